@@ -0,0 +1,22 @@
+"""
+Benchmarks of the indiredis web pages against synthetic devices.
+
+A redis server, or the fakeredis in-memory stand-in, is filled with devices, properties and
+elements in the key layout created by indi-mr, and the page responders are called with a
+minimal stand-in for the skipole skicall object. For each responder the latency, the number
+of redis round trips, the bytes sent to redis and the peak memory allocated are measured, and
+the results written as JSON, so runs before and after a change can be compared.
+
+Run with, for example::
+
+    python3 -m benchmarks --devices 2 --properties 200 --elements 8 --output results.json
+
+The option --fake uses fakeredis rather than a redis server, this requires the fakeredis
+package with lua support, installed with python3 -m pip install fakeredis[lua]
+
+The module benchmarks.loadgen drives the whole WSGI application with simulated browsers,
+polling and submitting forms while a fake driver publishes changes, to find the number of
+concurrent browsers a server can support::
+
+    python3 -m benchmarks.loadgen --sessions 20 --step 20 --duration 60 --target-ms 200
+"""
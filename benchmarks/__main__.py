@@ -0,0 +1,88 @@
+
+import argparse, json, platform, sys
+
+from datetime import datetime, timezone
+
+from indiredis.webcode import devices
+
+from .fixtures import make_redisserver, open_redis, populate
+from .harness import count_round_trips, make_proj_data, measure, BenchSkicall
+
+
+def run(args):
+    "Fills redis, measures each responder, and returns the results as a dictionary"
+    redisserver = make_redisserver(args.host, args.port, args.prefix)
+    rconn = open_redis(redisserver, fake=args.fake)
+    counter = count_round_trips(rconn)
+    pages = populate(rconn, redisserver, devices=args.devices, properties=args.properties,
+                     elements=args.elements, groups=args.groups)
+    proj_data = make_proj_data(rconn, redisserver, cache=args.cache)
+    devicename, group = pages[0]
+
+    # the versions a browser holds after loading each page
+    skicall = BenchSkicall(proj_data)
+    devices.devicelist(skicall)
+    listversion = skicall.call_data["version1"]
+    skicall = BenchSkicall(proj_data, {'device':devicename, 'group':group})
+    devices.refreshproperties(skicall)
+    version1 = skicall.call_data["version1"]
+    version2 = skicall.call_data["version2"]
+
+    cases = [("devicelist", devices.devicelist, {}),
+             ("check_for_update", devices.check_for_update, {'version1':listversion}),
+             ("refreshproperties", devices.refreshproperties, {'device':devicename, 'group':group}),
+             ("check_for_device_change", devices.check_for_device_change,
+                {'device':devicename, 'group':group, 'version1':version1, 'version2':version2}),
+             # an out of date version1 gives the json update of the number vectors
+             ("check_for_device_change_update", devices.check_for_device_change,
+                {'device':devicename, 'group':group, 'version1':-1, 'version2':version2})]
+    results = [measure(name, responder, proj_data, call_data, counter, repeat=args.repeat)
+               for name, responder, call_data in cases]
+
+    if not args.keep:
+        keys = list(rconn.scan_iter(redisserver.keyprefix + '*'))
+        if keys:
+            rconn.delete(*keys)
+
+    return {'timestamp':datetime.now(timezone.utc).isoformat(),
+            'python':platform.python_version(),
+            'parameters':{'devices':args.devices,
+                          'properties':args.properties,
+                          'elements':args.elements,
+                          'groups':args.groups,
+                          'cache':args.cache,
+                          'fake':args.fake},
+            'results':results}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks", description="Benchmarks the indiredis properties pages against synthetic devices.")
+    parser.add_argument("--devices", type=int, default=1, help="Number of devices (default 1).")
+    parser.add_argument("--properties", type=int, default=50, help="Number of properties of each device (default 50).")
+    parser.add_argument("--elements", type=int, default=4, help="Number of elements of each property (default 4).")
+    parser.add_argument("--groups", type=int, default=4, help="Number of groups of each device (default 4).")
+    parser.add_argument("--repeat", type=int, default=50, help="Number of calls of each responder (default 50).")
+    parser.add_argument("--cache", action="store_true", help="Read pages from the in-memory property cache, rather than redis.")
+    parser.add_argument("--fake", action="store_true", help="Use fakeredis rather than a redis server, requires fakeredis[lua].")
+    parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark keys from redis when finished.")
+    parser.add_argument("--rhost", dest="host", default="localhost", help="Hostname of the redis server (default localhost).")
+    parser.add_argument("--rport", dest="port", type=int, default=6379, help="Port of the redis server (default 6379).")
+    parser.add_argument("--prefix", default="bench_", help="Prefix applied to the benchmark redis keys (default bench_).")
+    parser.add_argument("--output", help="File to which the JSON results are written, default standard output.")
+    args = parser.parse_args()
+
+    report = run(args)
+    for result in report['results']:
+        latency = result['latency_ms']
+        print(f"{result['responder']:32} median {latency['median']:8.3f} ms  p95 {latency['p95']:8.3f} ms  "
+              f"round trips {result['round_trips']:6.1f}  peak memory {result['peak_memory_bytes']:10d} bytes", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+
+"""Fills redis with synthetic devices in the indi-mr key layout."""
+
+from datetime import datetime, timezone
+
+from indi_mr import redis_server, tools
+
+
+# vector types given to properties in turn
+VECTORS = ("NumberVector", "SwitchVector", "TextVector", "LightVector", "BLOBVector")
+
+
+def make_redisserver(host='localhost', port=6379, prefix='bench_'):
+    "Returns the redis_server named tuple used by the benchmarks, a prefix keeps the keys apart from real data"
+    return redis_server(host=host, port=port, db=0, password='', keyprefix=prefix,
+                        to_indi_channel='bench_to_indi', from_indi_channel='bench_from_indi')
+
+
+def open_redis(redisserver, fake=False):
+    "Returns a connection to the redis server, or to a fakeredis in-memory server"
+    if fake:
+        import fakeredis
+        return fakeredis.FakeRedis()
+    return tools.open_redis(redisserver)
+
+
+def _element(vector, propertyname, index):
+    "Returns the element attribute dictionary for the vector type"
+    name = f"{propertyname}_e{index}"
+    eld = {'name':name, 'label':f"Element {index}"}
+    if vector == "NumberVector":
+        eld.update({'format':'%8.3f', 'min':'0', 'max':'1000', 'step':'1', 'value':str(index * 1.5)})
+    elif vector == "SwitchVector":
+        eld['value'] = "On" if index == 0 else "Off"
+    elif vector == "TextVector":
+        eld['value'] = f"text value {index}"
+    elif vector == "LightVector":
+        eld['value'] = "Ok"
+    else:
+        eld.update({'format':'', 'size':'0', 'filepath':''})
+    return eld
+
+
+def populate(rconn, redisserver, devices=1, properties=50, elements=4, groups=4):
+    """Deletes any earlier benchmark keys, and creates the given number of devices, each with
+       the given number of properties spread over groups, each with the given number of elements.
+       Returns the list of (devicename, groupname) of the groups created"""
+    prefix = redisserver.keyprefix
+    keys = list(rconn.scan_iter(prefix + '*'))
+    if keys:
+        rconn.delete(*keys)
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    pages = []
+    pipe = rconn.pipeline()
+    for d in range(devices):
+        devicename = f"Bench Device {d}"
+        pipe.sadd(prefix + 'devices', devicename)
+        pipe.lpush(prefix + 'devicemessages:' + devicename, f"{timestamp} Device {d} ready")
+        for g in range(groups):
+            pages.append((devicename, f"Group {g}"))
+        for p in range(properties):
+            vector = VECTORS[p % len(VECTORS)]
+            propertyname = f"PROP_{p}"
+            attributes = {'name':propertyname, 'label':f"Property {p}", 'group':f"Group {p % groups}",
+                          'state':'Ok', 'perm':'rw', 'timeout':'0', 'timestamp':timestamp,
+                          'message':'', 'device':devicename, 'vector':vector}
+            if vector == "SwitchVector":
+                attributes['rule'] = 'OneOfMany'
+            elif vector == "LightVector":
+                attributes['perm'] = 'ro'
+            elif vector == "BLOBVector":
+                attributes['blobs'] = 'Enabled'
+            pipe.sadd(prefix + 'properties:' + devicename, propertyname)
+            pipe.hset(prefix + 'attributes:' + propertyname + ':' + devicename, mapping=attributes)
+            for e in range(elements):
+                eld = _element(vector, propertyname, e)
+                pipe.sadd(prefix + 'elements:' + propertyname + ':' + devicename, eld['name'])
+                pipe.hset(prefix + 'elementattributes:' + eld['name'] + ':' + propertyname + ':' + devicename, mapping=eld)
+        pipe.execute()
+    rconn.lpush(prefix + 'messages', f"{timestamp} Benchmark devices loaded")
+    return pages
@@ -0,0 +1,122 @@
+
+"""Calls page responders with a stand-in skicall, measuring latency, redis round trips and memory."""
+
+import statistics, tracemalloc
+
+from time import perf_counter
+
+from indiredis.webcode.cache import DeviceCache
+from indiredis.webcode.compressjobs import CompressionPool
+from indiredis.webcode.preview import PreviewMaker
+
+
+class RoundTrips():
+    "Counts the commands, or pipelines, sent to redis and the bytes sent"
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def reset(self):
+        self.calls = 0
+        self.bytes = 0
+
+
+def count_round_trips(rconn):
+    """Replaces the connection class of the connection pool of rconn by one counting each
+       send to the server, returns the RoundTrips counter. Call before rconn is used"""
+    counter = RoundTrips()
+    pool = rconn.connection_pool
+    base = pool.connection_class
+
+    def send_packed_command(connection, command, check_health=True):
+        counter.calls += 1
+        if isinstance(command, (bytes, bytearray, memoryview)):
+            counter.bytes += len(command)
+        else:
+            counter.bytes += sum(len(item) for item in command)
+        return base.send_packed_command(connection, command, check_health)
+
+    pool.connection_class = type("Counting" + base.__name__, (base,), {'send_packed_command':send_packed_command})
+    # discard any connections already made with the original class
+    pool.reset()
+    return counter
+
+
+def make_proj_data(rconn, redisserver, cache=False):
+    """Returns proj_data as created by indiredis.make_wsgi_app, but without background threads.
+       If cache is True the property cache is loaded, otherwise pages are read from redis"""
+    propertycache = None
+    if cache:
+        propertycache = DeviceCache(rconn, redisserver)
+        propertycache._load()
+        propertycache.ready = True
+    return {"rconn":rconn,
+            "redisserver":redisserver,
+            "propertycache":propertycache,
+            "singleflight":None,
+            "sessions":None,
+            "compression":CompressionPool(rconn, redisserver),
+            "rediskey":redisserver.keyprefix + 'cookies',
+            "blob_folder":'',
+            "previews":PreviewMaker(propertycache, rconn, redisserver, ''),
+            "blob_layout":"flat",
+            "hashedpassword":"",
+            "refresh_timeout":2}
+
+
+class BenchSkicall():
+    "The attributes and methods of a skipole skicall used by the page responders"
+
+    def __init__(self, proj_data, call_data=None):
+        self.proj_data = proj_data
+        self.call_data = dict(call_data or {})
+        self.page_data = {}
+        self.ident_data = ''
+        self.environ = {}
+        self.submit_dict = {}
+        self.received_cookies = {}
+
+    def makepath(self, *foldernames):
+        return "/" + "/".join(foldernames)
+
+
+def _percentile(values, fraction):
+    "Returns the value at the fraction of the sorted values"
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def measure(name, responder, proj_data, call_data, counter, repeat=50):
+    """Calls responder repeat times with a new skicall having a copy of call_data, and returns
+       a dictionary of the latencies in milliseconds, round trips and bytes sent to redis per
+       call, and the peak memory allocated by a single call"""
+    latencies = []
+    calls = 0
+    sent = 0
+    for count in range(repeat):
+        skicall = BenchSkicall(proj_data, call_data)
+        counter.reset()
+        start = perf_counter()
+        responder(skicall)
+        latencies.append((perf_counter() - start) * 1000)
+        calls += counter.calls
+        sent += counter.bytes
+    # memory is measured in a separate call, as tracing slows the calls timed above
+    skicall = BenchSkicall(proj_data, call_data)
+    tracemalloc.start()
+    try:
+        responder(skicall)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'responder':name,
+            'repeat':repeat,
+            'latency_ms':{'min':min(latencies),
+                          'mean':statistics.mean(latencies),
+                          'median':statistics.median(latencies),
+                          'p95':_percentile(latencies, 0.95),
+                          'max':max(latencies)},
+            'round_trips':calls / repeat,
+            'bytes_sent':sent / repeat,
+            'peak_memory_bytes':peak}
@@ -0,0 +1,536 @@
+
+"""Drives the indiredis WSGI application end to end with simulated browsers.
+
+The application created by indiredis.make_wsgi_app is called in-process, or served by
+waitress on localhost with the option --serve, and each simulated browser, a thread, opens
+the devices page and the properties page of a device, then polls as the pages do, the
+devices page every five seconds and the properties page every ten, and now and then submits
+a number or switch vector form. A fake driver answers the submitted vectors, and publishes
+changes to number vectors on the from_indi_channel, as indi-mr does.
+
+The number of browsers is increased in stages, and for each stage the throughput and the
+latency percentiles are reported, together with the largest number of browsers served
+before the 95th percentile latency exceeds the target.
+
+As the application subscribes to redis, a redis server is required, fakeredis is not used.
+
+Run with, for example::
+
+    python3 -m benchmarks.loadgen --sessions 20 --step 20 --max-sessions 200 --duration 60 --target-ms 200
+"""
+
+import argparse, http.client, json, platform, random, re, statistics, sys, threading
+
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from io import BytesIO
+from time import monotonic, perf_counter, sleep
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import xml.etree.ElementTree as ET
+
+from indiredis import make_wsgi_app
+
+from .fixtures import make_redisserver, open_redis, populate
+
+
+# pattern of the page ident and ident_data set into each html page
+_IDENTDATA = re.compile(r"SKIPOLE\.identdata = '([^']*)';")
+
+
+class _PageParser(HTMLParser):
+    "Collects the links and the form input fields of a html page"
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.inputs = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and attrs.get('href'):
+            self.links.append(attrs['href'])
+        elif tag == 'input' and attrs.get('name'):
+            self.inputs.append(attrs)
+
+
+class Page():
+    "The ident and forms of a html page, as a browser holds them"
+
+    def __init__(self, body):
+        text = body.decode('utf-8')
+        match = _IDENTDATA.search(text)
+        self.ident = match.group(1) if match else ''
+        parser = _PageParser()
+        parser.feed(text)
+        self.links = parser.links
+        # sections of the properties page, 'property_4' : list of input attribute dictionaries
+        self.sections = {}
+        for attrs in parser.inputs:
+            section, sep, field = attrs['name'].partition('-')
+            if sep and section.startswith('property_'):
+                self.sections.setdefault(section, []).append(attrs)
+
+    def update_ident(self, result):
+        "Sets the ident_data received in a json response, as skipole.js does"
+        if 'ident_data' in result:
+            parts = self.ident.split('_')
+            self.ident = parts[0] + '_' + parts[1] + '_' + result['ident_data']
+
+    def _forms(self, formname):
+        "Returns a list of (section, fields) of the forms shown, where fields is a list of input attributes"
+        forms = []
+        for section, fields in self.sections.items():
+            names = {attrs['name']:attrs.get('value', '') for attrs in fields}
+            # hidden forms are sent without a property name
+            if names.get(f"{section}-{formname}:propertyname"):
+                forms.append((section, fields))
+        return forms
+
+    def number_forms(self):
+        "Returns a list of (section, fields) of the number vector forms shown"
+        return self._forms('setnumber')
+
+    def switch_forms(self):
+        "Returns a list of (section, fields) of the radio button switch vector forms shown"
+        return [(section, fields) for section, fields in self._forms('setswitch')
+                if any(attrs['name'].endswith('-svradio:radio_checked') for attrs in fields)]
+
+
+class WSGIClient():
+    "Calls the WSGI application in-process"
+
+    def __init__(self, application):
+        self.application = application
+
+    def request(self, method, path, query='', body=b''):
+        "Returns the (status, body) of the response"
+        environ = {'REQUEST_METHOD':method,
+                   'SCRIPT_NAME':'',
+                   'PATH_INFO':path,
+                   'QUERY_STRING':query,
+                   'SERVER_NAME':'localhost',
+                   'SERVER_PORT':'80',
+                   'SERVER_PROTOCOL':'HTTP/1.1',
+                   'HTTP_HOST':'localhost',
+                   'REMOTE_ADDR':'127.0.0.1',
+                   'wsgi.version':(1, 0),
+                   'wsgi.url_scheme':'http',
+                   'wsgi.input':BytesIO(body),
+                   'wsgi.errors':sys.stderr,
+                   'wsgi.multithread':True,
+                   'wsgi.multiprocess':False,
+                   'wsgi.run_once':False}
+        if body:
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(body))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+
+        result = self.application(environ, start_response)
+        try:
+            data = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], data
+
+    def close(self):
+        pass
+
+
+class HTTPClient():
+    "Sends requests over a kept alive connection to the application served on localhost"
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, query='', body=b''):
+        "Returns the (status, body) of the response"
+        if query:
+            path = path + '?' + query
+        headers = {'Content-Type':'application/x-www-form-urlencoded'} if body else {}
+        try:
+            self.connection.request(method, path, body=body or None, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            # the connection is re-opened by the next request
+            self.connection.close()
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+class Recorder():
+    "Records the latency of each request made by the browsers"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    def add(self, kind, start, latency, ok):
+        with self._lock:
+            self._records.append((kind, start, latency, ok))
+
+    def summary(self, begin, end):
+        "Returns a dictionary of the requests started between the begin and end times"
+        records = [record for record in self._records if begin <= record[1] < end]
+        kinds = sorted(set(record[0] for record in records))
+        result = {'all':_stats(records, end - begin)}
+        for kind in kinds:
+            result[kind] = _stats([record for record in records if record[0] == kind], end - begin)
+        return result
+
+
+def _percentile(values, fraction):
+    "Returns the value at the fraction of the sorted values"
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def _stats(records, seconds):
+    "Returns the request count, errors, throughput and latency percentiles in milliseconds"
+    latencies = sorted(record[2] * 1000 for record in records)
+    stats = {'requests':len(records),
+             'errors':sum(1 for record in records if not record[3]),
+             'throughput_rps':len(records) / seconds if seconds else 0.0}
+    if latencies:
+        stats['latency_ms'] = {'mean':statistics.mean(latencies),
+                               'p50':_percentile(latencies, 0.5),
+                               'p90':_percentile(latencies, 0.9),
+                               'p95':_percentile(latencies, 0.95),
+                               'p99':_percentile(latencies, 0.99),
+                               'max':latencies[-1]}
+    return stats
+
+
+class Browser(threading.Thread):
+    """Opens the devices page and a properties page, then polls and submits forms
+       at the cadence of a browser, until stop is set"""
+
+    def __init__(self, client, url, recorder, stop, args, seed):
+        super().__init__(daemon=True)
+        self.client = client
+        self.url = url.rstrip("/") + "/"
+        self.recorder = recorder
+        self.stop = stop
+        self.args = args
+        self.random = random.Random(seed)
+        self.home = None
+        self.page = None
+        self.loaded = False
+
+    def _call(self, kind, method, path, fields):
+        "Makes a request, records its latency, and returns the body, or None on failure"
+        body = b''
+        query = urlencode(fields)
+        if method == 'POST':
+            body, query = query.encode('ascii'), ''
+        start = monotonic()
+        timer = perf_counter()
+        try:
+            status, data = self.client.request(method, path, query, body)
+        except Exception:
+            self.recorder.add(kind, start, perf_counter() - timer, False)
+            return
+        self.recorder.add(kind, start, perf_counter() - timer, status == 200)
+        if status == 200:
+            return data
+
+    def _open(self, kind, href):
+        "Opens a html page given a link, which may include a query string, returns a Page or None"
+        parts = urlsplit(href)
+        path = parts.path if parts.path.startswith("/") else self.url + parts.path
+        data = self._call(kind, 'GET', path, parse_qsl(parts.query))
+        if data is not None:
+            return Page(data)
+
+    def _json(self, kind, method, path, page, fields=()):
+        "Calls a json responder from the page, following any request for a html refresh"
+        data = self._call(kind, method, path, [('ident', page.ident)] + list(fields))
+        if data is None:
+            return page
+        try:
+            result = json.loads(data)
+        except ValueError:
+            return page
+        if 'JSONtoHTML' in result:
+            refreshed = self._open(kind + "_refresh", result['JSONtoHTML'] + "?ident=" + page.ident)
+            return refreshed or page
+        page.update_ident(result)
+        return page
+
+    def _load(self):
+        "Opens the devices page, then the properties page of a device, returns True on success"
+        self.home = self._open("home", self.url)
+        if self.home is None:
+            return False
+        links = [href for href in self.home.links if urlsplit(href).path.endswith("properties")]
+        if not links:
+            return False
+        self.page = self._open("properties", self.random.choice(links))
+        return self.page is not None
+
+    def _submit(self):
+        "Submits a number vector, or a switch vector, form of the properties page"
+        forms = [('setnumber', form) for form in self.page.number_forms()]
+        forms.extend(('setswitch', form) for form in self.page.switch_forms())
+        if not forms:
+            return
+        formname, (section, fields) = self.random.choice(forms)
+        submit = []
+        radios = []
+        for attrs in fields:
+            name = attrs['name']
+            if name.startswith(f"{section}-{formname}:"):
+                submit.append((name, attrs.get('value', '')))
+            elif ':inputdict-' in name:
+                submit.append((name, f"{self.random.uniform(0, 1000):.3f}"))
+            elif name.endswith('-svradio:radio_checked'):
+                radios.append((name, attrs.get('value', '')))
+        if formname == 'setnumber':
+            self.page = self._json("set_numbervector", 'POST', self.url + "set/numbervector", self.page, submit)
+        elif radios:
+            submit.append(self.random.choice(radios))
+            self.page = self._json("set_switchvector", 'POST', self.url + "set/switchvector", self.page, submit)
+
+    def run(self):
+        try:
+            self.loaded = self._load()
+            if not self.loaded:
+                return
+            args = self.args
+            now = monotonic()
+            # each browser starts its cycle at a random point, as real browsers are not in step
+            due = {'home':now + self.random.uniform(0, args.home_poll),
+                   'poll':now + self.random.uniform(0, args.poll),
+                   'submit':now + self.random.uniform(0, args.submit) if args.submit else None}
+            while not self.stop.is_set():
+                action = min((when, name) for name, when in due.items() if when is not None)[1]
+                if self.stop.wait(max(0, due[action] - monotonic())):
+                    break
+                if action == 'home':
+                    self.home = self._json("check_for_update", 'GET', self.url + "homeonanyupdate", self.home)
+                    due['home'] += args.home_poll
+                elif action == 'poll':
+                    self.page = self._json("check_for_device_change", 'GET', self.url + "checkupdates", self.page)
+                    due['poll'] += args.poll
+                else:
+                    self._submit()
+                    due['submit'] += args.submit
+        finally:
+            self.client.close()
+
+
+class FakeDriver(threading.Thread):
+    """Answers the vectors sent on the to_indi_channel, and changes number vectors at the
+       given rate per second, setting values into redis and publishing the setNumberVector
+       and setSwitchVector on the from_indi_channel, as indi-mr does"""
+
+    def __init__(self, rconn, redisserver, rate, seed=0):
+        super().__init__(daemon=True)
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.stop = threading.Event()
+        self.numbervectors = self._numbervectors()
+
+    def _numbervectors(self):
+        "Returns a list of (devicename, propertyname) of the number vectors in redis"
+        prefix = self.redisserver.keyprefix
+        found = []
+        for devicename in sorted(self.rconn.smembers(prefix + 'devices')):
+            devicename = devicename.decode('utf-8')
+            for propertyname in sorted(self.rconn.smembers(prefix + 'properties:' + devicename)):
+                propertyname = propertyname.decode('utf-8')
+                vector = self.rconn.hget(prefix + 'attributes:' + propertyname + ':' + devicename, 'vector')
+                if vector == b'NumberVector':
+                    found.append((devicename, propertyname))
+        return found
+
+    def _set(self, vector, devicename, propertyname, values):
+        "Sets the element values into redis, and publishes the set vector"
+        prefix = self.redisserver.keyprefix
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        root = ET.Element("set" + vector, device=devicename, name=propertyname, state="Ok", timestamp=timestamp)
+        one = "oneNumber" if vector == "NumberVector" else "oneSwitch"
+        pipe = self.rconn.pipeline()
+        pipe.hset(prefix + 'attributes:' + propertyname + ':' + devicename, mapping={'state':'Ok', 'timestamp':timestamp})
+        for name, value in values.items():
+            pipe.hset(prefix + 'elementattributes:' + name + ':' + propertyname + ':' + devicename, 'value', value)
+            ET.SubElement(root, one, name=name).text = value
+        pipe.publish(self.redisserver.from_indi_channel, ET.tostring(root))
+        pipe.execute()
+
+    def _answer(self, data):
+        "Sets the values of a newNumberVector or newSwitchVector received from a client"
+        try:
+            root = ET.fromstring(data)
+        except ET.ParseError:
+            return
+        if root.tag not in ("newNumberVector", "newSwitchVector"):
+            return
+        values = {child.get("name"):(child.text or '').strip() for child in root}
+        self._set(root.tag[3:], root.get("device"), root.get("name"), values)
+
+    def _change(self):
+        "Changes the values of a randomly chosen number vector"
+        devicename, propertyname = self.random.choice(self.numbervectors)
+        prefix = self.redisserver.keyprefix
+        names = self.rconn.smembers(prefix + 'elements:' + propertyname + ':' + devicename)
+        values = {name.decode('utf-8'):f"{self.random.uniform(0, 1000):.3f}" for name in names}
+        self._set("NumberVector", devicename, propertyname, values)
+
+    def run(self):
+        pubsub = self.rconn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.redisserver.to_indi_channel)
+        interval = 1 / self.rate if (self.rate and self.numbervectors) else None
+        due = monotonic()
+        try:
+            while not self.stop.is_set():
+                timeout = 0.1 if interval is None else min(0.1, max(0, due - monotonic()))
+                message = pubsub.get_message(timeout=timeout)
+                if message and message['type'] == 'message':
+                    self._answer(message['data'])
+                if (interval is not None) and (monotonic() >= due):
+                    self._change()
+                    due += interval
+        finally:
+            pubsub.close()
+
+
+def _serve(application, port, threads):
+    "Serves the application with waitress on localhost, returns the server"
+    from waitress import create_server
+    server = create_server(application, host='127.0.0.1', port=port, threads=threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+def run_stage(clientfactory, url, sessions, recorder, args):
+    """Runs the given number of browsers, started over the ramp time, then measures for the
+       duration, and returns the summary of the requests made while measuring"""
+    stop = threading.Event()
+    browsers = []
+    for count in range(sessions):
+        browser = Browser(clientfactory(), url, recorder, stop, args, seed=sessions * 100000 + count)
+        browser.start()
+        browsers.append(browser)
+        sleep(args.ramp / sessions)
+    begin = monotonic()
+    sleep(args.duration)
+    end = monotonic()
+    stop.set()
+    for browser in browsers:
+        browser.join()
+    result = recorder.summary(begin, end)
+    result['sessions'] = sessions
+    # browsers which failed to open their pages made no further requests
+    result['loaded'] = sum(1 for browser in browsers if browser.loaded)
+    return result
+
+
+def run(args):
+    "Fills redis, runs stages of increasing numbers of browsers, and returns the results as a dictionary"
+    redisserver = make_redisserver(args.host, args.port, args.prefix)
+    rconn = open_redis(redisserver)
+    populate(rconn, redisserver, devices=args.devices, properties=args.properties,
+             elements=args.elements, groups=args.groups)
+    # browsers poll, rather than holding event streams
+    application = make_wsgi_app(redisserver, event_streams=0)
+    if args.serve:
+        server = _serve(application, args.serve, args.threads)
+        clientfactory = lambda : HTTPClient('127.0.0.1', args.serve)
+    else:
+        server = None
+        client = WSGIClient(application)
+        clientfactory = lambda : client
+    driver = FakeDriver(rconn, redisserver, args.update_rate)
+    driver.start()
+    stages = []
+    max_sessions = 0
+    sessions = args.sessions
+    try:
+        while sessions <= args.max_sessions:
+            stage = run_stage(clientfactory, "/", sessions, Recorder(), args)
+            stages.append(stage)
+            latency = stage['all'].get('latency_ms')
+            print(f"sessions {sessions:6d}  requests {stage['all']['requests']:8d}  errors {stage['all']['errors']:6d}  "
+                  f"throughput {stage['all']['throughput_rps']:8.1f} /s  "
+                  f"p95 {latency['p95'] if latency else 0:8.3f} ms", file=sys.stderr)
+            if ((latency is None) or (latency['p95'] > args.target_ms) or stage['all']['errors']
+                    or (stage['loaded'] < sessions)):
+                break
+            max_sessions = sessions
+            if not args.step:
+                break
+            sessions += args.step
+    finally:
+        driver.stop.set()
+        driver.join()
+        if server is not None:
+            server.close()
+        if not args.keep:
+            keys = list(rconn.scan_iter(redisserver.keyprefix + '*'))
+            if keys:
+                rconn.delete(*keys)
+
+    return {'timestamp':datetime.now(timezone.utc).isoformat(),
+            'python':platform.python_version(),
+            'parameters':{'devices':args.devices,
+                          'properties':args.properties,
+                          'elements':args.elements,
+                          'groups':args.groups,
+                          'duration':args.duration,
+                          'home_poll':args.home_poll,
+                          'poll':args.poll,
+                          'submit':args.submit,
+                          'update_rate':args.update_rate,
+                          'serve':bool(args.serve),
+                          'threads':args.threads if args.serve else None,
+                          'target_ms':args.target_ms},
+            'max_sessions':max_sessions,
+            'stages':stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.loadgen", description="Load tests the indiredis web application with simulated browsers.")
+    parser.add_argument("--devices", type=int, default=1, help="Number of devices (default 1).")
+    parser.add_argument("--properties", type=int, default=50, help="Number of properties of each device (default 50).")
+    parser.add_argument("--elements", type=int, default=4, help="Number of elements of each property (default 4).")
+    parser.add_argument("--groups", type=int, default=4, help="Number of groups of each device (default 4).")
+    parser.add_argument("--sessions", type=int, default=10, help="Number of browsers in the first stage (default 10).")
+    parser.add_argument("--step", type=int, default=10, help="Browsers added at each stage, zero for a single stage (default 10).")
+    parser.add_argument("--max-sessions", type=int, default=500, help="Largest number of browsers tried (default 500).")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds each stage is measured (default 30).")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds over which the browsers of a stage are started (default 5).")
+    parser.add_argument("--target-ms", type=float, default=250, help="95th percentile latency target in milliseconds (default 250).")
+    parser.add_argument("--home-poll", type=float, default=5, help="Seconds between polls of the devices page (default 5).")
+    parser.add_argument("--poll", type=float, default=10, help="Seconds between polls of the properties page (default 10).")
+    parser.add_argument("--submit", type=float, default=30, help="Seconds between form submissions by each browser, zero for none (default 30).")
+    parser.add_argument("--update-rate", type=float, default=2, help="Number vector changes per second published by the fake driver (default 2).")
+    parser.add_argument("--serve", type=int, default=0, metavar="PORT", help="Serve the application with waitress on this localhost port, rather than calling it in-process.")
+    parser.add_argument("--threads", type=int, default=4, help="Number of waitress threads with --serve (default 4).")
+    parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark keys from redis when finished.")
+    parser.add_argument("--rhost", dest="host", default="localhost", help="Hostname of the redis server (default localhost).")
+    parser.add_argument("--rport", dest="port", type=int, default=6379, help="Port of the redis server (default 6379).")
+    parser.add_argument("--prefix", default="bench_", help="Prefix applied to the benchmark redis keys (default bench_).")
+    parser.add_argument("--output", help="File to which the JSON results are written, default standard output.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(f"maximum sessions within {args.target_ms} ms p95 latency: {report['max_sessions']}", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,14 +17,34 @@ make_wsgi_app() in your own script with your preferred web server.
 
 import os, sys, pathlib, time, configparser, hashlib, threading, json
 
+from http.cookies import SimpleCookie
+
 from datetime import datetime
 
-from waitress import serve
+from waitress import create_server
 
-from skipole import WSGIApplication, use_submit_list, skis, ServeFile, set_debug
+from skipole import WSGIApplication, use_submit_list, skis, set_debug
 
 from indi_mr import tools, inditoredis, indi_server, redis_server, mqtttoredis, mqtt_server, driverstoredis
 
+from .webcode.cache import DeviceCache
+from .webcode.events import EventStream
+from .webcode.coalesce import SingleFlight
+from .webcode.asgi import ASGIApplication
+from .webcode.authenticate import SessionCache
+from .webcode.blobindex import BlobIndexer, blob_usage, migrate_blob_folder
+from .webcode.layout import LAYOUTS
+from .webcode.dedup import BlobDeduplicator
+from .webcode.janitor import BlobJanitor, blob_retention
+from .webcode.blobserve import BlobServer
+from .webcode.preview import PreviewMaker, PreviewServer
+from .webcode.blobupload import UploadServer
+from .webcode.compressjobs import CompressionPool
+from .webcode.pool import redis_pool, open_redis_pool, pool_stats, background_connections
+from .webcode.numberstream import NumberStreamServer
+from .webcode.instrument import RedisMeter
+from .webcode.metrics import Metrics, MetricsServer
+
 PROJECTFILES = os.path.dirname(os.path.realpath(__file__))
 PROJECT = 'indiredis'
 
@@ -32,6 +52,9 @@ PROJECT = 'indiredis'
 def _start_call(called_ident, skicall):
     "When a call is initially received this function is called."
 
+    # time the call, and count its redis commands, until _end_call
+    skicall.proj_data["meter"].begin(skicall.path, called_ident[1] if called_ident else None)
+
     if skicall.proj_data["hashedpassword"]:
         # a password has been set, so pages must be protected
         if _is_user_logged_in(skicall):
@@ -47,32 +70,32 @@ def _start_call(called_ident, skicall):
             return "login"
 
     if called_ident is None:
-        # blobs are served at /projectpath/blobs
-        servedfile = skicall.map_url_to_server("blobs", skicall.proj_data["blob_folder"])
-        if servedfile:
-            raise ServeFile(servedfile, mimetype="application/octet-stream")
+        # url not found, blobs at /projectpath/blobs are served by the _Dispatcher route
         return
 
     if skicall.ident_data:
         # if ident_data exists, it should optionally be
         # the device name and property group to be displayed
-        # with two checksums
-        # checksum1 - flags if the page has been changed
-        # checksum2 - flags if an html refresh is needed, rather than json update
+        # with two versions
+        # version1 - flags if the page has been changed
+        # version2 - flags if an html refresh is needed, rather than json update
         # set these into skicall.call_data
         sessiondata = skicall.ident_data.split("/n")
-        checksum1 = sessiondata[0]
-        if checksum1:
-            skicall.call_data["checksum1"] = int(checksum1)
-        checksum2 = sessiondata[1]
-        if checksum2:
-            skicall.call_data["checksum2"] = int(checksum2)
+        version1 = sessiondata[0]
+        if version1:
+            skicall.call_data["version1"] = int(version1)
+        version2 = sessiondata[1]
+        if version2:
+            skicall.call_data["version2"] = int(version2)
         device = sessiondata[2]
         if device:
             skicall.call_data["device"] = device
         group = sessiondata[3]
         if group:
             skicall.call_data["group"] = group
+        # a key of the browser, if set by setvalues.client_key
+        if len(sessiondata) > 4 and sessiondata[4]:
+            skicall.call_data["client"] = sessiondata[4]
     return called_ident
 
 
@@ -84,6 +107,7 @@ def _submit_data(skicall):
 
 def _end_call(page_ident, page_type, skicall):
     """This function is called at the end of a call prior to filling the returned page with skicall.page_data"""
+    skicall.proj_data["meter"].end()
     if skicall.call_data.get('authenticate'):
         # a user has logged in, set a cookie
         return skicall.call_data['authenticate']
@@ -97,16 +121,16 @@ def _end_call(page_ident, page_type, skicall):
         skicall.page_data["status", "hide"] = False
 
     # set device and group into a string to be sent as ident_data
-        # with two checksums
-        # checksum1 - flags if the page has been changed
-        # checksum2 - flags if an html refresh is needed, rather than json update
-    # checksum1 is a checksum of the data shown on the page (using zlib.adler32(data))
-    if 'checksum1' in skicall.call_data:
-        identstring = str(skicall.call_data['checksum1']) + "/n"
+        # with two versions
+        # version1 - flags if the page has been changed
+        # version2 - flags if an html refresh is needed, rather than json update
+    # the versions are sums of the counters in webcode.versions, which increase on every change
+    if 'version1' in skicall.call_data:
+        identstring = str(skicall.call_data['version1']) + "/n"
     else:
         identstring = "/n"
-    if 'checksum2' in skicall.call_data:
-        identstring += str(skicall.call_data['checksum2']) + "/n"
+    if 'version2' in skicall.call_data:
+        identstring += str(skicall.call_data['version2']) + "/n"
     else:
         identstring += "/n"
     if "device" in skicall.call_data:
@@ -115,6 +139,8 @@ def _end_call(page_ident, page_type, skicall):
         identstring += "/n"
     if "group" in skicall.call_data:
         identstring += skicall.call_data["group"]
+    if "client" in skicall.call_data:
+        identstring += "/n" + skicall.call_data["client"]
 
     # set this string to ident_data
     skicall.page_data['ident_data'] = identstring
@@ -126,9 +152,18 @@ def _is_user_logged_in(skicall):
     if proj not in skicall.received_cookies:
         return False
     receivedcookie = skicall.received_cookies[proj]
+    return _valid_cookie(skicall.proj_data, receivedcookie)
+
+
+def _valid_cookie(proj_data, receivedcookie):
+    "Checks the cookie exists in redis, and if it does, updates its timestamp"
+    sessions = proj_data.get("sessions")
+    if sessions is not None:
+        # recently validated cookies are not read from redis, and their timestamps are written in batches
+        return sessions.is_valid(receivedcookie)
     # check cookie exists in redis sorted set
-    rediskey = skicall.proj_data["rediskey"]
-    rconn = skicall.proj_data["rconn"]
+    rediskey = proj_data["rediskey"]
+    rconn = proj_data["rconn"]
     # check the score of this cookie in the sorted set
     score = rconn.zscore(rediskey, receivedcookie)
     # if this cookie has a score of None, it does not exist
@@ -139,35 +174,128 @@ def _is_user_logged_in(skicall):
     return True
 
 
+def _logged_in_cookie(proj_data, cookieheader):
+    """Given the Cookie header of a request which is not passed to the skipole application,
+       returns True if no password is set, or if the user is logged in"""
+    if not proj_data["hashedpassword"]:
+        return True
+    cookies = SimpleCookie(cookieheader)
+    if PROJECT not in cookies:
+        return False
+    return _valid_cookie(proj_data, cookies[PROJECT].value)
+
+
+class _Dispatcher():
+    """A WSGI application which passes calls to the given routes, being a dictionary of
+       path:WSGI application, and any other call to the skipole application. A path
+       ending in "/" routes every call to a path below it. Routes require a logged in
+       user, other than those whose paths are in public.
+       Other attributes are those of the skipole application."""
+
+    def __init__(self, application, routes, proj_data, public=()):
+        self.application = application
+        self.routes = routes
+        self.public = set(public)
+        self.prefixes = [(path, route) for path, route in routes.items() if path.endswith("/")]
+        self.proj_data = proj_data
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        route = self.routes.get(path)
+        if route is None:
+            for prefix, prefixroute in self.prefixes:
+                if path.startswith(prefix):
+                    route = prefixroute
+                    # as WSGI middleware, the route's path is moved to SCRIPT_NAME, leaving the
+                    # remainder, such as the path of a file within a folder, as PATH_INFO
+                    environ = dict(environ, SCRIPT_NAME=environ.get('SCRIPT_NAME', '') + prefix[:-1],
+                                   PATH_INFO=path[len(prefix)-1:])
+                    break
+            else:
+                return self.application(environ, start_response)
+        if (path not in self.public) and (not self._logged_in(environ)):
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return [b"Not logged in"]
+        return route(environ, start_response)
 
-def make_wsgi_app(redisserver, blob_folder='', url="/", hashedpassword=""):
-    """Create a wsgi application which can be served by a WSGI compatable web server.
-    Reads and writes to redis stores created by indi-mr
+    def _logged_in(self, environ):
+        "Checks the cookie set by the skipole application at login"
+        return _logged_in_cookie(self.proj_data, environ.get('HTTP_COOKIE', ''))
 
-    :param redisserver: Named Tuple providing the redis server parameters
-    :type redisserver: namedtuple
-    :param blob_folder: Folder where Blobs will be stored
-    :type blob_folder: String
-    :param url: URL at which the web service is served
-    :type url: String
-    :param hashedpassword: Hashed password or empty value
-    :type hashedpassword: String
-    :return: A WSGI callable application
-    :rtype: skipole.WSGIApplication
-    """
+    def pool_stats(self):
+        """Returns a dictionary of redis connection pool usage, with keys
+           'max_connections', 'created', 'in_use' and 'available'"""
+        return pool_stats(self.proj_data["rconn"])
+
+    def blob_usage(self):
+        "Returns a dictionary with keys 'files' and 'bytes', the number and total size of BLOB files"
+        return blob_usage(self.proj_data["rconn"], self.proj_data["redisserver"])
+
+    def set_server(self, server):
+        "Sets the waitress server serving this application, so its task queue is shown in the metrics"
+        self.proj_data["metrics"].server = server
+
+    def __getattr__(self, name):
+        return getattr(self.application, name)
+
+
+
+def _make_application(redisserver, blob_folder, url, hashedpassword, event_streams,
+                      websocket_host, websocket_port, refresh_timeout, redis_pool,
+                      compress_workers, compress_level, blob_retention, blob_layout, blob_dedup,
+                      slow_request, slow_log, public_metrics):
+    """Creates the skipole application, the property cache and optional number stream server,
+       and returns the application wrapped in a _Dispatcher serving the event stream"""
 
     if blob_folder:
         blob_folder = pathlib.Path(blob_folder).expanduser().resolve()
+    if blob_layout not in LAYOUTS:
+        raise ValueError(f"blob_layout must be one of {LAYOUTS}")
 
-    # The web service needs a redis connection, available in tools
-    rconn = tools.open_redis(redisserver)
+    # The web service needs a redis connection, from a pool if one is described,
+    # otherwise as available in tools
+    if redis_pool is None:
+        rconn = tools.open_redis(redisserver)
+    else:
+        rconn = open_redis_pool(redisserver, redis_pool)
+    # the redis use of each request is recorded, and slow requests logged
+    metrics = Metrics()
+    meter = RedisMeter(slow_request, slow_log, metrics)
+    meter.instrument(rconn)
+    # the property cache holds devices and properties in memory, updated by a thread
+    # subscribed to the redis from_indi_channel
+    propertycache = DeviceCache(rconn, redisserver)
+    # files with identical contents stored once, as hard links, once they have been indexed
+    deduplicator = None
+    if blob_dedup:
+        deduplicator = BlobDeduplicator(rconn, redisserver, blob_folder)
+        deduplicator.start()
+    # BLOB files are indexed as they are received, for the blobs page
+    BlobIndexer(propertycache, rconn, redisserver, blob_folder, blob_layout, deduplicator).start()
+    # and previews made of received FITS images, if numpy is available
+    previews = PreviewMaker(propertycache, rconn, redisserver, blob_folder)
+    previews.start()
+    # and the oldest files deleted when the folder exceeds the retention limits
+    if blob_retention is not None:
+        BlobJanitor(rconn, redisserver, blob_folder, blob_retention, previews).start()
+    propertycache.start()
     # and pass parameters in proj_data, note that resdiskey will be the key used to store cookies, created
     # as users log in
     proj_data = {"rconn":rconn,
                  "redisserver":redisserver,
+                 "propertycache":propertycache,
+                 "singleflight":SingleFlight(),
+                 "sessions":SessionCache(rconn, redisserver.keyprefix + 'cookies'),
+                 "compression":CompressionPool(rconn, redisserver, compress_workers, compress_level),
                  "rediskey":redisserver.keyprefix + 'cookies',
+                 "redis_pool":redis_pool,
                  "blob_folder":blob_folder,
-                 "hashedpassword":hashedpassword
+                 "previews":previews,
+                 "blob_layout":blob_layout,
+                 "hashedpassword":hashedpassword,
+                 "refresh_timeout":refresh_timeout,
+                 "meter":meter,
+                 "metrics":metrics
                 }
     application = WSGIApplication(project=PROJECT,
                                   projectfiles=PROJECTFILES,
@@ -187,7 +315,146 @@ def make_wsgi_app(redisserver, blob_folder='', url="/", hashedpassword=""):
 
     #set_debug(True)
 
-    return application
+    if websocket_port:
+        numberstream = NumberStreamServer(propertycache, lambda cookieheader : _logged_in_cookie(proj_data, cookieheader),
+                                          websocket_host, websocket_port)
+        numberstream.start()
+
+    # the event stream is served alongside the skipole application
+    routes = {url.rstrip("/") + "/events": EventStream(propertycache, event_streams)}
+    # large files can be sent to devices by POST to url + "upload", without being held in memory
+    routes[url.rstrip("/") + "/upload"] = UploadServer(rconn, redisserver)
+    if blob_folder:
+        # as are the blob files
+        routes[url.rstrip("/") + "/blobs/"] = BlobServer(blob_folder)
+        routes[url.rstrip("/") + "/previews/"] = PreviewServer(previews)
+    # metrics for Prometheus, which require a login unless public_metrics is set
+    metricspath = url.rstrip("/") + "/metrics"
+    routes[metricspath] = MetricsServer(metrics, proj_data)
+
+    return _Dispatcher(application, routes, proj_data, public=[metricspath] if public_metrics else [])
+
+
+def make_wsgi_app(redisserver, blob_folder='', url="/", hashedpassword="", event_streams=2,
+                  websocket_host="localhost", websocket_port=0, refresh_timeout=2, redis_pool=None,
+                  compress_workers=1, compress_level=9, blob_retention=None, blob_layout="flat",
+                  blob_dedup=False, slow_request=0, slow_log='', public_metrics=False):
+    """Create a wsgi application which can be served by a WSGI compatable web server.
+    Reads and writes to redis stores created by indi-mr
+
+    Browsers are informed of changes by a Server-Sent Events stream served at url + "events",
+    as each stream holds a thread of a threaded web server, event_streams limits the number
+    of concurrent streams, further browsers fall back to polling.
+
+    Metrics in the Prometheus text format are served at url + "metrics", which requires a login
+    if a password is set, unless public_metrics is True. If the application is served by
+    waitress, pass the server to application.set_server to include its task queue.
+
+    If websocket_port is given, a WebSocket server is also started, streaming NumberVector
+    values as they change, this requires the websockets package.
+
+    :param redisserver: Named Tuple providing the redis server parameters
+    :type redisserver: namedtuple
+    :param blob_folder: Folder where Blobs will be stored
+    :type blob_folder: String
+    :param url: URL at which the web service is served
+    :type url: String
+    :param hashedpassword: Hashed password or empty value
+    :type hashedpassword: String
+    :param event_streams: Maximum number of concurrent event streams
+    :type event_streams: Integer
+    :param websocket_host: Listenning IP address of the NumberVector WebSocket server
+    :type websocket_host: String
+    :param websocket_port: Port of the NumberVector WebSocket server, or zero for no server
+    :type websocket_port: Integer
+    :param refresh_timeout: Maximum seconds a device refresh waits for the device properties
+    :type refresh_timeout: Float
+    :param redis_pool: Named Tuple created by indiredis.redis_pool, or None for a single connection
+    :type redis_pool: namedtuple
+    :param compress_workers: Number of processes compressing uploaded BLOBs
+    :type compress_workers: Integer
+    :param compress_level: gzip compression level of uploaded BLOBs, 1 fastest to 9 smallest
+    :type compress_level: Integer
+    :param blob_retention: Named Tuple created by indiredis.blob_retention, or None to keep all BLOBs
+    :type blob_retention: namedtuple
+    :param blob_layout: "flat", or "sharded" to move BLOBs into folders YYYY/MM/DD/devicename
+    :type blob_layout: String
+    :param blob_dedup: If True, BLOBs identical to one already held are replaced by hard links to it
+    :type blob_dedup: Boolean
+    :param slow_request: Requests taking longer than this many milliseconds are logged, zero for no log
+    :type slow_request: Float
+    :param slow_log: File to which slow requests are appended, or empty for stderr
+    :type slow_log: String
+    :param public_metrics: If True, the metrics are served without a login, even if a password is set
+    :type public_metrics: Boolean
+    :return: A WSGI callable application
+    :rtype: A WSGI application wrapping skipole.WSGIApplication
+    """
+
+    return _make_application(redisserver, blob_folder, url, hashedpassword, event_streams,
+                             websocket_host, websocket_port, refresh_timeout, redis_pool,
+                             compress_workers, compress_level, blob_retention, blob_layout, blob_dedup,
+                             slow_request, slow_log, public_metrics)
+
+
+def make_asgi_app(redisserver, blob_folder='', url="/", hashedpassword="", workers=8,
+                  websocket_host="localhost", websocket_port=0, refresh_timeout=2, redis_pool=None,
+                  compress_workers=1, compress_level=9, blob_retention=None, blob_layout="flat",
+                  blob_dedup=False, slow_request=0, slow_log='', public_metrics=False):
+    """Create an asgi application which can be served by an ASGI compatable web server,
+    such as uvicorn. Reads and writes to redis stores created by indi-mr
+
+    The web pages are those of make_wsgi_app, created in a pool of worker threads, but the
+    Server-Sent Events stream at url + "events" is served on the asyncio event loop, so any
+    number of browsers can hold a stream open without each holding a thread.
+    This requires redis version 4.2 or later, which provides redis.asyncio.
+
+    If websocket_port is given, a WebSocket server is also started, streaming NumberVector
+    values as they change, this requires the websockets package.
+
+    :param redisserver: Named Tuple providing the redis server parameters
+    :type redisserver: namedtuple
+    :param blob_folder: Folder where Blobs will be stored
+    :type blob_folder: String
+    :param url: URL at which the web service is served
+    :type url: String
+    :param hashedpassword: Hashed password or empty value
+    :type hashedpassword: String
+    :param workers: Number of threads creating web pages
+    :type workers: Integer
+    :param websocket_host: Listenning IP address of the NumberVector WebSocket server
+    :type websocket_host: String
+    :param websocket_port: Port of the NumberVector WebSocket server, or zero for no server
+    :type websocket_port: Integer
+    :param refresh_timeout: Maximum seconds a device refresh waits for the device properties
+    :type refresh_timeout: Float
+    :param redis_pool: Named Tuple created by indiredis.redis_pool, or None for a single connection
+    :type redis_pool: namedtuple
+    :param compress_workers: Number of processes compressing uploaded BLOBs
+    :type compress_workers: Integer
+    :param compress_level: gzip compression level of uploaded BLOBs, 1 fastest to 9 smallest
+    :type compress_level: Integer
+    :param blob_retention: Named Tuple created by indiredis.blob_retention, or None to keep all BLOBs
+    :type blob_retention: namedtuple
+    :param blob_layout: "flat", or "sharded" to move BLOBs into folders YYYY/MM/DD/devicename
+    :type blob_layout: String
+    :param blob_dedup: If True, BLOBs identical to one already held are replaced by hard links to it
+    :type blob_dedup: Boolean
+    :param slow_request: Requests taking longer than this many milliseconds are logged, zero for no log
+    :type slow_request: Float
+    :param slow_log: File to which slow requests are appended, or empty for stderr
+    :type slow_log: String
+    :param public_metrics: If True, the metrics are served without a login, even if a password is set
+    :type public_metrics: Boolean
+    :return: An ASGI callable application
+    :rtype: indiredis.webcode.asgi.ASGIApplication
+    """
+    # the event streams of the WSGI application are not used, as the ASGI application serves them
+    application = _make_application(redisserver, blob_folder, url, hashedpassword, 0,
+                                    websocket_host, websocket_port, refresh_timeout, redis_pool,
+                                    compress_workers, compress_level, blob_retention, blob_layout, blob_dedup,
+                                    slow_request, slow_log, public_metrics)
+    return ASGIApplication(application, application.proj_data, url, PROJECT, workers)
 
 
 # The function confighelper helps generate a config file which should look like:
@@ -201,6 +468,32 @@ def make_wsgi_app(redisserver, blob_folder='', url="/", hashedpassword=""):
 #  # web service host and port
 #  host = localhost
 #  port = 8000
+#  # number of web server threads, half of which may hold event streams
+#  threads = 8
+#  # optional port of a WebSocket server streaming number values,
+#  # this requires the websockets package
+#  websocket_port = 8001
+#  # maximum seconds a device refresh waits for the device properties
+#  refresh_timeout = 2
+#  # number of processes compressing uploaded BLOBs, and the gzip level, 1 fastest to 9 smallest
+#  compress_workers = 1
+#  compress_level = 9
+#  # optional limits of the blob folder, the oldest files beyond them are deleted,
+#  # except those matching the comma separated protected patterns
+#  blob_max_bytes = 10000000000
+#  blob_max_days = 30
+#  blob_max_count = 100000
+#  blob_protected = *.cfg, calibration*
+#  # flat, or sharded to move BLOBs into sub folders YYYY/MM/DD/devicename
+#  blob_layout = flat
+#  # set true to store BLOBs with identical contents once, as hard links
+#  blob_dedup = false
+#  # requests taking longer than this many milliseconds are logged, with their
+#  # redis commands, to the slow_log file, or to stderr if it is not given
+#  slow_request = 500
+#  slow_log = path/to/slow.log
+#  # set true to serve the metrics at /metrics without a login, even if a password is set
+#  public_metrics = false
 #
 #  # only one of the following [INDI], [MQTT] or [DRIVERS] should
 #  # be given. They are mutually exclusive.
@@ -237,6 +530,14 @@ def make_wsgi_app(redisserver, blob_folder='', url="/", hashedpassword=""):
 #  # redis server host and port
 #  rhost = localhost
 #  rport = 6379
+#  # optional unix socket of the redis server, used instead of rhost and rport
+#  # by the web service
+#  unix_socket = /run/redis/redis.sock
+#  # size of the web service connection pool, default the number of threads plus
+#  # the connections of the background threads started
+#  pool_size = 10
+#  # seconds to wait for a redis reply
+#  socket_timeout = 5
 #  # Prefix applied to redis keys
 #  prefix = indi_
 #  # Redis channel used to publish data to indiserver
@@ -583,6 +884,21 @@ def _read_config(configfile):
     configdict['hashedpassword'] = webparams.get('hashedpassword', '')
     configdict['host'] = webparams.get('host', 'localhost')
     configdict['port'] = webparams.getint('port', 8000)
+    configdict['threads'] = webparams.getint('threads', 8)
+    configdict['websocket_port'] = webparams.getint('websocket_port', 0)
+    configdict['refresh_timeout'] = webparams.getfloat('refresh_timeout', 2)
+    configdict['compress_workers'] = webparams.getint('compress_workers', 1)
+    configdict['compress_level'] = webparams.getint('compress_level', 9)
+    configdict['blob_max_bytes'] = webparams.getint('blob_max_bytes', 0)
+    configdict['blob_max_days'] = webparams.getfloat('blob_max_days', 0)
+    configdict['blob_max_count'] = webparams.getint('blob_max_count', 0)
+    protected = webparams.get('blob_protected', '')
+    configdict['blob_protected'] = [pattern.strip() for pattern in protected.split(',') if pattern.strip()]
+    configdict['blob_layout'] = webparams.get('blob_layout', 'flat')
+    configdict['blob_dedup'] = webparams.getboolean('blob_dedup', False)
+    configdict['slow_request'] = webparams.getfloat('slow_request', 0)
+    configdict['slow_log'] = webparams.get('slow_log', '')
+    configdict['public_metrics'] = webparams.getboolean('public_metrics', False)
     if 'INDI' in config:
         indiparams = config['INDI']
         configdict['ihost'] = indiparams.get('ihost', 'localhost')
@@ -616,9 +932,26 @@ def _read_config(configfile):
     configdict['prefix'] = redisparams.get('prefix', 'indi_')
     configdict['toindipub'] = redisparams.get('toindipub', 'to_indi')
     configdict['fromindipub'] = redisparams.get('fromindipub', 'from_indi')
+    configdict['unix_socket'] = redisparams.get('unix_socket', '')
+    # the pool has a connection for each thread, and for each background thread started
+    retention = blob_retention(max_bytes=configdict['blob_max_bytes'], max_age=configdict['blob_max_days'],
+                               max_count=configdict['blob_max_count'])
+    background = background_connections(configdict['blob_folder'], configdict['compress_workers'], retention,
+                                        configdict['blob_dedup'], configdict['websocket_port'])
+    configdict['pool_size'] = redisparams.getint('pool_size', configdict['threads'] + background)
+    configdict['socket_timeout'] = redisparams.getfloat('socket_timeout', 5)
     return configdict
 
 
+def _serve(application, host, port, threads):
+    """Blocking call, serves the application with the python waitress web server,
+       which is given to the application so its task queue is shown in the metrics"""
+    server = create_server(application, host=host, port=port, threads=threads)
+    application.set_server(server)
+    server.print_listen("Serving on http://{}:{}")
+    server.run()
+
+
 def runclient(configfile):
     """Blocking call, which given the path to a config reads the
     parameters and runs the web client
@@ -641,11 +974,28 @@ def runclient(configfile):
                               from_indi_channel=configdict['fromindipub'])
 
     # create a wsgi application
-    application = make_wsgi_app(redis_host, configdict['blob_folder'], url='/', hashedpassword=configdict['hashedpassword'])
+    application = make_wsgi_app(redis_host, configdict['blob_folder'], url='/', hashedpassword=configdict['hashedpassword'],
+                                event_streams=configdict['threads']//2,
+                                websocket_host=configdict['host'], websocket_port=configdict['websocket_port'],
+                                refresh_timeout=configdict['refresh_timeout'],
+                                redis_pool=redis_pool(max_connections=configdict['pool_size'],
+                                                      unix_socket_path=configdict['unix_socket'],
+                                                      socket_timeout=configdict['socket_timeout']),
+                                compress_workers=configdict['compress_workers'],
+                                compress_level=configdict['compress_level'],
+                                blob_retention=blob_retention(max_bytes=configdict['blob_max_bytes'],
+                                                              max_age=configdict['blob_max_days']*86400,
+                                                              max_count=configdict['blob_max_count'],
+                                                              protected=configdict['blob_protected']),
+                                blob_layout=configdict['blob_layout'],
+                                blob_dedup=configdict['blob_dedup'],
+                                slow_request=configdict['slow_request'],
+                                slow_log=configdict['slow_log'],
+                                public_metrics=configdict['public_metrics'])
 
     if ("ihost" in configdict) or ("mhost" in configdict) or ("drivers" in configdict):
         # serve the application with the python waitress web server in another thread
-        webapp = threading.Thread(target=serve, args=(application,), kwargs={'host':configdict['host'], 'port':configdict['port']})
+        webapp = threading.Thread(target=_serve, args=(application, configdict['host'], configdict['port'], configdict['threads']))
         webapp.start()
 
         if "ihost" in configdict:
@@ -665,4 +1015,34 @@ def runclient(configfile):
             driverstoredis(configdict['drivers'], redis_host, blob_folder=configdict['blob_folder'])
     else:
         # blocking call which serves the application with the python waitress web server
-        serve(application, host=configdict['host'], port=configdict['port'])
+        _serve(application, configdict['host'], configdict['port'], configdict['threads'])
+
+
+def shardblobs(configfile):
+    """Given the path to a config file, moves the BLOBs at the top of the blob folder into
+    the sharded layout of folders YYYY/MM/DD/devicename, updating the index of BLOBs held in
+    redis. This should be run with the web client stopped, before setting blob_layout = sharded
+
+    :param configfile: path to the config file
+    :type configfile: String
+    :return: The number of files moved
+    :rtype: Integer
+    """
+    configfile = os.path.abspath(os.path.expanduser(configfile))
+    if not os.path.isfile(configfile):
+        print("The configuration file has not been found")
+        sys.exit(1)
+    configdict = _read_config(configfile)
+    if not configdict['blob_folder']:
+        print("The configuration file does not give a blob folder")
+        sys.exit(1)
+    redis_host = redis_server(host=configdict["rhost"], port=configdict["rport"],
+                              db=0, password='',
+                              keyprefix=configdict['prefix'],
+                              to_indi_channel=configdict['toindipub'],
+                              from_indi_channel=configdict['fromindipub'])
+    rconn = tools.open_redis(redis_host)
+    blob_folder = pathlib.Path(configdict['blob_folder']).expanduser().resolve()
+    moved = migrate_blob_folder(rconn, redis_host, blob_folder)
+    print(f"{moved} files have been moved")
+    return moved
@@ -20,11 +20,10 @@ import threading, argparse
 from indi_mr import inditoredis, indi_server, redis_server
 
 # any wsgi web server can serve the wsgi application produced by make_wsgi_app,
-# in this example the web server 'waitress' is used
+# in this example the web server 'waitress' is used, by _serve, which also
+# gives the server to the application so its task queue is shown in the metrics
 
-from waitress import serve
-
-from . import make_wsgi_app
+from . import make_wsgi_app, redis_pool, background_connections, _serve
 
 version = "0.7.2"
 
@@ -37,6 +36,8 @@ if __name__ == "__main__":
     parser.add_argument("blobdirectorypath", help="Path of the directory where BLOB's will be set")
     parser.add_argument("-p", "--port", type=int, default=8000, help="Port of the web service (default 8000).")
     parser.add_argument("--host", default="localhost", help="Listenning IP address of the web service (default localhost).")
+    parser.add_argument("--threads", type=int, default=8, help="Number of web service threads (default 8).")
+    parser.add_argument("--wsport", type=int, default=0, help="Port of a WebSocket server streaming number values, requires the websockets package (default none).")
     parser.add_argument("--clientonly", action="store_true", help="Do not connect to indiserver port.")
     parser.add_argument("--iport", type=int, default=7624, help="Port of the indiserver (default 7624).")
     parser.add_argument("--ihost", default="localhost", help="Hostname of the indiserver (default localhost).")
@@ -56,14 +57,18 @@ if __name__ == "__main__":
                               to_indi_channel=args.toindipub, from_indi_channel=args.fromindipub)
 
     # create a wsgi application
-    application = make_wsgi_app(redis_host, args.blobdirectorypath, url='/')
+    # half the threads may hold event streams
+    application = make_wsgi_app(redis_host, args.blobdirectorypath, url='/', event_streams=args.threads//2,
+                                websocket_host=args.host, websocket_port=args.wsport,
+                                redis_pool=redis_pool(max_connections=args.threads + background_connections(
+                                                          args.blobdirectorypath, websocket_port=args.wsport)))
 
     if args.clientonly:
         # blocking call which serves the application with the python waitress web server
-        serve(application, host=args.host, port=args.port)
+        _serve(application, args.host, args.port, args.threads)
     else:
         # serve the application with the python waitress web server in another thread
-        webapp = threading.Thread(target=serve, args=(application,), kwargs={'host':args.host, 'port':args.port})
+        webapp = threading.Thread(target=_serve, args=(application, args.host, args.port, args.threads))
         webapp.start()
         # and start the blocking function inditoredis
         inditoredis(indi_host, redis_host, log_lengths={}, blob_folder=args.blobdirectorypath)
@@ -0,0 +1,75 @@
+
+/*
+Listens to the indiredis server sent events stream, and when a change is
+reported for the device shown, calls the page json update immediately, rather
+than waiting for the interval poll.
+
+The page holds a hidden div with id indiredis_events, and attributes
+data-home : url of the home page, the events stream is at "events" relative to this
+data-target : url of the json update responder
+data-interval : milliseconds between polls if the stream is unavailable
+*/
+
+$(document).ready(function(){
+
+    var params = $("#indiredis_events");
+    if (!params.length) {
+        return;
+        }
+    var target = params.attr("data-target");
+    var interval = parseInt(params.attr("data-interval"));
+
+    // the device shown on a properties page, empty on the devices page
+    var device = $.trim($("#devicename").children().first().text());
+
+    var pending = false;
+
+    function update() {
+        // calls the json update, coalescing events received in quick succession
+        if (pending) {
+            return;
+            }
+        pending = true;
+        setTimeout(function(){
+            $.getJSON(target, {ident:SKIPOLE.identdata})
+                .done(function(result){
+                    SKIPOLE.setfields(result);
+                    })
+                .always(function(){
+                    pending = false;
+                    });
+            }, 250);
+        }
+
+    function poll() {
+        // the stream is unavailable, so poll instead
+        setInterval(update, interval);
+        }
+
+    if (!window.EventSource) {
+        poll();
+        return;
+        }
+
+    var eventsurl = new URL("events", new URL(params.attr("data-home"), window.location.href));
+    if (device) {
+        eventsurl.searchParams.set("device", device);
+        }
+
+    var source = new EventSource(eventsurl.href);
+
+    source.addEventListener("change", function(e){
+        var change = JSON.parse(e.data);
+        if ((!device) || (!change.device) || (change.device == device)) {
+            update();
+            }
+        });
+
+    source.onerror = function(){
+        // the browser reconnects unless the server has refused the stream
+        if (source.readyState == EventSource.CLOSED) {
+            poll();
+            }
+        };
+
+    });
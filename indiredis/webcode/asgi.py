@@ -0,0 +1,306 @@
+
+"""An ASGI application serving the indiredis web pages.
+
+The pages are created by the same skipole WSGI application as make_wsgi_app, which is
+called in a pool of worker threads, so the responder functions are unchanged. The Server-Sent
+Events stream of device changes is served natively on the asyncio loop, so each browser
+holding an open stream costs a coroutine rather than a thread, and login cookies of the
+stream are checked with redis.asyncio, connecting as described by the redis pool.
+
+Request bodies are spooled to a temporary file, so large uploads are not held in memory.
+
+This requires redis version 4.2 or later, and an ASGI server such as uvicorn.
+"""
+
+import asyncio, sys, tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from http.cookies import SimpleCookie
+
+from time import monotonic, time
+
+from urllib.parse import parse_qs
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from .events import KEEPALIVE, MAXAGE, _event
+
+
+# bytes of a request body held in memory, a larger body is written to a temporary file
+SPOOL = 1024 * 1024
+
+
+class ASGIApplication():
+    """Calls the WSGI application in worker threads, other than the events stream at
+       url + 'events' which is served on the asyncio loop"""
+
+    def __init__(self, application, proj_data, url, project, workers):
+        if aioredis is None:
+            raise ImportError("redis version 4.2 or later is required for the ASGI application: python3 -m pip install -U redis")
+        self.application = application
+        self.proj_data = proj_data
+        self.propertycache = proj_data["propertycache"]
+        self.eventspath = url.rstrip("/") + "/events"
+        # the name of the login cookie
+        self.project = project
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="indiredis_asgi")
+        # created in the event loop on first use
+        self.aconn = None
+        self.loop = None
+        # set, and replaced, on each change recorded by the property cache
+        self._changed = None
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if self.loop is None:
+                self._start()
+            if scope['path'] == self.eventspath:
+                await self._events(scope, receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+
+
+    def _start(self):
+        "Called within the event loop to listen for changes recorded by the property cache"
+        self.loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.propertycache.add_listener(self._listener)
+
+
+    def _listener(self, event):
+        "Called in the cache subscriber thread, wakes the event streams"
+        self.loop.call_soon_threadsafe(self._wakeup)
+
+
+    def _wakeup(self):
+        changed = self._changed
+        self._changed = asyncio.Event()
+        changed.set()
+
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.propertycache.remove_listener(self._listener)
+                if self.aconn is not None:
+                    await self.aconn.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+    async def _logged_in(self, scope):
+        "Checks the cookie set by the skipole application at login"
+        if not self.proj_data["hashedpassword"]:
+            return True
+        cookieheader = ""
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookieheader = value.decode('latin-1')
+                break
+        cookies = SimpleCookie(cookieheader)
+        if self.project not in cookies:
+            return False
+        receivedcookie = cookies[self.project].value
+        sessions = self.proj_data.get("sessions")
+        if (sessions is not None) and sessions.cached(receivedcookie):
+            return True
+        if self.aconn is None:
+            self.aconn = _open_async_redis(self.proj_data["redisserver"], self.proj_data.get("redis_pool"))
+        rediskey = self.proj_data["rediskey"]
+        # if this cookie has a score of None, it does not exist
+        if not await self.aconn.zscore(rediskey, receivedcookie):
+            if sessions is not None:
+                sessions.discard([receivedcookie])
+            return False
+        if sessions is None:
+            # cookie exist, update its score - which is the unix timestamp
+            await self.aconn.zadd(rediskey, {receivedcookie:time()}, xx=True)
+            return True
+        # the session cache writes the last-seen times in batches
+        sessions.accept(receivedcookie)
+        if sessions.flush_due():
+            await asyncio.get_running_loop().run_in_executor(self.executor, sessions.flush)
+        return True
+
+
+    async def _events(self, scope, receive, send):
+        "Serves the event stream, as webcode.events.EventStream but without holding a thread"
+        if not await self._logged_in(scope):
+            await _send_text(send, 403, b"Not logged in")
+            return
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        device = query.get('device', [None])[0]
+        lastid = None
+        for name, value in scope['headers']:
+            if name == b'last-event-id':
+                try:
+                    lastid = int(value)
+                except ValueError:
+                    pass
+        await send({'type': 'http.response.start',
+                    'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        disconnected = asyncio.ensure_future(_disconnected(receive))
+        try:
+            await _send_body(send, b"retry: 5000\n\n")
+            sequence = self.propertycache.sequence
+            if (lastid is not None) and (lastid != sequence):
+                if lastid > sequence:
+                    # the id is from before a restart, so changes may have been missed
+                    await _send_body(send, _event(sequence, "reload", None, None))
+                else:
+                    # send changes made while the client was reconnecting
+                    sequence = lastid
+            end = monotonic() + MAXAGE
+            while (monotonic() < end) and (not disconnected.done()):
+                changed = self._changed
+                # with a timeout of zero, this does not block
+                events = self.propertycache.wait_for_events(sequence, 0)
+                if events is None:
+                    # changes have been lost, the page must refresh
+                    sequence = self.propertycache.sequence
+                    await _send_body(send, _event(sequence, "reload", None, None))
+                    continue
+                if not events:
+                    done, pending = await asyncio.wait([asyncio.ensure_future(changed.wait()), disconnected],
+                                                       timeout=KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+                    for task in pending:
+                        if task is not disconnected:
+                            task.cancel()
+                    if not done:
+                        await _send_body(send, b": keepalive\n\n")
+                    continue
+                for sequence, tag, devicename, propertyname in events:
+                    if device and devicename and (devicename != device):
+                        continue
+                    await _send_body(send, _event(sequence, tag, devicename, propertyname))
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+
+
+    async def _wsgi(self, scope, receive, send):
+        "Calls the WSGI application in a worker thread"
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await self._call_wsgi(scope, body, send)
+        finally:
+            body.close()
+
+
+    async def _call_wsgi(self, scope, body, send):
+        "Calls the WSGI application in a worker thread, with the request body in the file body"
+        environ = _environ(scope, body)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, self.application, environ, start_response)
+        try:
+            iterator = iter(result)
+            # a served file may be large, so chunks are read one at a time in the worker threads
+            chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not None:
+                if chunk:
+                    await _send_body(send, chunk)
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+
+def _open_async_redis(redisserver, pool):
+    "Returns a redis.asyncio connection to the server, by the unix socket and timeout of pool if given"
+    kwargs = {'db':redisserver.db,
+              'password':redisserver.password,
+              'socket_timeout':5}
+    if pool is None:
+        return aioredis.Redis(host=redisserver.host, port=redisserver.port, **kwargs)
+    kwargs['socket_timeout'] = pool.socket_timeout
+    if pool.unix_socket_path:
+        return aioredis.Redis(unix_socket_path=pool.unix_socket_path, **kwargs)
+    return aioredis.Redis(host=redisserver.host, port=redisserver.port, **kwargs)
+
+
+def _environ(scope, body):
+    "Returns a WSGI environ dictionary from an ASGI http scope"
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+               'REMOTE_ADDR': client[0],
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': body,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+    return environ
+
+
+async def _send_body(send, data):
+    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+
+async def _send_text(send, status, text):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': text, 'more_body': False})
+
+
+async def _disconnected(receive):
+    "Returns when the client disconnects"
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
@@ -1,11 +1,97 @@
 
-import hashlib, uuid, time
+import hashlib, uuid, time, threading
 
 from skipole import FailPage
 
 # this is the maximum number of cookies generated, ie of simultaneous connections
 N = 10
 
+# seconds for which a cookie found in redis is accepted without checking redis again
+TTL = 10
+
+# seconds between writing the last-seen times of cookies to redis
+FLUSH = 30
+
+
+class SessionCache():
+    """Records cookies recently found in redis, so each request need not read redis, and
+       the last-seen times of cookies, which are written to redis in batches.
+
+       A cookie removed from redis by another process may be accepted for up to TTL seconds."""
+
+    def __init__(self, rconn, rediskey, ttl=TTL, flush=FLUSH):
+        self.rconn = rconn
+        self.rediskey = rediskey
+        self.ttl = ttl
+        self.flush_interval = flush
+        self._lock = threading.Lock()
+        # dictionary of cookie:monotonic time until which it is accepted
+        self._valid = {}
+        # dictionary of cookie:unix time last seen, not yet written to redis
+        self._lastseen = {}
+        self._next_flush = time.monotonic() + flush
+
+
+    def is_valid(self, cookie):
+        "Returns True if the cookie exists, and records it as seen"
+        if not self.cached(cookie):
+            # check the score of this cookie in the sorted set, if None, it does not exist
+            if not self.rconn.zscore(self.rediskey, cookie):
+                self.discard([cookie])
+                return False
+            self.accept(cookie)
+        if self.flush_due():
+            self.flush()
+        return True
+
+
+    def cached(self, cookie):
+        """Returns True, and records the cookie as seen, if it was found in redis within the
+           last ttl seconds, otherwise the caller must check redis"""
+        now = time.monotonic()
+        with self._lock:
+            expires = self._valid.get(cookie)
+            if (expires is None) or (now >= expires):
+                return False
+            self._lastseen[cookie] = time.time()
+        return True
+
+
+    def accept(self, cookie):
+        "Records a cookie, which the caller has found in redis, as valid and seen"
+        with self._lock:
+            self._valid[cookie] = time.monotonic() + self.ttl
+            self._lastseen[cookie] = time.time()
+
+
+    def flush_due(self):
+        "Returns True if the last-seen times are due to be written to redis"
+        with self._lock:
+            return time.monotonic() >= self._next_flush
+
+
+    def flush(self):
+        "Writes the last-seen times to redis, as scores of cookies which still exist"
+        now = time.monotonic()
+        with self._lock:
+            pending = self._lastseen
+            self._lastseen = {}
+            self._next_flush = now + self.flush_interval
+            # forget expired cookies
+            for cookie in [c for c, expires in self._valid.items() if expires <= now]:
+                del self._valid[cookie]
+        if pending:
+            # xx, so cookies removed since they were seen are not added back
+            self.rconn.zadd(self.rediskey, pending, xx=True)
+
+
+    def discard(self, cookies):
+        "Forgets the given cookies, which have been removed from redis"
+        with self._lock:
+            for cookie in cookies:
+                self._valid.pop(cookie, None)
+                self._lastseen.pop(cookie, None)
+
 
 def login(skicall):
     "This function is called to checklogin from the login page"
@@ -27,12 +113,19 @@ def logout(skicall):
     rediskey = skicall.proj_data["rediskey"]
     rconn = skicall.proj_data["rconn"]
     rconn.zrem(rediskey, receivedcookie)
+    sessions = skicall.proj_data.get("sessions")
+    if sessions is not None:
+        sessions.discard([receivedcookie])
     
     
 def _create_cookie(skicall):
     "Generates a random cookie, store it in redis, and return the cookie"
     rediskey = skicall.proj_data["rediskey"]
     rconn = skicall.proj_data["rconn"]
+    sessions = skicall.proj_data.get("sessions")
+    if sessions is not None:
+        # write last-seen times, so the oldest cookies are those least recently used
+        sessions.flush()
     # generate a cookie string
     cookiestring = uuid.uuid4().hex
     rconn.zadd(rediskey, {cookiestring:time.time()}, nx=True)
@@ -40,5 +133,8 @@ def _create_cookie(skicall):
     number = rconn.zcard(rediskey)
     if number > N:
         # delete the lowest score (oldest cookies)
+        oldest = rconn.zrange(rediskey, 0, -1*N)
         rconn.zremrangebyrank(rediskey, 0, -1*N)
+        if sessions is not None:
+            sessions.discard(cookie.decode('utf-8') if isinstance(cookie, bytes) else cookie for cookie in oldest)
     return cookiestring
@@ -0,0 +1,342 @@
+
+"""An index of BLOB files, so the blobs page can list them a page at a time.
+
+Redis keys, prefixed by redisserver.keyprefix, are
+
+blobindex                          - sorted set of file names, scored by the unix time indexed
+blobindex:devicename               - sorted set of the file names of the device
+blobindex:propertyname:devicename  - sorted set of the file names of the property
+blobinfo                           - hash of file name:"devicename\\npropertyname"
+blobsize                           - hash of file name:size in bytes
+blobpath                           - with the sharded layout, hash of file name:relative path
+blobinode                          - hash of file name:"device:inode" of the file on disc
+blobinodes                         - hash of "device:inode":number of file names linking to it
+blobbytes                          - total size of the files in the index, counting files
+                                     hard linked to the same contents once
+
+Files are added as setBLOBVector messages are received by the property cache, files
+already in the blob folder when the web service starts, including any received while it
+was stopped, are added by rebuild_index, but with no device or property, as these are
+not known. rebuild_index also removes files which have been deleted outside the web service.
+
+With the sharded layout of webcode.layout, the file names above are paths relative to
+the blob folder, such as 2024/01/31/CCD_Simulator/image.fits
+"""
+
+import threading, pathlib, os, queue
+
+from time import time
+
+from .layout import SHARDED, shard_blob
+
+
+# KEYS are blobsize, blobbytes, blobinode and blobinodes
+
+# records the size ARGV[2] and inode ARGV[3] of file ARGV[1], adding the size to the total
+# if the file is new, and is the first file name of the inode
+_ADDSIZE_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return
+end
+if ARGV[3] == '' then
+    redis.call('INCRBY', KEYS[2], ARGV[2])
+    return
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+if redis.call('HINCRBY', KEYS[4], ARGV[3], 1) == 1 then
+    redis.call('INCRBY', KEYS[2], ARGV[2])
+end
+"""
+
+# decrements the file names of the inode of file ARGV[1], returns the size of the file
+# if it was the last file name of the inode, otherwise 0, must be called before the
+# size and inode of the file are removed
+_RELEASE = """
+local function release(keys, name, size)
+    local inode = redis.call('HGET', keys[3], name)
+    if inode then
+        if redis.call('HINCRBY', keys[4], inode, -1) > 0 then
+            return 0
+        end
+        redis.call('HDEL', keys[4], inode)
+    end
+    redis.call('DECRBY', keys[2], size)
+    return tonumber(size)
+end
+"""
+
+# removes the size of file ARGV[1], returning the bytes subtracted from the total
+_REMOVESIZE_SCRIPT = _RELEASE + """
+local size = redis.call('HGET', KEYS[1], ARGV[1])
+if not size then
+    return 0
+end
+local freed = release(KEYS, ARGV[1], size)
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return freed
+"""
+
+# sets the inode of file ARGV[1] to ARGV[2], as it has been replaced by a hard link
+_RELINK_SCRIPT = _RELEASE + """
+local size = redis.call('HGET', KEYS[1], ARGV[1])
+if (not size) or (redis.call('HGET', KEYS[3], ARGV[1]) == ARGV[2]) then
+    return
+end
+release(KEYS, ARGV[1], size)
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+if redis.call('HINCRBY', KEYS[4], ARGV[2], 1) == 1 then
+    redis.call('INCRBY', KEYS[2], size)
+end
+"""
+
+# removes the digest recorded by webcode.dedup of a deleted file, if it is the file
+# recorded for those contents, KEYS are blobdigest and blobhashed
+_FORGET_SCRIPT = """
+local digest = redis.call('HGET', KEYS[2], ARGV[1])
+if digest then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    if redis.call('HGET', KEYS[1], digest) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], digest)
+    end
+end
+"""
+
+
+def _key(redisserver, *parts):
+    "Returns a redis key, as the indi_mr keys, of the prefix and colon separated parts"
+    return redisserver.keyprefix + ":".join(parts)
+
+
+def _sizekeys(redisserver):
+    "Returns the keys of the size scripts"
+    return [_key(redisserver, 'blobsize'), _key(redisserver, 'blobbytes'),
+            _key(redisserver, 'blobinode'), _key(redisserver, 'blobinodes')]
+
+
+def inode(stat):
+    "Returns the string identifying the contents on disc of a file, given its os.stat result"
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+
+def _addsize(rconn, redisserver, pipe, filename, size, fileinode=''):
+    "Adds the command recording the file size and inode to the pipeline"
+    script = rconn.register_script(_ADDSIZE_SCRIPT)
+    script(keys=_sizekeys(redisserver), args=[filename, size, fileinode], client=pipe)
+
+
+def index_blob(rconn, redisserver, filename, devicename='', propertyname='', timestamp=None, size=0, fileinode=''):
+    """Adds the file, of size bytes, to the index, if it is not already present. fileinode is
+       the string returned by inode, so files hard linked to the same contents are counted once"""
+    if timestamp is None:
+        timestamp = time()
+    pipe = rconn.pipeline()
+    # nx, so a file indexed again keeps its original time
+    pipe.zadd(_key(redisserver, 'blobindex'), {filename:timestamp}, nx=True)
+    if devicename:
+        pipe.zadd(_key(redisserver, 'blobindex', devicename), {filename:timestamp}, nx=True)
+        if propertyname:
+            pipe.zadd(_key(redisserver, 'blobindex', propertyname, devicename), {filename:timestamp}, nx=True)
+    pipe.hsetnx(_key(redisserver, 'blobinfo'), filename, devicename + "\n" + propertyname)
+    _addsize(rconn, redisserver, pipe, filename, size, fileinode)
+    if "/" in filename:
+        # a sharded path, recorded so links to the file can be made from its name
+        pipe.hset(_key(redisserver, 'blobpath'), filename.rsplit("/", 1)[1], filename)
+    pipe.execute()
+
+
+def remove_blob(rconn, redisserver, filename):
+    """Removes the file from the index, returns the bytes subtracted from the total, which is
+       zero if other file names are hard linked to its contents"""
+    info = rconn.hget(_key(redisserver, 'blobinfo'), filename)
+    pipe = rconn.pipeline()
+    pipe.zrem(_key(redisserver, 'blobindex'), filename)
+    if info:
+        devicename, propertyname = info.decode('utf-8').split("\n")
+        if devicename:
+            pipe.zrem(_key(redisserver, 'blobindex', devicename), filename)
+            if propertyname:
+                pipe.zrem(_key(redisserver, 'blobindex', propertyname, devicename), filename)
+    pipe.hdel(_key(redisserver, 'blobinfo'), filename)
+    script = rconn.register_script(_REMOVESIZE_SCRIPT)
+    position = len(pipe)
+    script(keys=_sizekeys(redisserver), args=[filename], client=pipe)
+    if "/" in filename:
+        pipe.hdel(_key(redisserver, 'blobpath'), filename.rsplit("/", 1)[1])
+    return int(pipe.execute()[position] or 0)
+
+
+def forget_blob(rconn, redisserver, relpath):
+    "Removes the digest record of a deleted file"
+    script = rconn.register_script(_FORGET_SCRIPT)
+    script(keys=[_key(redisserver, 'blobdigest'), _key(redisserver, 'blobhashed')], args=[relpath])
+
+
+def relink_blob(rconn, redisserver, filename, fileinode):
+    "Records that the file has been replaced by a hard link to the contents of fileinode"
+    script = rconn.register_script(_RELINK_SCRIPT)
+    script(keys=_sizekeys(redisserver), args=[filename, fileinode])
+
+
+def _walk(blob_folder):
+    "Yields the path, relative to the blob folder, and the stat of every file in it and its shard folders"
+    for dirpath, dirnames, filenames in os.walk(blob_folder):
+        # hidden folders, such as .previews, are not BLOBs
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        folder = pathlib.Path(dirpath)
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            path = folder / name
+            yield path.relative_to(blob_folder).as_posix(), path.stat()
+
+
+def rebuild_index(rconn, redisserver, blob_folder):
+    """Adds every file in the blob folder not already in the index, scored by its
+       modification time, and removes from the index files which no longer exist.
+       Files already indexed are unchanged, so this is run on every start.
+       Returns the number of files removed"""
+    pipe = rconn.pipeline()
+    count = 0
+    seen = set()
+    for relpath, stat in _walk(blob_folder):
+        seen.add(relpath)
+        pipe.zadd(_key(redisserver, 'blobindex'), {relpath:stat.st_mtime}, nx=True)
+        pipe.hsetnx(_key(redisserver, 'blobinfo'), relpath, "\n")
+        _addsize(rconn, redisserver, pipe, relpath, stat.st_size, inode(stat))
+        if "/" in relpath:
+            pipe.hset(_key(redisserver, 'blobpath'), relpath.rsplit("/", 1)[1], relpath)
+        count += 1
+        if count % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    # files deleted outside the web service, or while it was stopped
+    removed = 0
+    for rxname, score in rconn.zscan_iter(_key(redisserver, 'blobindex')):
+        relpath = rxname.decode('utf-8') if isinstance(rxname, bytes) else rxname
+        if relpath in seen:
+            continue
+        if (blob_folder / relpath).is_file():
+            # received since the folder was walked
+            continue
+        remove_blob(rconn, redisserver, relpath)
+        forget_blob(rconn, redisserver, relpath)
+        removed += 1
+    return removed
+
+
+def migrate_blob_folder(rconn, redisserver, blob_folder):
+    """Moves the files at the top of the blob folder, a pathlib.Path, into the sharded layout,
+       updating the blob index. Files with no device recorded in the index go to a folder
+       named unknown. Returns the number of files moved"""
+    moved = 0
+    for path in list(blob_folder.iterdir()):
+        if path.name.startswith('.') or (not path.is_file()):
+            continue
+        info = rconn.hget(_key(redisserver, 'blobinfo'), path.name)
+        devicename, propertyname = info.decode('utf-8').split("\n") if info else ('', '')
+        stat = path.stat()
+        timestamp = rconn.zscore(_key(redisserver, 'blobindex'), path.name) or stat.st_mtime
+        remove_blob(rconn, redisserver, path.name)
+        relpath = shard_blob(blob_folder, path.name, devicename, timestamp)
+        index_blob(rconn, redisserver, relpath, devicename, propertyname, timestamp=timestamp,
+                   size=stat.st_size, fileinode=inode(stat))
+        moved += 1
+    return moved
+
+
+def list_blobs(rconn, redisserver, devicename='', propertyname='', start=None, end=None, page=0, pagesize=50):
+    """Returns a tuple (filenames, total) where filenames is the list of files, most
+       recent first, on the given page, and total is the number of files matching the
+       filter. start and end are optional unix times limiting the files listed.
+       The cost depends on the page size, not the number of files"""
+    if devicename and propertyname:
+        key = _key(redisserver, 'blobindex', propertyname, devicename)
+    elif devicename:
+        key = _key(redisserver, 'blobindex', devicename)
+    else:
+        key = _key(redisserver, 'blobindex')
+    minscore = '-inf' if start is None else start
+    maxscore = '+inf' if end is None else end
+    pipe = rconn.pipeline()
+    pipe.zrevrangebyscore(key, maxscore, minscore, start=page*pagesize, num=pagesize)
+    pipe.zcount(key, minscore, maxscore)
+    rxnames, total = pipe.execute()
+    filenames = [name.decode('utf-8') if isinstance(name, bytes) else name for name in rxnames]
+    return filenames, total
+
+
+def blob_usage(rconn, redisserver):
+    "Returns a dictionary with keys 'files' and 'bytes', the number and total size of indexed files"
+    pipe = rconn.pipeline()
+    pipe.zcard(_key(redisserver, 'blobindex'))
+    pipe.get(_key(redisserver, 'blobbytes'))
+    files, rxbytes = pipe.execute()
+    return {'files':files, 'bytes':int(rxbytes or 0)}
+
+
+class BlobIndexer():
+    """A listener of the property cache, which passes the files of each setBLOBVector
+       received to a thread which indexes them, and adds any existing files to the index
+       on start. With the sharded layout, each file is first moved to its shard folder.
+       If a BlobDeduplicator is given, each file indexed is then passed to it"""
+
+    def __init__(self, propertycache, rconn, redisserver, blob_folder, layout="flat", deduplicator=None):
+        self.propertycache = propertycache
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.blob_folder = blob_folder
+        self.layout = layout
+        self.deduplicator = deduplicator
+        # not bounded, as a file which is not indexed is never deleted by the janitor
+        self._queue = queue.Queue()
+
+    def start(self):
+        "Adds this listener to the property cache, starts the indexing thread, and indexes existing files in a thread"
+        self.propertycache.add_listener(self)
+        thread = threading.Thread(target=self._run, name="indiredis_blobindex", daemon=True)
+        thread.start()
+        if self.blob_folder:
+            thread = threading.Thread(target=rebuild_index, args=(self.rconn, self.redisserver, self.blob_folder),
+                                      name="indiredis_blobrebuild", daemon=True)
+            thread.start()
+
+    def __call__(self, event):
+        # called in the cache subscriber thread, so only reads memory and queues the files
+        sequence, tag, devicename, propertyname = event
+        if tag != 'setBLOBVector':
+            return
+        for eld in self.propertycache.read_elements(devicename, propertyname):
+            filepath = eld.get('filepath')
+            if filepath:
+                self._queue.put((devicename, propertyname, filepath))
+
+    def _run(self):
+        while True:
+            devicename, propertyname, filepath = self._queue.get()
+            try:
+                relpath = self._index(devicename, propertyname, filepath)
+            except Exception:
+                # redis unavailable, or the file could not be moved, it is added on the next start
+                continue
+            if (relpath is not None) and (self.deduplicator is not None):
+                self.deduplicator.add(relpath)
+
+    def _index(self, devicename, propertyname, filepath):
+        "Indexes the file, returning its path relative to the blob folder, or None if it no longer exists"
+        path = pathlib.Path(filepath)
+        try:
+            stat = path.stat()
+        except OSError:
+            # already removed, or moved to its shard folder
+            return
+        # moving the file to its shard folder keeps its inode
+        if self.layout == SHARDED:
+            timestamp = time()
+            relpath = shard_blob(self.blob_folder, path.name, devicename, timestamp)
+            index_blob(self.rconn, self.redisserver, relpath, devicename, propertyname, timestamp=timestamp,
+                       size=stat.st_size, fileinode=inode(stat))
+            return relpath
+        index_blob(self.rconn, self.redisserver, path.name, devicename, propertyname,
+                   size=stat.st_size, fileinode=inode(stat))
+        return path.name
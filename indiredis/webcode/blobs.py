@@ -3,6 +3,16 @@ from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from os.path import isfile
 
+from datetime import datetime, timedelta
+
+from urllib.parse import parse_qs, urlencode
+
+from .blobindex import list_blobs, blob_usage
+
+
+# number of files listed on each page
+PAGESIZE = 50
+
 
 def _safekey(key):
     """Provides a base64 encoded key from a given key"""
@@ -18,38 +28,82 @@ def _fromsafekey(safekey):
     return urlsafe_b64decode(b64binarydata).decode('utf-8') # b64 decode, and convert to string
 
 
+def _query(skicall):
+    "Returns a dictionary of the filter and page parameters of the query string"
+    query = parse_qs(skicall.environ.get('QUERY_STRING', ''))
+    params = {name:query[name][0].strip() for name in ('device', 'property', 'from', 'to', 'page', 'ident') if name in query}
+    return {name:value for name, value in params.items() if value}
+
+
+def _timestamp(datestring, days=0):
+    "Returns the unix time of a YYYY-MM-DD date plus days, or None if the date is invalid"
+    try:
+        day = datetime.strptime(datestring, "%Y-%m-%d") + timedelta(days=days)
+    except ValueError:
+        return
+    return day.timestamp()
+
+
 def setup(skicall):
-    "Fills in the blobs management page"
+    """Fills in the blobs management page, listing a page of files from the blob index,
+       filtered by the query string parameters device, property, from and to, the latter
+       two being dates YYYY-MM-DD, and page, the page number starting at zero"""
 
     if not skicall.ident_data:
         # there is no device properties information
         skicall.page_data['backtoproperties', 'show'] = False
 
+    skicall.page_data['pagelinks', 'show'] = False
     blob_folder = skicall.proj_data["blob_folder"]
     if not blob_folder:
         skicall.page_data['nothingfound', 'show'] = True
         skicall.page_data['bloblinks', 'show'] = False
+        skicall.page_data['pageinfo', 'show'] = False
         return
-    blobfiles = [f.name for f in blob_folder.iterdir() if f.is_file()]
+
+    params = _query(skicall)
+    start = _timestamp(params['from']) if 'from' in params else None
+    # the to date is inclusive, so the range ends at the start of the next day
+    end = _timestamp(params['to'], days=1) if 'to' in params else None
+    try:
+        page = max(int(params.get('page', 0)), 0)
+    except ValueError:
+        page = 0
+    blobfiles, total = list_blobs(skicall.proj_data["rconn"], skicall.proj_data["redisserver"],
+                                  devicename=params.get('device', ''), propertyname=params.get('property', ''),
+                                  start=start, end=end, page=page, pagesize=PAGESIZE)
+
     if not blobfiles:
         skicall.page_data['nothingfound', 'show'] = True
         skicall.page_data['bloblinks', 'show'] = False
+        skicall.page_data['pageinfo', 'show'] = False
         return
     skicall.page_data['nothingfound', 'show'] = False
     skicall.page_data['bloblinks', 'show'] = True
+    first = page*PAGESIZE + 1
+    usage = blob_usage(skicall.proj_data["rconn"], skicall.proj_data["redisserver"])
+    skicall.page_data['pageinfo', 'para_text'] = (f"Files {first} to {first + len(blobfiles) - 1} of {total}, most recent first. "
+                                                  f"The folder holds {usage['files']} files, {usage['bytes']/1e6:.1f} MB.")
 
     # The widget has links formed from a list of lists
     # 0 : The url, label or ident of the target page of the link
     # 1 : The displayed filename of the link
     # 2 : If True, download attribute is set in the link    
 
-    blobfiles.sort(reverse=True)
     bloblinks = []
     for bf in blobfiles:
         # create a link to blobs/blobfile
         bloblinks.append([ "blobs/" + bf, bf, True])
     skicall.page_data['bloblinks', 'file_links'] = bloblinks
 
-
-
-
+    # links to newer and older pages, retaining the filter
+    pagelinks = []
+    if page:
+        params['page'] = str(page-1)
+        pagelinks.append(["blobfolder?" + urlencode(params), "Newer files", False])
+    if first + len(blobfiles) - 1 < total:
+        params['page'] = str(page+1)
+        pagelinks.append(["blobfolder?" + urlencode(params), "Older files", False])
+    if pagelinks:
+        skicall.page_data['pagelinks', 'show'] = True
+        skicall.page_data['pagelinks', 'file_links'] = pagelinks
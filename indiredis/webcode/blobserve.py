@@ -0,0 +1,182 @@
+
+"""A WSGI application serving files from the blob folder.
+
+Supports byte ranges, so an interrupted download of a large file can be resumed, and
+conditional requests with ETag and Last-Modified headers, which receive 304 Not Modified
+if the file is unchanged. The file is returned in blocks of BLOCKSIZE, through wsgi.file_wrapper
+where the server provides it, so the server streams the file in blocks.
+"""
+
+import mimetypes, os
+
+from email.utils import formatdate, parsedate_to_datetime
+
+
+# size of blocks read from a file
+BLOCKSIZE = 65536
+
+# mimetypes does not know the FITS extensions common for astronomical images
+_FITS = {'.fits':'image/fits', '.fit':'image/fits', '.fts':'image/fits'}
+
+
+class BlobServer():
+    "WSGI application serving files from blob_folder, given as a pathlib.Path"
+
+    def __init__(self, blob_folder):
+        self.blob_folder = blob_folder
+
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain'), ('Allow', 'GET, HEAD')])
+            return [b"Method not allowed"]
+        # the route is the path to the folder, the remainder is the path of the file within it
+        filename = environ.get('PATH_INFO', '').lstrip('/')
+        path = self._path(filename)
+        if path is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b"File not found"]
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b"File not found"]
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        headers = [('ETag', etag),
+                   ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+                   ('Accept-Ranges', 'bytes')]
+        if _not_modified(environ, etag, stat.st_mtime):
+            f.close()
+            start_response('304 Not Modified', headers)
+            return []
+        headers.append(('Content-Type', _mimetype(filename)))
+        byterange = _range(environ, etag, stat.st_mtime, size)
+        if byterange is False:
+            f.close()
+            start_response('416 Range Not Satisfiable', [('Content-Range', f'bytes */{size}')])
+            return []
+        if byterange is None:
+            start, end = 0, size - 1
+            status = '200 OK'
+        else:
+            start, end = byterange
+            status = '206 Partial Content'
+            headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+        length = end - start + 1 if size else 0
+        headers.append(('Content-Length', str(length)))
+        start_response(status, headers)
+        if method == 'HEAD':
+            f.close()
+            return []
+        f.seek(start)
+        if end == size - 1:
+            # served to the end of the file, so the server's file wrapper can send it
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(f, BLOCKSIZE)
+        return _FileRange(f, length)
+
+
+    def _path(self, filename):
+        """Returns the path of the file in the blob folder, or None if it is not a file there,
+           filename may be a path within the folder, such as a sharded path"""
+        parts = filename.split('/')
+        # no hidden files or folders, and no parent folders
+        if (not filename) or any((not part) or part.startswith('.') for part in parts):
+            return
+        path = self.blob_folder.joinpath(*parts)
+        if not path.is_file():
+            return
+        return path
+
+
+class _FileRange():
+    "Iterates over length bytes of a file from its current position"
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        data = self.f.read(min(BLOCKSIZE, self.remaining))
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def _mimetype(filename):
+    "Returns the mimetype from the file extension"
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in _FITS:
+        return _FITS[extension]
+    mimetype, encoding = mimetypes.guess_type(os.path.basename(filename))
+    if (mimetype is None) or encoding:
+        # a compressed file, such as .fits.gz, is sent as it is
+        return 'application/octet-stream'
+    return mimetype
+
+
+def _not_modified(environ, etag, mtime):
+    "Returns True if the conditional headers show the client has the current file"
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # weak comparison, so W/ prefixes are ignored
+        return ('*' in tags) or (etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags])
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def _range(environ, etag, mtime, size):
+    """Returns (start, end) of a single byte range requested, None if the whole file
+       is to be sent, or False if the range cannot be satisfied"""
+    rangeheader = environ.get('HTTP_RANGE', '')
+    if not rangeheader.startswith('bytes='):
+        return
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range:
+        # only send the range if the client has this version of the file
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return
+        elif if_range != formatdate(mtime, usegmt=True):
+            return
+    ranges = rangeheader[6:].split(',')
+    if len(ranges) != 1:
+        # multiple ranges are not supported, the whole file is sent
+        return
+    first, sep, last = ranges[0].strip().partition('-')
+    try:
+        if not first:
+            # the final bytes of the file
+            length = int(last)
+            if length <= 0:
+                return False
+            start = max(size - length, 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return
+    if (not sep) or (start > end) or (start >= size):
+        return False
+    return start, min(end, size - 1)
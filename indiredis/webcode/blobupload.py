@@ -0,0 +1,155 @@
+
+"""Sends BLOBs to a device without holding copies of the file in memory.
+
+The file is read in blocks, optionally gzip compressed, and base64 encoded into a temporary
+file holding the complete newBLOBVector XML. This is then memory mapped and published, redis
+sending the mapped file to its socket without it being copied into a Python bytes object,
+so memory used does not depend on the file size.
+
+An INDI message must be published as a single message, as the receiver expects whole XML
+elements, so the XML is written in blocks but published in one PUBLISH.
+
+UploadServer is a WSGI application which receives the file as the raw body of a POST
+request, spooling it to a temporary file, so a script can send large files, for example:
+
+curl --data-binary @file.fits "http://host:8000/upload?device=CCD&property=UPLOAD&element=FILE&format=.fits"
+
+With the parameter zip=1 the file is compressed, and .gz appended to the format.
+"""
+
+import gzip, mmap, tempfile, json
+
+from base64 import b64encode
+
+from datetime import datetime, timezone
+
+from urllib.parse import parse_qs
+
+from xml.sax.saxutils import quoteattr
+
+
+# size of blocks read from a file, a multiple of 3 so blocks are base64 encoded without padding
+BLOCKSIZE = 3 * 65536
+
+# uploads larger than this are spooled to disk as they are received
+SPOOLSIZE = 1024 * 1024
+
+
+class _Base64Writer():
+    "A file-like object which base64 encodes the data written to it into the file f"
+
+    def __init__(self, f):
+        self.f = f
+        self.remainder = b''
+
+    def write(self, data):
+        length = len(data)
+        data = self.remainder + data
+        # encode whole groups of three bytes, keeping any remainder for the next write
+        cut = len(data) - len(data) % 3
+        self.f.write(b64encode(data[:cut]))
+        self.remainder = data[cut:]
+        return length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.remainder:
+            self.f.write(b64encode(self.remainder))
+            self.remainder = b''
+
+
+def _copy(source, destination):
+    "Copies source to destination in blocks, returns the number of bytes copied"
+    size = 0
+    while True:
+        block = source.read(BLOCKSIZE)
+        if not block:
+            return size
+        destination.write(block)
+        size += len(block)
+
+
+def publish_blob(rconn, redisserver, devicename, propertyname, elementname, source, fext, compress=False, size=None):
+    """Reads the binary file object source, and publishes a newBLOBVector to the to_indi_channel.
+       If compress is True, the file is gzip compressed and .gz appended to the format fext.
+       If source is already compressed, size should be given as the uncompressed size.
+       Returns the uncompressed size of the file, or None if the property does not exist"""
+    if not rconn.exists(redisserver.keyprefix + 'attributes:' + propertyname + ':' + devicename):
+        return
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    if compress:
+        fext = fext + ".gz"
+    with tempfile.TemporaryFile() as xmlfile:
+        # the size attribute is not known until the file is read, so a fixed width space is left for it
+        head = (f"<newBLOBVector device={quoteattr(devicename)} name={quoteattr(propertyname)} timestamp={quoteattr(timestamp)}>"
+                f"<oneBLOB name={quoteattr(elementname)} format={quoteattr(fext)} size=\"").encode('utf-8')
+        xmlfile.write(head)
+        sizeposition = xmlfile.tell()
+        xmlfile.write(b" " * 20 + b">")
+        encoder = _Base64Writer(xmlfile)
+        if compress:
+            with gzip.GzipFile(fileobj=encoder, mode='wb') as gz:
+                copied = _copy(source, gz)
+        else:
+            copied = _copy(source, encoder)
+        if size is None:
+            size = copied
+        encoder.close()
+        xmlfile.write(b"</oneBLOB></newBLOBVector>")
+        # write the size and closing quote, padded with spaces to the space left
+        xmlfile.seek(sizeposition)
+        xmlfile.write(str(size).encode('ascii') + b'"' + b" " * (19 - len(str(size))))
+        xmlfile.flush()
+        with mmap.mmap(xmlfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as message:
+                rconn.publish(redisserver.to_indi_channel, message)
+    return size
+
+
+class UploadServer():
+    """WSGI application receiving a file as the body of a POST request, with query string
+       parameters device, property, element, format and optionally zip=1, and publishing
+       it to the device. Responds with a JSON object with key 'size', or an error text"""
+
+    def __init__(self, rconn, redisserver):
+        self.rconn = rconn
+        self.redisserver = redisserver
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain'), ('Allow', 'POST')])
+            return [b"Method not allowed"]
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        params = {name:query[name][0] for name in ('device', 'property', 'element', 'format', 'zip') if name in query}
+        if not all(params.get(name) for name in ('device', 'property', 'element')):
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b"device, property and element parameters are required"]
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            start_response('411 Length Required', [('Content-Type', 'text/plain')])
+            return [b"A Content-Length header is required"]
+        stream = environ['wsgi.input']
+        with tempfile.SpooledTemporaryFile(max_size=SPOOLSIZE) as spool:
+            remaining = length
+            while remaining > 0:
+                block = stream.read(min(BLOCKSIZE, remaining))
+                if not block:
+                    break
+                spool.write(block)
+                remaining -= len(block)
+            if remaining:
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return [b"Incomplete upload"]
+            spool.seek(0)
+            size = publish_blob(self.rconn, self.redisserver, params['device'], params['property'], params['element'],
+                                spool, params.get('format', ''), compress=(params.get('zip') == '1'))
+        if size is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b"Property not found"]
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'size':size}).encode('utf-8')]
@@ -0,0 +1,415 @@
+
+"""An in-process model of devices, properties and elements, kept up to date by
+a thread subscribed to the redis from_indi_channel.
+
+indi-mr writes each received INDI item into redis, and then publishes the XML on the
+from_indi_channel, so on receiving a message only the property named in it needs to be
+read from redis. Web requests then read the model from memory.
+
+As each change is applied, the version counters in module versions are incremented, so
+pages can test for changes with a single redis call. The group index of module groupindex
+is also kept up to date, so pages can read a single group from redis when the cache is not
+loaded.
+"""
+
+import threading
+
+from time import sleep
+
+from collections import deque
+
+import xml.etree.ElementTree as ET
+
+from .snapshot import read_device, read_property, read_devicelist
+from .groupindex import set_property, remove_property, rebuild_device, order_groups
+from .versions import bump_versions, devicemessage_field, structure_field, group_field, groupstructure_field
+
+
+_VECTORS = ('defTextVector', 'defNumberVector', 'defSwitchVector', 'defLightVector', 'defBLOBVector',
+            'setTextVector', 'setNumberVector', 'setSwitchVector', 'setLightVector', 'setBLOBVector')
+
+# attributes which set the layout of a property on the page, a change refreshes the page html
+_LAYOUT_ATTRIBUTES = ('vector', 'perm', 'rule', 'label')
+
+
+class DeviceCache():
+    """Holds devices, properties and elements in memory. Call start() to load the model
+       from redis and start the subscriber thread.
+
+       Until the model has been loaded, the attribute ready is False, and callers should
+       read redis directly."""
+
+    def __init__(self, rconn, redisserver):
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.ready = False
+        self._lock = threading.Lock()
+        # notified on every change to the model
+        self._changed = threading.Condition(self._lock)
+        # sequence is incremented on every change, and recent changes are recorded
+        # as (sequence, tag, devicename, propertyname) tuples in self._events
+        self.sequence = 0
+        self._events = deque(maxlen=1000)
+        # functions called with each (sequence, tag, devicename, propertyname) change
+        self._listeners = []
+        self._message = ""
+        # dictionary of devicename:{'attributes':{propertyname:att_dict},
+        #                           'elements':{propertyname:[element dictionaries]},
+        #                           'devicemessage':string,
+        #                           'groups':{group:[propertynames sorted by label]} or None}
+        # where 'groups' is set from the attributes when first read, and reset to None when
+        # the group or label of a property changes
+        self._devices = {}
+
+
+    def start(self):
+        "Starts the subscriber thread"
+        thread = threading.Thread(target=self._run, name="indiredis_cache", daemon=True)
+        thread.start()
+
+
+    def _run(self):
+        "Subscribes to the from_indi_channel, loads the model and applies updates, reconnects on failure"
+        while True:
+            try:
+                pubsub = self.rconn.pubsub(ignore_subscribe_messages=True)
+                # subscribe before loading, so no update is missed
+                pubsub.subscribe(self.redisserver.from_indi_channel)
+                self._load()
+                self.ready = True
+                while True:
+                    # get_message with a timeout waits for the socket to be readable, so unlike
+                    # listen(), a quiet channel does not raise a socket timeout error
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and (message['type'] == 'message'):
+                        self.update(message['data'])
+            except Exception:
+                # redis connection failed, serve from redis directly until reconnected
+                self.ready = False
+                sleep(5)
+
+
+    def _load(self):
+        "Reads every device from redis"
+        devicelist = read_devicelist(self.rconn, self.redisserver)
+        devices = {}
+        for devicename in devicelist['devices']:
+            snapshot = read_device(self.rconn, self.redisserver, devicename)
+            devices[devicename] = {'attributes':snapshot['attributes'],
+                                   'elements':snapshot['elements'],
+                                   'devicemessage':snapshot['devicemessage'],
+                                   'groups':None}
+            rebuild_device(self.rconn, self.redisserver, devicename, snapshot['attributes'])
+        with self._lock:
+            self._message = devicelist['message']
+            self._devices = devices
+        # a reload could change anything
+        bump_versions(self.rconn, self.redisserver, ['load'])
+        self._notify("load", None, None)
+
+
+    def _notify(self, tag, devicename, propertyname):
+        "Records the change, wakes any thread waiting on wait_for_events and calls listeners"
+        with self._changed:
+            self.sequence += 1
+            event = (self.sequence, tag, devicename, propertyname)
+            self._events.append(event)
+            self._changed.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                # a failing listener must not stop the subscriber
+                pass
+
+
+    def add_listener(self, listener):
+        """Adds a function which is called, in the subscriber thread, with each
+           (sequence, tag, devicename, propertyname) change, it must not block"""
+        with self._lock:
+            self._listeners.append(listener)
+
+
+    def remove_listener(self, listener):
+        "Removes a function added with add_listener"
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+    def wait_for_events(self, sequence, timeout):
+        """Waits up to timeout seconds for changes after the given sequence number, and returns
+           a list of (sequence, tag, devicename, propertyname) tuples, which is empty if no change
+           has occurred. If the changes since sequence are no longer recorded, returns None"""
+        with self._changed:
+            self._changed.wait_for(lambda : self.sequence > sequence, timeout)
+            if self.sequence <= sequence:
+                return []
+            if self._events[0][0] > sequence + 1:
+                return None
+            return [event for event in self._events if event[0] > sequence]
+
+
+    def update(self, data):
+        """Given the XML data published on the from_indi_channel, re-reads the
+           property it refers to, and returns the device name, or None if the
+           model has not changed"""
+        try:
+            root = ET.fromstring(data)
+        except ET.ParseError:
+            return
+        devicename = root.get("device")
+        propertyname = root.get("name")
+        if root.tag == "message":
+            fields = self._update_messages(devicename)
+        elif (root.tag == "delProperty") and (not propertyname):
+            # the whole device is deleted
+            fields = self._update_device(devicename)
+        elif (root.tag in _VECTORS) or (root.tag == "delProperty"):
+            fields = self._update_property(devicename, propertyname)
+        else:
+            return
+        # versions are incremented after the model is updated, so a page which reads the
+        # versions and then the model may refresh needlessly, but never misses a change
+        bump_versions(self.rconn, self.redisserver, fields)
+        self._notify(root.tag, devicename, propertyname)
+        return devicename
+
+
+    def _message_fields(self, snapshot, devicename):
+        """Sets the messages from snapshot into the model, and returns the version fields
+           of those which have changed, must be called with the lock held"""
+        fields = []
+        if snapshot['message'] != self._message:
+            self._message = snapshot['message']
+            fields.append('messages')
+        device = self._devices.get(devicename)
+        if (device is not None) and ('devicemessage' in snapshot) and (snapshot['devicemessage'] != device['devicemessage']):
+            device['devicemessage'] = snapshot['devicemessage']
+            fields.extend(['devicemessages', devicemessage_field(devicename)])
+        return fields
+
+
+    def _update_messages(self, devicename):
+        """Reads the last system message, and the last device message if devicename is given,
+           returns a list of version fields to increment"""
+        if devicename:
+            # with an empty property name, only the messages are read
+            snapshot = read_property(self.rconn, self.redisserver, devicename, "")
+        else:
+            snapshot = read_devicelist(self.rconn, self.redisserver)
+        with self._lock:
+            return self._message_fields(snapshot, devicename)
+
+
+    def _update_device(self, devicename):
+        """Re-reads the whole device, removing it if it no longer exists,
+           returns a list of version fields to increment"""
+        snapshot = read_device(self.rconn, self.redisserver, devicename)
+        with self._lock:
+            fields = ['devices', structure_field(devicename)]
+            if devicename in snapshot['devices']:
+                self._devices[devicename] = {'attributes':snapshot['attributes'],
+                                             'elements':snapshot['elements'],
+                                             'devicemessage':snapshot['devicemessage'],
+                                             'groups':None}
+            else:
+                self._devices.pop(devicename, None)
+            fields.extend(self._message_fields(snapshot, devicename))
+        rebuild_device(self.rconn, self.redisserver, devicename, snapshot['attributes'])
+        return fields
+
+
+    def _update_property(self, devicename, propertyname):
+        """Re-reads a single property, removing it if it no longer exists,
+           returns a list of version fields to increment"""
+        snapshot = read_property(self.rconn, self.redisserver, devicename, propertyname)
+        with self._lock:
+            if not snapshot['isdevice']:
+                fields = self._message_fields(snapshot, devicename)
+                if self._devices.pop(devicename, None) is not None:
+                    fields.extend(['devices', structure_field(devicename)])
+                removed = True
+            else:
+                fields, regroup = self._set_property(snapshot, devicename, propertyname)
+                removed = False
+        if removed:
+            rebuild_device(self.rconn, self.redisserver, devicename, {})
+        elif regroup:
+            if snapshot['attributes']:
+                set_property(self.rconn, self.redisserver, devicename, propertyname, snapshot['attributes'])
+            else:
+                remove_property(self.rconn, self.redisserver, devicename, propertyname)
+        return fields
+
+
+    def _set_property(self, snapshot, devicename, propertyname):
+        """Sets the property read by read_property into the model, must be called with the lock
+           held, returns the version fields to increment, and True if the group index is to be
+           updated, as the property has been added, removed, or its group or label changed"""
+        fields = []
+        if devicename not in self._devices:
+            self._devices[devicename] = {'attributes':{}, 'elements':{}, 'devicemessage':"", 'groups':None}
+            fields.append('devices')
+        fields.extend(self._message_fields(snapshot, devicename))
+        device = self._devices[devicename]
+        old_att = device['attributes'].get(propertyname)
+        old_els = device['elements'].get(propertyname)
+        new_att = snapshot['attributes']
+        new_els = snapshot['elements']
+        if new_att:
+            device['attributes'][propertyname] = new_att
+            device['elements'][propertyname] = new_els
+        else:
+            device['attributes'].pop(propertyname, None)
+            device['elements'].pop(propertyname, None)
+        fields.extend(_property_fields(devicename, old_att, old_els, new_att, new_els))
+        regroup = _group_key(old_att) != _group_key(new_att)
+        if regroup:
+            device['groups'] = None
+        return fields, regroup
+
+
+    def read_device(self, devicename, group=None):
+        "Returns the same dictionary as snapshot.read_device, but read from memory"
+        with self._lock:
+            devices = sorted(self._devices)
+            device = self._devices.get(devicename)
+            if device is None:
+                return {'devices':devices,
+                        'message':self._message,
+                        'devicemessage':"",
+                        'attributes':{},
+                        'elements':{}}
+            # copies of the attribute dictionaries are returned, as callers add to them,
+            # element dictionaries are replaced on update rather than altered, so can be shared
+            attributes = {name:dict(ad) for name, ad in device['attributes'].items()}
+            if group:
+                elements = {name:list(device['elements'][name]) for name, ad in device['attributes'].items() if ad.get('group') == group}
+            else:
+                elements = {name:list(els) for name, els in device['elements'].items()}
+            return {'devices':devices,
+                    'message':self._message,
+                    'devicemessage':device['devicemessage'],
+                    'attributes':attributes,
+                    'elements':elements}
+
+
+    def read_group(self, devicename, group=None):
+        """Returns the same dictionary as snapshot.read_group, but read from memory, of the given
+           group, or of the first group of the device if group is None"""
+        with self._lock:
+            devices = sorted(self._devices)
+            device = self._devices.get(devicename)
+            if device is None:
+                return {'devices':devices,
+                        'message':self._message,
+                        'devicemessage':"",
+                        'groups':[],
+                        'group':group or '',
+                        'properties':[],
+                        'attributes':{},
+                        'elements':{}}
+            if device['groups'] is None:
+                device['groups'] = order_groups(device['attributes'])
+            groups = sorted(device['groups'])
+            if group is None:
+                group = groups[0] if groups else ''
+            properties = list(device['groups'].get(group, []))
+            # copies of the attribute dictionaries are returned, as callers add to them,
+            # element dictionaries are replaced on update rather than altered, so can be shared
+            return {'devices':devices,
+                    'message':self._message,
+                    'devicemessage':device['devicemessage'],
+                    'groups':groups,
+                    'group':group,
+                    'properties':properties,
+                    'attributes':{name:dict(device['attributes'][name]) for name in properties},
+                    'elements':{name:list(device['elements'][name]) for name in properties}}
+
+
+    def read_devicelist(self):
+        "Returns the same dictionary as snapshot.read_devicelist, but read from memory"
+        with self._lock:
+            devicemessages = {devicename:device['devicemessage'] for devicename, device in self._devices.items()}
+            return {'devices':sorted(devicemessages),
+                    'message':self._message,
+                    'devicemessages':devicemessages}
+
+
+    def read_elements(self, devicename, propertyname):
+        "Returns the list of element dictionaries of the property, empty if it does not exist"
+        with self._lock:
+            device = self._devices.get(devicename)
+            if device is None:
+                return []
+            return list(device['elements'].get(propertyname, []))
+
+
+    def read_attributes(self, devicename, propertyname):
+        "Returns a copy of the attribute dictionary of the property, empty if it does not exist"
+        with self._lock:
+            device = self._devices.get(devicename)
+            if device is None:
+                return {}
+            return dict(device['attributes'].get(propertyname, {}))
+
+
+    def read_numbervectors(self, devicename, group=None, propertyname=None):
+        """Returns a list of dictionaries, one for each number vector of the device, or of the
+           given group, or the single property given, each with keys 'device', 'property', 'state',
+           'timestamp' and 'elements', being a dictionary of element name:formatted number"""
+        numbervectors = []
+        with self._lock:
+            device = self._devices.get(devicename)
+            if device is None:
+                return numbervectors
+            if propertyname is None:
+                names = sorted(device['attributes'])
+            else:
+                names = [propertyname]
+            for name in names:
+                ad = device['attributes'].get(name)
+                if (ad is None) or (ad.get('vector') != "NumberVector"):
+                    continue
+                if group and (ad.get('group') != group):
+                    continue
+                numbervectors.append({'device':devicename,
+                                      'property':name,
+                                      'state':ad.get('state'),
+                                      'timestamp':ad.get('timestamp'),
+                                      'elements':{eld['name']:eld['formatted_number'] for eld in device['elements'].get(name, [])}})
+        return numbervectors
+
+
+def _group_key(att_dict):
+    "Returns the (group, label) under which a property is indexed, or None if it does not exist"
+    if not att_dict:
+        return
+    return att_dict.get('group', ''), att_dict.get('label')
+
+
+def _property_fields(devicename, old_att, old_els, new_att, new_els):
+    """Compares the old and new attributes and elements of a property, and returns
+       the version fields to increment"""
+    if (not old_att) and (not new_att):
+        return []
+    if (not old_att) or (not new_att) or (old_att.get('group') != new_att.get('group')):
+        # a property has been added or removed, or moved to another group
+        return [structure_field(devicename)]
+    if (old_att == new_att) and (old_els == new_els):
+        return []
+    group = new_att.get('group', '')
+    if _json_update(old_att, old_els, new_att, new_els):
+        return [group_field(devicename, group)]
+    return [groupstructure_field(devicename, group)]
+
+
+def _json_update(old_att, old_els, new_att, new_els):
+    """Returns True if the change to the property can be shown on the page by a json update,
+       or False if the page html must be refreshed"""
+    if any(old_att.get(key) != new_att.get(key) for key in _LAYOUT_ATTRIBUTES):
+        return False
+    # elements are listed in label order, so the same names and labels give the same table rows
+    return [(eld['name'], eld.get('label')) for eld in old_els] == [(eld['name'], eld.get('label')) for eld in new_els]
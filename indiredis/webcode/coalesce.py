@@ -0,0 +1,74 @@
+
+"""Coalesces identical concurrent reads.
+
+When many browsers show the same device and group, their polls arrive together and each
+would make the same redis calls. With SingleFlight.do, the first caller with a given key
+runs the function, while others with that key wait for, and share, its result. The result
+is then kept for a short time, so polls arriving just after also share it.
+"""
+
+import threading
+
+from time import monotonic
+
+
+# seconds for which a result is shared after it has been read
+TTL = 0.5
+
+
+class _Call():
+    "A call of the function, in progress or completed"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.expires = None
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    "Shares the result of a function between concurrent callers with the same key"
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # dictionary of key:_Call
+        self._calls = {}
+
+
+    def do(self, key, function, *args):
+        """Returns function(*args), calling it only if no call with this key is in
+           progress, or has completed within ttl seconds. The result is shared, so must
+           not be altered by the caller. An exception is raised in every waiting caller,
+           but is not kept."""
+        with self._lock:
+            call = self._calls.get(key)
+            if (call is not None) and ((call.expires is None) or (monotonic() < call.expires)):
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+                # remove expired results, so keys of devices no longer shown are dropped
+                now = monotonic()
+                for oldkey in [k for k, c in self._calls.items() if (c.expires is not None) and (c.expires <= now)]:
+                    del self._calls[oldkey]
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if call.error is None:
+                    call.expires = monotonic() + self.ttl
+                else:
+                    # errors are not kept, the next caller tries again
+                    call.expires = 0
+            call.done.set()
+        return call.result
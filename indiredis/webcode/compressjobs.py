@@ -0,0 +1,115 @@
+
+"""Compresses uploaded BLOBs in a pool of worker processes.
+
+Compressing a large file holds the GIL, so rather than compressing in the web server thread,
+the upload is written to a temporary file and a job submitted to a process pool. The request
+returns at once, and when compression completes, the BLOB is published to the device and a
+status message recorded, which is shown on the next properties page update for the device
+in the browser which submitted the file.
+"""
+
+import gzip, os, tempfile, threading, multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .blobupload import publish_blob, BLOCKSIZE
+
+
+def _compress_file(inpath, outpath, level):
+    "Run in a worker process, gzip compresses the file at inpath to outpath"
+    with open(inpath, 'rb') as infile, gzip.open(outpath, 'wb', compresslevel=level) as outfile:
+        while True:
+            block = infile.read(BLOCKSIZE)
+            if not block:
+                break
+            outfile.write(block)
+
+
+class CompressionPool():
+    """A pool of max_workers processes compressing files at the given gzip level,
+       with at most max_jobs files waiting or being compressed"""
+
+    def __init__(self, rconn, redisserver, max_workers=1, level=9, max_jobs=8):
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.max_workers = max_workers
+        self.level = level
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        # the process pool is created when first needed
+        self._executor = None
+        self._jobs = 0
+        # dictionary of (client, devicename):list of completed job status messages
+        self._status = {}
+
+
+    def submit(self, client, devicename, propertyname, elementname, data, fext):
+        """Writes data to a temporary file and submits it for compression, returns False
+           if too many jobs are already in progress. client is a key of the submitting
+           browser, to which the status is shown"""
+        with self._lock:
+            if self._jobs >= self.max_jobs:
+                return False
+            if self._executor is None:
+                # spawn, as forking a process with running threads is unsafe, created
+                # before the job is counted, so a failure to create it holds no slot
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            self._jobs += 1
+        try:
+            infd, inpath = tempfile.mkstemp(prefix="indiredis_")
+            with os.fdopen(infd, 'wb') as infile:
+                infile.write(data)
+            outpath = inpath + ".gz"
+            future = self._executor.submit(_compress_file, inpath, outpath, self.level)
+        except Exception:
+            with self._lock:
+                self._jobs -= 1
+            raise
+        job = (client, devicename, propertyname, elementname, fext, len(data), inpath, outpath)
+        future.add_done_callback(lambda f : threading.Thread(target=self._publish, args=(f, job), daemon=True).start())
+        return True
+
+
+    def _publish(self, future, job):
+        "Called in a thread when compression completes, publishes the compressed file"
+        client, devicename, propertyname, elementname, fext, size, inpath, outpath = job
+        try:
+            future.result()
+            with open(outpath, 'rb') as source:
+                data_sent = publish_blob(self.rconn, self.redisserver, devicename, propertyname, elementname,
+                                         source, fext + ".gz", size=size)
+            if data_sent is None:
+                message = f"Error sending compressed file to {devicename} {propertyname} {elementname}"
+            else:
+                message = f"""The compressed file has been submitted:
+    Device name   : {devicename}
+    Property name : {propertyname}
+    Element name  : {elementname}
+    Size          : {size}
+    Format        : {fext}.gz"""
+        except Exception as e:
+            message = f"Error compressing file for {devicename} {propertyname} {elementname}: {e}"
+        finally:
+            for path in (inpath, outpath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self._lock:
+            self._jobs -= 1
+            self._status.setdefault((client, devicename), []).append(message)
+
+
+    def pending(self):
+        "Returns the number of files waiting for, or being, compressed"
+        with self._lock:
+            return self._jobs
+
+
+    def pop_status(self, client, devicename):
+        """Returns the status messages of completed jobs of the device submitted by the client,
+           removing them, or an empty string"""
+        with self._lock:
+            messages = self._status.pop((client, devicename), [])
+        return "\n\n".join(messages)
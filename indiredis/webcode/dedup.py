@@ -0,0 +1,102 @@
+
+"""Keeps one copy on disc of BLOB files with identical contents.
+
+Flat, bias and dark frames, and repeated calibration files, are often byte for byte
+identical. Each file received is hashed in a thread, and if a file with the same SHA-256
+digest is already held, the new file is replaced by a hard link to it. The file names, and
+so every link to them, are unchanged, but the contents are stored once, and only deleted
+when the last file name linking to them is deleted.
+
+Redis keys, prefixed by redisserver.keyprefix, are
+
+blobdigest  - hash of digest:path, relative to the blob folder, of a file with those contents
+blobhashed  - hash of path:digest, so the digest entry is removed when the file is deleted,
+              by blobindex.forget_blob
+"""
+
+import hashlib, os, queue, threading
+
+from .blobindex import relink_blob, inode
+
+
+# size of blocks read when hashing a file
+BLOCKSIZE = 1024 * 1024
+
+# number of received files which may wait to be hashed, further files are not deduplicated
+QUEUESIZE = 64
+
+
+def _digest(path):
+    "Returns the SHA-256 hex digest of the file"
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCKSIZE)
+            if not block:
+                return sha.hexdigest()
+            sha.update(block)
+
+
+def deduplicate(rconn, redisserver, blob_folder, relpath):
+    """Hashes the file at relpath within the blob folder, and if a file with the same contents
+       is held, replaces it by a hard link to that file. Returns True if the file was replaced"""
+    path = blob_folder / relpath
+    digest = _digest(path)
+    digestkey = redisserver.keyprefix + 'blobdigest'
+    # record this file, unless another already holds these contents
+    if rconn.hsetnx(digestkey, digest, relpath):
+        rconn.hset(redisserver.keyprefix + 'blobhashed', relpath, digest)
+        return False
+    original = rconn.hget(digestkey, digest).decode('utf-8')
+    originalpath = blob_folder / original
+    if not originalpath.is_file():
+        # the recorded file has been deleted, so this file now holds these contents
+        rconn.hset(digestkey, digest, relpath)
+        rconn.hset(redisserver.keyprefix + 'blobhashed', relpath, digest)
+        return False
+    if os.path.samefile(originalpath, path):
+        # already linked
+        return False
+    # link to a temporary name, then replace, so the file name always exists
+    temppath = path.with_name("." + path.name + ".link")
+    os.link(originalpath, temppath)
+    os.replace(temppath, path)
+    # the file now shares the contents of the original, so is not counted in the total size
+    relink_blob(rconn, redisserver, relpath, inode(originalpath.stat()))
+    return True
+
+
+class BlobDeduplicator():
+    """Runs a thread which replaces files whose contents are already held by hard links,
+       the files are passed to add by the BlobIndexer, once it has moved and indexed them"""
+
+    def __init__(self, rconn, redisserver, blob_folder):
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.blob_folder = blob_folder
+        self._queue = queue.Queue(QUEUESIZE)
+
+    def start(self):
+        "Starts the hashing thread"
+        if not self.blob_folder:
+            return
+        thread = threading.Thread(target=self._run, name="indiredis_dedup", daemon=True)
+        thread.start()
+
+    def add(self, relpath):
+        "Queues the file at relpath within the blob folder to be deduplicated, it is skipped if the queue is full"
+        if not self.blob_folder:
+            return
+        try:
+            self._queue.put_nowait(relpath)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            relpath = self._queue.get()
+            try:
+                deduplicate(self.rconn, self.redisserver, self.blob_folder, relpath)
+            except Exception:
+                # the file may have been deleted, it is left as it is
+                continue
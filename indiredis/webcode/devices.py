@@ -1,15 +1,27 @@
 
 import pathlib
+from html import escape
+from urllib.parse import quote
 from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, monotonic
 from base64 import urlsafe_b64encode, urlsafe_b64decode
-from zlib import adler32
 
 from skipole import FailPage
 
 from indi_mr import tools
 
-from .setvalues import set_state
+from .setvalues import set_state, client_key
+from .snapshot import read_group, read_devicelist
+from .versions import devicelist_version, property_versions
+from .layout import SHARDED, blob_paths
+
+
+# seconds after the last def vector of a device is received, for which getDeviceProperties
+# waits for any further def vectors before refreshing the page
+QUIET = 0.25
+
+# text and background colours of the light states
+_LIGHTS = {"Idle":("white", "grey"), "Ok":("white", "green"), "Busy":("black", "yellow"), "Alert":("white", "red")}
 
 
 
@@ -27,31 +39,52 @@ def _fromsafekey(safekey):
     return urlsafe_b64decode(b64binarydata).decode('utf-8') # b64 decode, and convert to string
 
 
+def _read_group(skicall, devicename, group=None):
+    """Returns a dictionary of the device, its groups and the properties of the group, or of the
+       first group if group is None, from the in-memory cache if it is loaded, otherwise from redis"""
+    cache = skicall.proj_data.get("propertycache")
+    if (cache is not None) and cache.ready:
+        return cache.read_group(devicename, group)
+    return read_group(skicall.proj_data["rconn"], skicall.proj_data["redisserver"], devicename, group)
+
+
+def _read_devicelist(skicall):
+    """Returns a dictionary of devices and their last messages,
+       from the in-memory cache if it is loaded, otherwise from redis"""
+    cache = skicall.proj_data.get("propertycache")
+    if (cache is not None) and cache.ready:
+        return cache.read_devicelist()
+    return read_devicelist(skicall.proj_data["rconn"], skicall.proj_data["redisserver"])
+
+
 def devicelist(skicall):
     "Gets a list of devices and fill index devices page"
     # remove any device, group etc from call_data, since this page does not refer to a single device
-    # however, retain the athenticate value if given
+    # however, retain the athenticate value if given, and the key of the browser
     if 'authenticate' in skicall.call_data:
         authenticate = skicall.call_data['authenticate']
     else:
        authenticate = None
+    client = skicall.call_data.get('client')
     skicall.call_data.clear()
     if authenticate:
         skicall.call_data['authenticate'] = authenticate
+    if client:
+        skicall.call_data['client'] = client
     # If a password has been set, a logout button is displayed
     # since the user must have logged in to see this page
     # if no password, the logout button is not shown
     if not skicall.proj_data["hashedpassword"]:
         skicall.page_data['logout', 'show'] = False
-    rconn = skicall.proj_data["rconn"]
-    redisserver = skicall.proj_data["redisserver"]
-    checksum1 = ''
+    # the version is read before the data, so any change made while the data is read
+    # will be picked up by the next update
+    version1 = devicelist_version(skicall.proj_data["rconn"], skicall.proj_data["redisserver"])
+    devicedata = _read_devicelist(skicall)
     # get last message
-    message = tools.last_message(rconn, redisserver)
+    message = devicedata['message']
     if message:
         skicall.page_data['message', 'para_text'] = message
-        checksum1 += message
-    devices = tools.devices(rconn, redisserver)
+    devices = devicedata['devices']
     if not devices:
         skicall.page_data['device', 'hide'] = True
         if message:
@@ -61,10 +94,8 @@ def devicelist(skicall):
         skicall.page_data['devicelist', 'para_text'] = "No devices have been found .. waiting for update."
         # publish getProperties
         getProperties(skicall)
-        checksum1 += skicall.page_data['message', 'para_text']
-        # encode checksum1 as binary, then create a checksum
-        bindata = checksum1.encode('utf-8', errors='ignore')
-        skicall.call_data["checksum1"] = adler32(bindata)
+        # no version is set, so check_for_update will call this page again, and
+        # getProperties will be re-sent until devices are found
         return
     skicall.page_data['devicelist', 'para_text'] = "Follow the link to manage each instrument."
     # devices is a list of known devices
@@ -72,48 +103,23 @@ def devicelist(skicall):
     for index,devicename in enumerate(devices):
         skicall.page_data['device_'+str(index),'devicename', 'button_text'] = devicename
         skicall.page_data['device_'+str(index),'devicename','get_field1'] = devicename
-        checksum1 += devicename
         # set device messages here
-        devicemessage = tools.last_message(rconn, redisserver, devicename)
+        devicemessage = devicedata['devicemessages'][devicename]
         if devicemessage:
             skicall.page_data['device_'+str(index),'devicemessage','para_text'] = devicemessage
-            checksum1 += devicemessage
-    # encode checksum1 as binary, then create a checksum
-    bindata = checksum1.encode('utf-8', errors='ignore')
-    skicall.call_data["checksum1"] = adler32(bindata)
+    # set the version into ident_data which is sent back and can be used to check if the page has changed
+    skicall.call_data["version1"] = version1
 
 
 def check_for_update(skicall):
     """Called to update the devices page, which should occur every five seconds.
-       If a change has occurred, requests the client re call the home page.
-       If not, checks if getProperties has been sent in the last minute. If not,
-       then send it."""
+       If a change has occurred, requests the client re call the home page."""
 
-    rconn = skicall.proj_data["rconn"]
-    redisserver = skicall.proj_data["redisserver"]
-    rxchecksum1 = skicall.call_data.get("checksum1", -1)
-    devices = tools.devices(rconn, redisserver)
-    if not devices:
-        # no devices! Request browser to do a full page update
-        skicall.page_data['JSONtoHTML'] = 'home'
-        return
-    checksum1 = ''
-    # check if last message changed
-    message = tools.last_message(rconn, redisserver)
-    if message:
-        checksum1 += message
-    # devices is a list of known devices
-    for index,devicename in enumerate(devices):
-        checksum1 += devicename
-        # set device messages here
-        devicemessage = tools.last_message(rconn, redisserver, devicename)
-        if devicemessage:
-            checksum1 += devicemessage
-    # encode checksum1 as binary, then create a checksum
-    bindata = checksum1.encode('utf-8', errors='ignore')
-    check = adler32(bindata)
-    if check != rxchecksum1:
-        # data read from redis is not the same as that currently shown
+    rxversion1 = skicall.call_data.get("version1", -1)
+    # concurrent polls share a single read
+    version1 = _coalesce(skicall, ("devicelist",), devicelist_version, skicall.proj_data["rconn"], skicall.proj_data["redisserver"])
+    if version1 != rxversion1:
+        # data in redis is not the same as that currently shown
         # so request browser to do a full page update
         skicall.page_data['JSONtoHTML'] = 'home'
 
@@ -165,26 +171,100 @@ def getDeviceProperties(skicall):
         raise FailPage("Device not recognised")
     rconn = skicall.proj_data["rconn"]
     redisserver = skicall.proj_data["redisserver"]
+    cache = skicall.proj_data.get("propertycache")
+    if (cache is not None) and cache.ready:
+        sequence = cache.sequence
+    else:
+        sequence = None
     # publish getProperties
     textsent = tools.getProperties(rconn, redisserver, device=devicename)
-    # wait two seconds for the data to hopefully refresh
-    sleep(2)
+    # wait for the data to hopefully refresh
+    _wait_for_device(skicall, devicename, sequence)
     # and refresh the properties on the page
     refreshproperties(skicall)
 
 
+def _wait_for_device(skicall, devicename, sequence):
+    """Waits for the def vectors of the device to arrive, returning once they have stopped
+       arriving for QUIET seconds, or after the timeout set in proj_data["refresh_timeout"].
+       sequence is that of the property cache before getProperties was sent, or None if
+       the cache is not loaded, in which case the whole timeout is waited"""
+    timeout = skicall.proj_data.get("refresh_timeout", 2)
+    if sequence is None:
+        sleep(timeout)
+        return
+    cache = skicall.proj_data["propertycache"]
+    end = monotonic() + timeout
+    # once a def vector has been received, quiet is the time by which another should arrive
+    quiet = None
+    while True:
+        now = monotonic()
+        if (now >= end) or ((quiet is not None) and (now >= quiet)):
+            return
+        if quiet is None:
+            wait = end - now
+        else:
+            wait = min(end, quiet) - now
+        events = cache.wait_for_events(sequence, wait)
+        if events is None:
+            # changes have been lost, so simply refresh the page
+            return
+        if not events:
+            continue
+        sequence = events[-1][0]
+        for seq, tag, name, propertyname in events:
+            if (name == devicename) and tag.startswith("def"):
+                quiet = monotonic() + QUIET
 
-def _read_redis(skicall):
-    """Reads redis and returns a dictionary of device and its properties for the properties page
-       and checksums for the displayed property page"""
+
+
+def _coalesce(skicall, key, function, *args):
+    """Returns function(*args), sharing the result with concurrent requests having the same key,
+       the result must not be altered"""
+    singleflight = skicall.proj_data.get("singleflight")
+    if singleflight is None:
+        return function(*args)
+    return singleflight.do(key, function, *args)
+
+
+def _read_page(skicall, devicename, group):
+    """Returns (version1, version2, snapshot) of the device and group. The versions are read
+       before the data, so any change made while the data is read will be picked up by the
+       next update. If the page structure changes while the data is read, version2 is
+       returned as -1, which forces a html refresh"""
     rconn = skicall.proj_data["rconn"]
     redisserver = skicall.proj_data["redisserver"]
+    version1, version2 = property_versions(rconn, redisserver, devicename, group)
+    snapshot = _read_group(skicall, devicename, group)
+    if property_versions(rconn, redisserver, devicename, group)[1] != version2:
+        version2 = -1
+    return version1, version2, snapshot
+
+
+def _default_group(skicall, devicename):
+    "Returns the group to display if none is given, being the first of the device"
+    snapshot = _read_group(skicall, devicename)
+    if not snapshot['groups']:
+        raise FailPage("No properties for the device have been found")
+    return snapshot['group']
+
+
+def _read_redis(skicall):
+    """Reads redis and returns a dictionary of device and its properties for the properties page
+       and versions for the displayed property page"""
     # gets device from skicall.call_data["device"]
     devicename = skicall.call_data.get("device")
     if devicename is None:
         raise FailPage("No device has been specified")
+    group = skicall.call_data.get('group')
+    if group is None:
+        # called from the home devices page, find the group to display so its versions can be read
+        group = _default_group(skicall, devicename)
+    # read the device list, the groups of the device and the properties of the group,
+    # concurrent requests for the same device and group share a single read
+    version1, version2, snapshot = _coalesce(skicall, ("page", devicename, group), _read_page, skicall, devicename, group)
     # check devicename is a valid device
-    devices = tools.devices(rconn, redisserver)
+    devices = snapshot['devices']
     if not devices:
         # no devices!
         raise FailPage("No devices have been found")
@@ -192,124 +272,58 @@ def _read_redis(skicall):
         # device has been deleted, go to home
         raise FailPage("The specified device has not been found")
 
+    pdict = {"devicename":devicename}
 
-    pdict = {"devicename":devicename}   # checks if any property has changed in the current displayed group
-    hlist = []                          # checks if any property that requires a html refresh has changed
-
-    # hlist will have all items added to it, that if changed, will require an html change
-    # a string version of hlist will then be used to create a checksum
-
-    properties = tools.properties(rconn, redisserver, devicename)
-    # this is a list of property names, if any changes, then a full html refresh should happen
-    if not properties:
+    group_list = snapshot['groups']
+    if not group_list:
         raise FailPage("No properties for the device have been found")
-    pdict['properties'] = properties
-    hlist.append(properties)
-
-    # get last message and last device message, these can be updated by json, so do not require html
-    # refresh, and so do not appear in hlist
-    message = tools.last_message(rconn, redisserver)
-    if message:
-        pdict['message'] = message
-    devicemessage = tools.last_message(rconn, redisserver, devicename)
-    if devicemessage:
-        pdict['devicemessage'] = devicemessage
-
-    # create list of property attributes dictionaries
-    att_list = []        # record property attributes - used to sort properties on the page
-    for propertyname in properties:
-        # get the property attributes
-        att_dict = tools.attributes_dict(rconn, redisserver, propertyname, devicename)
-        # Ensure the label is set
-        label = att_dict.get('label')
-        if label is None:
-            att_dict['label'] = propertyname
-        att_list.append(att_dict)
-
-
-    # now sort att_list by group and then by label
-    att_list.sort(key = lambda ad : (ad.get('group'), ad.get('label')))
-
     # get a list of groups for the group navigation bar
-    # if the group_list has changed (perhaps new properties with a new group has arrived)
-    # then this requires a html refresh
-    group_set = set(ad['group'] for ad in att_list)
-    group_list = sorted(group_set)
     pdict['group_list'] = group_list
-    hlist.append(group_list)
-    group = skicall.call_data.get('group')
-    # could be None, if called from the home devices page, display the first group
-    if group is None:
-        group = group_list[0]
     if group not in group_list:
         raise FailPage("The group specified has not been recognised")
     pdict['group'] = group
 
-    # record properties which are in the group being displayed
-    # If new properties appear in this group, then a html refresh is needed
-    propertygroup = []
-    for ad in att_list:
-        if att_dict['group'] == group:
-            propertygroup.append(ad['name'])
-    pdict['propertygroup'] = propertygroup
-    hlist.append(propertygroup)
-
-    # group_att_list is att_list limited to group members
-    group_att_list = []
-    for ad in att_list:
-        # loops through each property, where ad is the attribute directory of the property
-        # Only display the properties with the given group attribute
-        if group == ad['group']:
-            group_att_list.append(ad)
-
-    # a html refresh is only needed for those properties in this group which are not number vectors
-    numbervectors = []   # record properties which are numbervectors in this group
-    not_numbers  = []
-    for ad in group_att_list:
-        # loops through each property in the group, where ad is the attribute directory of the property
-        # for every property in the group_att_list, there is a list of element dictionaries which could change
-        ad["elements"] = tools.property_elements(rconn, redisserver, ad['name'], ad['device'])
-        if ad['vector'] == "NumberVector":
-            numbervectors.append(ad['name'])
-        else:
-            not_numbers.append(ad)
-    hlist.append(not_numbers)
-    # so if any of these change, which includes property attributes and elements, a full refresh is needed
-
-    pdict['numbervectors'] = numbervectors
-    # However, a number vector could have more or fewer elements, or with different names.
-    # in which case that also requires an html change
-    element_names = []
-    for ad in group_att_list:
-        # get list of element names for the given property and device
-        element_names.append( tools.elements(rconn, redisserver, ad['name'], ad['device']) )
-    hlist.append(element_names)
-
-    # temporarily set pdict['att_list'] to group_att_list so the checksum1 can be calculated
-    pdict['att_list'] = group_att_list
-
-    # create checksums from string values of pdict and hlist
+    # get last message and last device message
+    if snapshot['message']:
+        pdict['message'] = snapshot['message']
+    if snapshot['devicemessage']:
+        pdict['devicemessage'] = snapshot['devicemessage']
+
+    # only the properties of the group are shown, each in a section of the page, with the
+    # section index being the position of the property in the group, sorted by label. As
+    # any change to the properties of the group refreshes the page html, this index is
+    # stable for the json updates and form submissions made from the page
+    sections = []
+    for propertyname in snapshot['properties']:
+        # get a copy of the property attributes, as the snapshot may be shared with other requests
+        ad = dict(snapshot['attributes'][propertyname])
+        # Ensure the label is set
+        if ad.get('label') is None:
+            ad['label'] = propertyname
+        # for every property in the group, there is a list of element dictionaries
+        ad["elements"] = snapshot['elements'].get(propertyname, [])
+        sections.append(ad)
+    pdict['sections'] = sections
+    return pdict, version1, version2
 
-    # work out checksum1
-    # encode the string of pdict as binary, then create a checksum
-    bindata1 = str(pdict).encode('utf-8', errors='ignore')
-    checksum1 = adler32(bindata1)
-    # replace pdict['att_list'] as att_list
-    pdict['att_list'] = att_list
-    # work out checksum2
-    bindata2 = str(hlist).encode('utf-8', errors='ignore')
-    checksum2 = adler32(bindata2)
 
-    return pdict, checksum1, checksum2
+def _versions(skicall):
+    """Returns the tuple (version1, version2) of the device and group in call_data,
+       version1 changes if anything shown on the properties page changes,
+       version2 changes only if a html refresh of the page is needed"""
+    devicename = skicall.call_data["device"]
+    group = skicall.call_data["group"]
+    return _coalesce(skicall, ("versions", devicename, group), property_versions,
+                     skicall.proj_data["rconn"], skicall.proj_data["redisserver"], devicename, group)
 
 
 def refreshproperties(skicall):
     "Reads redis and refreshes the properties page"
     # read properties from redis
-    pdict, checksum1, checksum2 = _read_redis(skicall)
-    # set checksum's into ident_data which is sent back and can be used to check if the page has changed
-    skicall.call_data["checksum1"] = checksum1
-    skicall.call_data["checksum2"] = checksum2
+    pdict, version1, version2 = _read_redis(skicall)
+    # set versions into ident_data which is sent back and can be used to check if the page has changed
+    skicall.call_data["version1"] = version1
+    skicall.call_data["version2"] = version2
     skicall.page_data['devicename', 'large_text'] = pdict['devicename']
     rconn = skicall.proj_data["rconn"]
     redisserver = skicall.proj_data["redisserver"]
@@ -317,10 +331,9 @@ def refreshproperties(skicall):
         skicall.page_data['message', 'para_text'] = pdict['message']
     if 'devicemessage' in pdict:
         skicall.page_data['devicemessage','para_text'] = pdict['devicemessage']
-    # properties is a list of properties for the given device
-    # create a section for each property, and fill it in
-    properties = pdict['properties']
-    skicall.page_data['property','multiplier'] = len(properties)
+    # create a section for each property of the group, and fill it in
+    sections = pdict['sections']
+    skicall.page_data['property','multiplier'] = len(sections)
     group = pdict['group']
     skicall.call_data["group"] = group
     link_classes = []
@@ -337,17 +350,10 @@ def refreshproperties(skicall):
     skicall.page_data['navlinks', 'button_classes'] = link_classes
     skicall.page_data['navlinks', 'button_text'] = link_buttons
     skicall.page_data['navlinks', 'get_field1'] = link_getfields
-    att_list = pdict['att_list']
-    for index, ad in enumerate(att_list):
-        # loops through each property, where ad is the attribute directory of the property
-        # and index is the section index on the web page
-        # Only display the properties with the given group attribute
-        if group == ad['group']:
-            skicall.page_data['property_'+str(index),'show'] = True
-        else:
-            skicall.page_data['property_'+str(index),'show'] = False
-            # This property is not being shown on the page, so continue
-            continue
+    for index, ad in enumerate(sections):
+        # loops through each property of the group, where ad is the attribute directory of
+        # the property and index is the section index on the web page
+        skicall.page_data['property_'+str(index),'show'] = True
         # and display the property
         if ad['vector'] == "TextVector":
             _show_textvector(skicall, index, ad)
@@ -789,26 +795,25 @@ def _show_lightvector(skicall, index, ad):
     # set the state, one of Idle, OK, Busy and Alert
     set_state(skicall, index, ad)
 
-    rconn = skicall.proj_data["rconn"]
-    redisserver = skicall.proj_data["redisserver"]
-    element_list = ad["elements"]
-    if not element_list:
-        return
     # No permission value for lightvectors
     # display label : value in a table
-    skicall.page_data['property_'+str(index),'lvelements', 'titles'] = ["", "State"]
-    contents = []
+    skicall.page_data['property_'+str(index),'lvelements', 'set_html'] = _lights_html(ad["elements"])
+
+
+def _lights_html(element_list):
+    """Returns the html table of the element labels and their lights, set into a DivHTML widget
+       so a change of light can be shown by a json update"""
+    if not element_list:
+        return ""
+    rows = []
     for eld in element_list:
-        contents.append([eld['label'] + ":", "black", ""]) # pale yellow is "#ffffcc"
-        if eld['value'] == "Idle":
-            contents.append([eld['value'], "white", "grey"])
-        if eld['value'] == "Ok":
-            contents.append([eld['value'], "white", "green"])
-        if eld['value'] == "Busy":
-            contents.append([eld['value'], "black", "yellow"])
-        if eld['value'] == "Alert":
-            contents.append([eld['value'], "white", "red"])
-    skicall.page_data['property_'+str(index),'lvelements', 'contents'] = contents
+        colours = _LIGHTS.get(eld['value'])
+        if colours is None:
+            light = '<td>' + escape(eld['value']) + '</td>'
+        else:
+            light = '<td style="color:{};background-color:{};">{}</td>'.format(colours[0], colours[1], escape(eld['value']))
+        rows.append('<tr><td>' + escape(eld['label']) + ':</td>' + light + '</tr>')
+    return '<table class="w3-table w3-bordered w3-centered">' + "".join(rows) + '</table>'
 
 
 
@@ -853,6 +858,7 @@ def _show_blobvector(skicall, index, ad):
     element_list = ad["elements"]
     if not element_list:
         return
+    blobfiles = _blob_files(skicall, element_list)
     # permission is one of ro, wo, rw
     if ad['perm'] == "wo":
         # permission is write only
@@ -890,6 +896,9 @@ def _show_blobvector(skicall, index, ad):
         # permission is read write
         skicall.page_data['modalupload', 'show'] = True
         skicall.page_data['modalupload', 'hide'] = True
+        # display label : link to the received file in a table, followed by a table of upload buttons
+        skicall.page_data['property_'+str(index),'bvlinks', 'show'] = True
+        skicall.page_data['property_'+str(index),'bvlinks', 'set_html'] = _blob_links_html(skicall, element_list, blobfiles)
         skicall.page_data['property_'+str(index),'bvwelements', 'show'] = True
         col1 = []
         col2 = []
@@ -898,25 +907,8 @@ def _show_blobvector(skicall, index, ad):
         col2_getfields = []
         link_classes = []
         link_styles = []
-        # note, there are two rows of the table for each element, one for received data, and one for the upload button
         for eld in element_list:
-            # 1st row
-            col1.append(eld['label'] + ":")
-            if eld['filepath']:
-                path = pathlib.Path(eld['filepath'])
-                col2.append(path.name)
-                blobpath = skicall.makepath("blobs", path.name)
-                col2_link_idents.append(blobpath)
-            else:
-                col2.append("")
-                col2_link_idents.append("")
-            # no json or get field in first row
-            col2_json_idents.append("")
-            col2_getfields.append("")
-            link_classes.append('')
-            link_styles.append('')
-            # 2nd row
-            col1.append("Send a file to the instrument:")
+            col1.append("Send " + eld['label'] + " to the instrument:")
             col2.append("Upload File")
             col2_link_idents.append("no_javascript")
             col2_json_idents.append("show_modalupload")
@@ -932,29 +924,60 @@ def _show_blobvector(skicall, index, ad):
         skicall.page_data['property_'+str(index),'bvwelements', 'col2_getfields'] = col2_getfields
         skicall.page_data['property_'+str(index),'bvwelements', 'link_classes'] = link_classes
         skicall.page_data['property_'+str(index),'bvwelements', 'link_styles'] = link_styles
-        # take off the border at the bottem of every row
-        skicall.page_data['property_'+str(index),'bvwelements', 'widget_class'] = "w3-table w3-centered"
-        # and add it, just for even rows
-        skicall.page_data['property_'+str(index),'bvwelements', 'even_class'] = "w3-border-bottom"
+        _show_preview(skicall, index, element_list, blobfiles)
     else:
         # permission is read only
-        # display label : filepath in a table
-        skicall.page_data['property_'+str(index),'bvelements', 'show'] = True
-        col1 = []
-        col2 = []
-        col2_links = []
-        for eld in element_list:
-            col1.append(eld['label'] + ":")
-            if eld['filepath']:
-                path = pathlib.Path(eld['filepath'])
-                col2.append(path.name)
-                blobpath = skicall.makepath("blobs", path.name)
-                col2_links.append(blobpath)
-        skicall.page_data['property_'+str(index),'bvelements', 'col1'] = col1
-        if col2:
-            skicall.page_data['property_'+str(index),'bvelements', 'col2'] = col2
-        if col2_links:
-            skicall.page_data['property_'+str(index),'bvelements', 'col2_links'] = col2_links
+        # display label : link to the received file in a table
+        skicall.page_data['property_'+str(index),'bvlinks', 'show'] = True
+        skicall.page_data['property_'+str(index),'bvlinks', 'set_html'] = _blob_links_html(skicall, element_list, blobfiles)
+        _show_preview(skicall, index, element_list, blobfiles)
+
+
+def _blob_links_html(skicall, element_list, blobfiles):
+    """Returns the html table of the element labels and links to their received files, set into
+       a DivHTML widget so a newly received file can be shown by a json update"""
+    rows = []
+    for eld in element_list:
+        if eld['filepath']:
+            filename = pathlib.Path(eld['filepath']).name
+            blobpath = skicall.makepath("blobs", quote(blobfiles[filename]))
+            link = '<a href="' + escape(blobpath) + '">' + escape(filename) + '</a>'
+        else:
+            link = ''
+        rows.append('<tr><td>' + escape(eld['label']) + ':</td><td>' + link + '</td></tr>')
+    return '<table class="w3-table w3-bordered w3-centered">' + "".join(rows) + '</table>'
+
+
+def _blob_files(skicall, element_list):
+    "Returns a dictionary of the file names of the elements to their paths within the blob folder"
+    filenames = [pathlib.Path(eld['filepath']).name for eld in element_list if eld['filepath']]
+    if skicall.proj_data["blob_layout"] == SHARDED:
+        # the files have been moved to shard folders
+        return dict(zip(filenames, blob_paths(skicall.proj_data["rconn"], skicall.proj_data["redisserver"], filenames)))
+    return {filename:filename for filename in filenames}
+
+
+def _show_preview(skicall, index, element_list, blobfiles):
+    "Shows the preview of the first received file of the blob vector which has one, linked to the file"
+    skicall.page_data['property_'+str(index),'bvpreview', 'show'] = True
+    skicall.page_data['property_'+str(index),'bvpreview', 'set_html'] = _preview_html(skicall, element_list, blobfiles)
+
+
+def _preview_html(skicall, element_list, blobfiles):
+    """Returns the html of the preview image linked to its file, or an empty string if no received
+       file has a preview, set into a DivHTML widget so a new preview can be shown by a json update"""
+    previews = skicall.proj_data["previews"]
+    for eld in element_list:
+        if not eld['filepath']:
+            continue
+        filename = pathlib.Path(eld['filepath']).name
+        previewname = previews.preview_name(filename)
+        if previewname is None:
+            continue
+        previewpath = skicall.makepath("previews", quote(previewname))
+        blobpath = skicall.makepath("blobs", quote(blobfiles[filename]))
+        return '<a href="' + escape(blobpath) + '"><img src="' + escape(previewpath) + '" alt="' + escape(filename) + '" /></a>'
+    return ""
 
 
 def show_modalupload(skicall):
@@ -988,41 +1011,58 @@ def show_modalupload(skicall):
 
 
 
+def _compression_status(skicall):
+    "Shows the status of compressed uploads to the device, which have completed since the last update"
+    client = client_key(skicall)
+    if client is None:
+        # this browser has not submitted a file for compression
+        return
+    status = skicall.proj_data["compression"].pop_status(client, skicall.call_data['device'])
+    if status:
+        skicall.call_data["status"] = status
+
+
 def check_for_device_change(skicall):
     """Called to update the properties page, which should occur every ten seconds"""
     # The page which has called for this update shows all the properties in
-    # a particular group, and the device, group and checksums should all be present
+    # a particular group, and the device, group and versions should all be present
     # in call_data
     if (('device' not in skicall.call_data) or
         ('group' not in skicall.call_data) or
-        ('checksum1' not in skicall.call_data) or
-        ('checksum2' not in skicall.call_data)):
+        ('version1' not in skicall.call_data) or
+        ('version2' not in skicall.call_data)):
         # something wrong, divert to the home page
         skicall.page_data['JSONtoHTML'] = 'home'
         return
-    rconn = skicall.proj_data["rconn"]
-    redisserver = skicall.proj_data["redisserver"]
-    try:
-        pdict, checksum1, checksum2 = _read_redis(skicall)
-    except FailPage:
-        skicall.page_data['JSONtoHTML'] = 'home'
-        return
-
-    devicename = pdict["devicename"]
-    if (checksum1 == skicall.call_data['checksum1']) and (checksum2 == skicall.call_data['checksum2']):
-        # generated checksums are equal to the received checksums so
-        # no update required
+    version1, version2 = _versions(skicall)
+    if (version1 == skicall.call_data['version1']) and (version2 == skicall.call_data['version2']):
+        # versions are equal to the received versions so
+        # no update required, other than showing any compressed uploads sent
+        _compression_status(skicall)
         return
 
     # so an update is needed, it could be a whole page html, or just those items which can be changed by json
-    # if checksum2 is unchanged, this means those items requiring a whole page refresh (groups, propertynames)
+    # if version2 is unchanged, this means those items requiring a whole page refresh (groups, propertynames)
     # are unchanged, and therefore only a json refresh is needed
 
-    if checksum2 != skicall.call_data['checksum2']:
+    if version2 != skicall.call_data['version2']:
         # the whole page needs refreshing, request the browser to make an html call
         skicall.page_data['JSONtoHTML'] = 'refreshproperties'
         return
 
+    try:
+        pdict, version1, version2 = _read_redis(skicall)
+    except FailPage:
+        skicall.page_data['JSONtoHTML'] = 'home'
+        return
+
+    if version2 != skicall.call_data['version2']:
+        # the page structure changed since the versions were read
+        skicall.page_data['JSONtoHTML'] = 'refreshproperties'
+        return
+
+    _compression_status(skicall)
+
     #############################################################################################################
     # To reach this point, only those items which can be updated by json have changed, therefore do a json update
 
@@ -1031,55 +1071,137 @@ def check_for_device_change(skicall):
     if 'devicemessage' in pdict:
         skicall.page_data['devicemessage','para_text'] = pdict['devicemessage']
 
-    numbervectors = pdict['numbervectors']   # properties which are numbervectors
-    att_list = pdict['att_list']             # property attributes - used to sort properties on the page
-
-    # numbervectors are treated different to other vectors - they will have a json page update
-    # whereas all other property changes will cause a full page refresh
+    sections = pdict['sections']             # properties of the group, in the order of the page sections
 
-    # refresh numbervectors in this group only
+    # the property cache only leaves version2 unchanged if the properties and their elements
+    # are as shown on the page, so each section is updated in place with its current values
 
-    for index, ad in enumerate(att_list):
+    for index, ad in enumerate(sections):
         # loops through each property, where ad is the attribute directory of the property
         # and index is the section index on the web page
-        propertyname = ad['name']
-        if propertyname not in numbervectors:
-            continue
-
-        # set the change into page data
-        # items which may have changed:
-        #            state
-        #            timeout
-        #            timestamp
-        #            message
-        #            elements:{name:number,...}
-
-        # set the state, one of Idle, OK, Busy and Alert
+        # items which may have changed are the state, timeout, timestamp, message and element values
         set_state(skicall, index, ad)
-        skicall.page_data['property_'+str(index),'nvtable', 'col2'] = [ ad['perm'], ad['timeout'], ad['timestamp']]
         skicall.page_data['property_'+str(index),'propertyname', 'small_text'] = ad['message']
+        if ad['vector'] == "TextVector":
+            _update_textvector(skicall, index, ad)
+        elif ad['vector'] == "NumberVector":
+            _update_numbervector(skicall, index, ad)
+        elif ad['vector'] == "SwitchVector":
+            _update_switchvector(skicall, index, ad)
+        elif ad['vector'] == "LightVector":
+            _update_lightvector(skicall, index, ad)
+        elif ad['vector'] == "BLOBVector":
+            _update_blobvector(skicall, index, ad)
 
-        element_list = ad["elements"]
-        if not element_list:
-            continue
-        # permission is one of ro, wo, rw
-        if ad['perm'] == "wo":
-            continue             # if write only, should be no change from indiserver to display
-        elif ad['perm'] == "rw":
-            # permission is rw, number displayed updated, but not number in the input field as
-            # this interfers with the users typing in a new number
-            col2 = []
-            for eld in element_list:
-                col2.append(eld['formatted_number'])
-            skicall.page_data['property_'+str(index),'nvinputtable', 'col2'] = col2
+    # as this new data is inserted into the page, the page now shows version1
+
+    skicall.call_data['version1'] = version1
+
+
+
+def _update_textvector(skicall, index, ad):
+    """Sets the json update of a text vector shown by _show_textvector
+       ad is the attribute directory of the property
+       index is the section index on the web page"""
+    skicall.page_data['property_'+str(index),'tvtable', 'col2'] = [ ad['perm'], ad['timeout'], ad['timestamp']]
+    element_list = ad["elements"]
+    if (not element_list) or (ad['perm'] == "wo"):
+        # if write only, should be no change from indiserver to display
+        return
+    col2 = [eld['value'] for eld in element_list]
+    if ad['perm'] == "rw":
+        # the text displayed is updated, but not the input field as this
+        # interfers with the users typing in a new value
+        skicall.page_data['property_'+str(index),'tvtexttable', 'col2'] = col2
+    else:
+        skicall.page_data['property_'+str(index),'tvelements', 'col2'] = col2
+
+
+def _update_numbervector(skicall, index, ad):
+    """Sets the json update of a number vector shown by _show_numbervector
+       ad is the attribute directory of the property
+       index is the section index on the web page"""
+    skicall.page_data['property_'+str(index),'nvtable', 'col2'] = [ ad['perm'], ad['timeout'], ad['timestamp']]
+    element_list = ad["elements"]
+    if (not element_list) or (ad['perm'] == "wo"):
+        # if write only, should be no change from indiserver to display
+        return
+    col2 = [eld['formatted_number'] for eld in element_list]
+    if ad['perm'] == "rw":
+        # permission is rw, number displayed updated, but not number in the input field as
+        # this interfers with the users typing in a new number
+        skicall.page_data['property_'+str(index),'nvinputtable', 'col2'] = col2
+    else:
+        skicall.page_data['property_'+str(index),'nvelements', 'col2'] = col2
+
+
+def _update_switchvector(skicall, index, ad):
+    """Sets the json update of a switch vector shown by _show_switchvector
+       ad is the attribute directory of the property
+       index is the section index on the web page"""
+    skicall.page_data['property_'+str(index),'svtable', 'col2'] = [ ad['rule'], ad['perm'], ad['timeout'], ad['timestamp']]
+    element_list = ad["elements"]
+    if (not element_list) or (ad['perm'] == "wo"):
+        # if write only, should be no change from indiserver to display
+        return
+    if ad['perm'] != "rw":
+        # permission is ro
+        skicall.page_data['property_'+str(index),'svelements', 'col2'] = [eld['value'] for eld in element_list]
+        return
+    # permission is rw, highlight the switches which are On, and check them
+    row_classes = ['w3-yellow' if eld['value'] == "On" else '' for eld in element_list]
+    checked = [eld['name'] for eld in element_list if eld['value'] == "On"]
+    if len(element_list) == 1:
+        # only one element, shown as an on/off choice
+        eld = element_list[0]
+        if checked:
+            skicall.page_data['property_'+str(index),'svradio', 'radio_checked'] = eld['name'] + "_on"
+            skicall.page_data['property_'+str(index),'svradio', 'row_classes'] = ['w3-yellow', '']
         else:
-            # permission is ro
-            col2 = []
-            for eld in element_list:
-                col2.append(eld['formatted_number'])
-            skicall.page_data['property_'+str(index),'nvelements', 'col2'] = col2
+            skicall.page_data['property_'+str(index),'svradio', 'radio_checked'] = eld['name'] + "_off"
+            skicall.page_data['property_'+str(index),'svradio', 'row_classes'] = ['', 'w3-yellow']
+    elif ad['rule'] == "OneOfMany":
+        skicall.page_data['property_'+str(index),'svradio', 'row_classes'] = row_classes
+        if checked:
+            skicall.page_data['property_'+str(index),'svradio', 'radio_checked'] = checked[0]
+    elif ad['rule'] == "AnyOfMany":
+        skicall.page_data['property_'+str(index),'svcheckbox', 'row_classes'] = row_classes
+        skicall.page_data['property_'+str(index),'svcheckbox', 'checked'] = checked
+    elif ad['rule'] == "AtMostOne":
+        # with the 'None of the above' button as the last row
+        if checked:
+            row_classes.append('')
+            skicall.page_data['property_'+str(index),'svradio', 'radio_checked'] = checked[0]
+        else:
+            row_classes.append('w3-yellow')
+            skicall.page_data['property_'+str(index),'svradio', 'radio_checked'] = "noneoftheabove"
+        skicall.page_data['property_'+str(index),'svradio', 'row_classes'] = row_classes
 
-    # as this new data is inserted into the page, the page data should now have the same
-    # checksums as the generated checksums
 
-    skicall.call_data['checksum1'] = checksum1
+def _update_lightvector(skicall, index, ad):
+    """Sets the json update of a light vector shown by _show_lightvector
+       ad is the attribute directory of the property
+       index is the section index on the web page"""
+    skicall.page_data['property_'+str(index),'lvtable', 'col2'] = [ ad['group'], ad['timestamp']]
+    skicall.page_data['property_'+str(index),'lvelements', 'set_html'] = _lights_html(ad["elements"])
+
+
+def _update_blobvector(skicall, index, ad):
+    """Sets the json update of a blob vector shown by _show_blobvector
+       ad is the attribute directory of the property
+       index is the section index on the web page"""
+    if ad['perm'] == "wo":
+        skicall.page_data['property_'+str(index),'bvtable', 'col2'] = [ ad['perm'], ad['timeout'], ad['timestamp']]
+        return
+    skicall.page_data['property_'+str(index),'bvtable', 'col2'] = [ ad['perm'], ad['timeout'], ad['timestamp'], ad['blobs']]
+    if ad["elements"]:
+        blobfiles = _blob_files(skicall, ad["elements"])
+        skicall.page_data['property_'+str(index),'bvlinks', 'set_html'] = _blob_links_html(skicall, ad["elements"], blobfiles)
+        skicall.page_data['property_'+str(index),'bvpreview', 'set_html'] = _preview_html(skicall, ad["elements"], blobfiles)
+    # set the enableblob button
+    if ad['blobs'] == "Enabled":
+        skicall.page_data['property_'+str(index), 'enableblob', 'button_text'] = "Disable"
+        skicall.page_data['property_'+str(index), 'enableblob', 'get_field1'] = _safekey(ad['name'] + "\nDisable")
+    else:
+        skicall.page_data['property_'+str(index), 'enableblob', 'button_text'] = "Enable"
+        skicall.page_data['property_'+str(index), 'enableblob', 'get_field1'] = _safekey(ad['name'] + "\nEnable")
@@ -0,0 +1,111 @@
+
+"""A WSGI application serving a Server-Sent Events stream of device changes.
+
+Each event has the name 'change' and data of a JSON object with keys 'device', 'property'
+and 'tag', where tag is the INDI element received, such as setNumberVector. The device
+is null for system messages, and for a tag of 'load' or 'reload', which indicate every
+device should be refreshed. If the query string has a device parameter, only events
+for that device, and those with a null device, are sent.
+
+With a threaded web server each stream holds a thread, so the number of concurrent
+streams is limited, further requests receive 503 Service Unavailable, and the page
+script then falls back to polling.
+"""
+
+import json, threading
+
+from time import monotonic
+
+from urllib.parse import parse_qs
+
+
+# seconds between keepalive comments, which detect closed connections
+KEEPALIVE = 15
+
+# seconds after which a stream is closed, the browser then reconnects with the Last-Event-ID
+# header, this limits the time a thread is held by a client which has gone away
+MAXAGE = 300
+
+
+class EventStream():
+    "WSGI application streaming changes recorded by the DeviceCache"
+
+    def __init__(self, propertycache, max_streams):
+        self.propertycache = propertycache
+        self.max_streams = max_streams
+        self.streams = 0
+        self._lock = threading.Lock()
+
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            if self.streams >= self.max_streams:
+                start_response('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Retry-After', '60')])
+                return [b"Too many event streams"]
+            self.streams += 1
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        device = query.get('device', [None])[0]
+        try:
+            lastid = int(environ.get('HTTP_LAST_EVENT_ID', ''))
+        except ValueError:
+            lastid = None
+        start_response('200 OK', [('Content-Type', 'text/event-stream'),
+                                  ('Cache-Control', 'no-cache'),
+                                  ('X-Accel-Buffering', 'no')])
+        return _Response(self._stream(device, lastid), self._release)
+
+
+    def _release(self):
+        "Called when a stream is closed"
+        with self._lock:
+            self.streams -= 1
+
+
+    def _stream(self, device, lastid):
+        "Generator yielding the event stream"
+        yield b"retry: 5000\n\n"
+        sequence = self.propertycache.sequence
+        if (lastid is not None) and (lastid != sequence):
+            if lastid > sequence:
+                # the id is from before a restart, so changes may have been missed
+                yield _event(sequence, "reload", None, None)
+            else:
+                # send changes made while the client was reconnecting
+                sequence = lastid
+        end = monotonic() + MAXAGE
+        while monotonic() < end:
+            events = self.propertycache.wait_for_events(sequence, KEEPALIVE)
+            if events is None:
+                # changes have been lost, the page must refresh
+                sequence = self.propertycache.sequence
+                yield _event(sequence, "reload", None, None)
+                continue
+            if not events:
+                yield b": keepalive\n\n"
+                continue
+            for sequence, tag, devicename, propertyname in events:
+                if device and devicename and (devicename != device):
+                    continue
+                yield _event(sequence, tag, devicename, propertyname)
+
+
+class _Response():
+    """The WSGI iterable, the server calls close() when the stream ends or the
+       client disconnects, even if iteration has not started"""
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        return self.stream
+
+    def close(self):
+        self.stream.close()
+        self.release()
+
+
+def _event(sequence, tag, devicename, propertyname):
+    "Returns bytes of a change event"
+    data = json.dumps({'device':devicename, 'property':propertyname, 'tag':tag})
+    return f"id: {sequence}\nevent: change\ndata: {data}\n\n".encode('utf-8')
@@ -0,0 +1,110 @@
+
+"""An index of the properties of each device by group, so a group can be read alone.
+
+Redis keys, prefixed by redisserver.keyprefix, are
+
+groups:devicename                 - sorted set of the group names of the device, all scored
+                                    zero so they are in name order
+groupproperties:group:devicename  - sorted set of "label\\0propertyname" of the properties
+                                    of the group, all scored zero so they are in label order
+groupindex:devicename             - hash of propertyname:"group\\0label", so a property
+                                    can be removed from its group
+
+The index is kept by the property cache, which updates it as def vectors and delProperty
+messages change the group or label of a property, and rebuilds it when a device is loaded.
+snapshot.read_group reads a group using the index, and falls back to reading the whole
+device if the index does not cover every property of the device.
+"""
+
+
+# removes the property ARGV[3] of device ARGV[2] from its group, must be run before the
+# property is added again, ARGV[1] is the key prefix
+_REMOVE = """
+local function remove(prefix, device, name)
+    local indexkey = prefix .. 'groupindex:' .. device
+    local old = redis.call('HGET', indexkey, name)
+    if not old then
+        return
+    end
+    local sep = string.find(old, '\\0', 1, true)
+    local oldgroup = string.sub(old, 1, sep - 1)
+    local oldlabel = string.sub(old, sep + 1)
+    local propertieskey = prefix .. 'groupproperties:' .. oldgroup .. ':' .. device
+    redis.call('ZREM', propertieskey, oldlabel .. '\\0' .. name)
+    if redis.call('ZCARD', propertieskey) == 0 then
+        redis.call('ZREM', prefix .. 'groups:' .. device, oldgroup)
+    end
+    redis.call('HDEL', indexkey, name)
+end
+"""
+
+# sets property ARGV[3] of device ARGV[2] into group ARGV[4] with label ARGV[5]
+_SET_SCRIPT = _REMOVE + """
+local prefix, device, name, group, label = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local entry = group .. '\\0' .. label
+if redis.call('HGET', prefix .. 'groupindex:' .. device, name) == entry then
+    return 0
+end
+remove(prefix, device, name)
+redis.call('HSET', prefix .. 'groupindex:' .. device, name, entry)
+redis.call('ZADD', prefix .. 'groupproperties:' .. group .. ':' .. device, 0, label .. '\\0' .. name)
+redis.call('ZADD', prefix .. 'groups:' .. device, 0, group)
+return 1
+"""
+
+# removes property ARGV[3] of device ARGV[2]
+_REMOVE_SCRIPT = _REMOVE + """
+remove(ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# deletes the index of device ARGV[2]
+_CLEAR_SCRIPT = """
+local prefix, device = ARGV[1], ARGV[2]
+local groupskey = prefix .. 'groups:' .. device
+for i, group in ipairs(redis.call('ZRANGE', groupskey, 0, -1)) do
+    redis.call('DEL', prefix .. 'groupproperties:' .. group .. ':' .. device)
+end
+redis.call('DEL', groupskey, prefix .. 'groupindex:' .. device)
+"""
+
+
+def _group_label(propertyname, att_dict):
+    "Returns the (group, label) of a property, the label defaulting to the property name"
+    label = att_dict.get('label')
+    if label is None:
+        label = propertyname
+    return att_dict.get('group', ''), label
+
+
+def set_property(rconn, redisserver, devicename, propertyname, att_dict, pipe=None):
+    "Sets the property, with the given attribute dictionary, into the index of its group"
+    group, label = _group_label(propertyname, att_dict)
+    script = rconn.register_script(_SET_SCRIPT)
+    script(args=[redisserver.keyprefix, devicename, propertyname, group, label], client=pipe)
+
+
+def remove_property(rconn, redisserver, devicename, propertyname):
+    "Removes the property from the index"
+    script = rconn.register_script(_REMOVE_SCRIPT)
+    script(args=[redisserver.keyprefix, devicename, propertyname])
+
+
+def rebuild_device(rconn, redisserver, devicename, attributes):
+    """Replaces the index of the device, given the dictionary of propertyname:attribute
+       dictionary of all its properties, which is empty if the device has been deleted"""
+    clear = rconn.register_script(_CLEAR_SCRIPT)
+    pipe = rconn.pipeline()
+    clear(args=[redisserver.keyprefix, devicename], client=pipe)
+    for propertyname, att_dict in attributes.items():
+        set_property(rconn, redisserver, devicename, propertyname, att_dict, pipe)
+    pipe.execute()
+
+
+def order_groups(attributes):
+    """Given a dictionary of propertyname:attribute dictionary, returns a dictionary of
+       group:list of property names, sorted by label, in the order of the index"""
+    groups = {}
+    for propertyname in sorted(attributes):
+        group, label = _group_label(propertyname, attributes[propertyname])
+        groups.setdefault(group, []).append((label, propertyname))
+    return {group:[propertyname for label, propertyname in sorted(names)] for group, names in groups.items()}
@@ -0,0 +1,187 @@
+
+"""Measures the redis calls and the time taken by each web request.
+
+RedisMeter.instrument replaces the connection class of the redis connection pool by one
+which, for the request being served by the current thread, counts the commands sent, the
+round trips and the bytes sent, and times the waits for replies. Each request is timed from
+the start_call to the end_call of the skipole application, and if it takes longer than the
+slow request threshold, a line is written to the slow request log. If a Metrics object is
+given, each request, and every redis command and round trip, including those made outside
+requests, is also added to it.
+
+A coalesced read, shared by concurrent requests, is counted against the request which made it.
+"""
+
+import sys, threading
+
+from collections import Counter
+from datetime import datetime
+from time import perf_counter
+
+
+class RequestStats():
+    "The redis usage and duration of a request"
+
+    def __init__(self, path, ident):
+        self.path = path
+        # the skipole page ident number called, or None
+        self.ident = ident
+        self.started = perf_counter()
+        self.seconds = 0.0
+        # Counter of command name:number sent
+        self.commands = Counter()
+        self.round_trips = 0
+        self.bytes = 0
+        # seconds spent sending to, and waiting for, redis
+        self.redis_seconds = 0.0
+
+    def line(self):
+        "Returns the stats as a line of the slow request log"
+        commands = " ".join(f"{name}:{count}" for name, count in self.commands.most_common())
+        return (f"{datetime.now().isoformat(timespec='seconds')} {self.path} ident {self.ident} {self.seconds*1000:.1f} ms, "
+                f"redis {sum(self.commands.values())} commands {self.round_trips} round trips "
+                f"{self.bytes} bytes {self.redis_seconds*1000:.1f} ms {commands}")
+
+
+def _command_name(args):
+    "Returns the lower case name of a command, given the command arguments"
+    if not args:
+        return ''
+    name = args[0]
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    return str(name).lower()
+
+
+class RedisMeter():
+    """Records the redis usage of the request being served by each thread, and writes requests
+       taking longer than slow_request milliseconds to slow_log, or to stderr if slow_log is
+       not given. If slow_request is zero, no log is written. If metrics is given, it is a
+       webcode.metrics.Metrics object to which requests and redis commands are added"""
+
+    def __init__(self, slow_request=0, slow_log='', metrics=None):
+        self.slow_request = slow_request
+        self.slow_log = slow_log
+        self.metrics = metrics
+        self._local = threading.local()
+        self._loglock = threading.Lock()
+
+    def instrument(self, rconn):
+        """Replaces the connection class of the connection pool of rconn by one recording
+           its use, this should be called before rconn is used"""
+        pool = rconn.connection_pool
+        pool.connection_class = _metered_class(pool.connection_class, self)
+        # discard any connections already made with the original class
+        pool.reset()
+        return rconn
+
+    def current(self):
+        "Returns the RequestStats of the request served by this thread, or None"
+        return getattr(self._local, 'stats', None)
+
+    def begin(self, path, ident=None):
+        "Starts recording a request for the given path and page ident, served by this thread"
+        self._local.stats = RequestStats(path, ident)
+
+    def end(self):
+        "Stops recording the request served by this thread, and returns its RequestStats or None"
+        stats = self.current()
+        if stats is None:
+            return
+        self._local.stats = None
+        stats.seconds = perf_counter() - stats.started
+        if self.metrics is not None:
+            self.metrics.request(stats.ident, stats.seconds)
+        if self.slow_request and (stats.seconds * 1000 > self.slow_request):
+            self._log(stats.line())
+        return stats
+
+    def _log(self, line):
+        with self._loglock:
+            if not self.slow_log:
+                print(line, file=sys.stderr)
+                return
+            try:
+                with open(self.slow_log, 'a') as f:
+                    print(line, file=f)
+            except OSError:
+                # a log which cannot be written must not fail the request
+                pass
+
+    def _commands(self, names):
+        if self.metrics is not None:
+            self.metrics.commands(names)
+        stats = self.current()
+        if stats is not None:
+            stats.commands.update(names)
+
+    def _sent(self, command, seconds):
+        stats = self.current()
+        if stats is None:
+            return
+        stats.round_trips += 1
+        if isinstance(command, (bytes, bytearray, memoryview)):
+            stats.bytes += len(command)
+        else:
+            stats.bytes += sum(len(item) for item in command)
+        stats.redis_seconds += seconds
+
+    def _waited(self, seconds):
+        stats = self.current()
+        if stats is not None:
+            stats.redis_seconds += seconds
+
+    def _round_trip(self, seconds):
+        if self.metrics is not None:
+            self.metrics.round_trip(seconds)
+
+
+def _metered_class(base, meter):
+    "Returns a subclass of the redis connection class base, reporting its use to meter"
+
+    class MeteredConnection(base):
+
+        # number of replies awaited, so a pub/sub connection waiting for messages is not timed
+        _awaiting = 0
+        # time the last commands were sent
+        _sent_at = 0.0
+
+        def send_command(self, *args, **kwargs):
+            meter._commands([_command_name(args)])
+            self._awaiting += 1
+            return super().send_command(*args, **kwargs)
+
+        def pack_commands(self, commands):
+            # the commands of a pipeline, sent as a single round trip
+            commands = list(commands)
+            meter._commands([_command_name(args) for args in commands])
+            self._awaiting += len(commands)
+            return super().pack_commands(commands)
+
+        def send_packed_command(self, command, check_health=True):
+            start = self._sent_at = perf_counter()
+            try:
+                return super().send_packed_command(command, check_health)
+            finally:
+                meter._sent(command, perf_counter() - start)
+
+        def read_response(self, *args, **kwargs):
+            if self._awaiting <= 0:
+                return super().read_response(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return super().read_response(*args, **kwargs)
+            finally:
+                self._awaiting -= 1
+                end = perf_counter()
+                meter._waited(end - start)
+                if not self._awaiting:
+                    # the last reply of the round trip
+                    meter._round_trip(end - self._sent_at)
+
+        def disconnect(self, *args, **kwargs):
+            self._awaiting = 0
+            return super().disconnect(*args, **kwargs)
+
+    MeteredConnection.__name__ = "Metered" + base.__name__
+    return MeteredConnection
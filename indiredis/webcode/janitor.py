@@ -0,0 +1,158 @@
+
+"""Deletes the oldest BLOB files when the blob folder exceeds its retention limits.
+
+The limits are a maximum total size, a maximum age and a maximum number of files. Files
+whose names match a protected pattern are never deleted. Rather than listing the folder,
+the janitor reads the oldest files from the blob index, which holds their times and sizes,
+counting contents hard linked by webcode.dedup once, and deletes at most BATCH files every
+INTERVAL seconds, so the work is spread out. Protected files at the oldest end of the index
+are passed over by a cursor, rather than read again on every check, and the preview of
+each file deleted is deleted with it.
+"""
+
+import threading, fnmatch
+
+from collections import namedtuple
+
+from time import time, sleep
+
+from .blobindex import remove_blob, forget_blob, blob_usage
+from .layout import prune_folders
+
+
+# seconds between each check of the limits
+INTERVAL = 60
+
+# maximum number of files deleted at each check
+BATCH = 100
+
+
+BlobRetention = namedtuple('BlobRetention', ['max_bytes', 'max_age', 'max_count', 'protected'])
+
+
+def blob_retention(max_bytes=0, max_age=0, max_count=0, protected=()):
+    """Creates a named tuple describing the limits of the blob folder, a zero value
+    meaning no limit.
+
+    :param max_bytes: Maximum total size of the files
+    :type max_bytes: Integer
+    :param max_age: Maximum age of a file in seconds
+    :type max_age: Float
+    :param max_count: Maximum number of files
+    :type max_count: Integer
+    :param protected: Glob patterns, such as '*.cfg', of file names which are never deleted,
+                      matched against the file name without the folders of a sharded layout
+    :type protected: Sequence of strings
+    :return: A named tuple with above parameters as named elements
+    :rtype: collections.namedtuple
+    """
+    return BlobRetention(max_bytes, max_age, max_count, tuple(protected))
+
+
+class BlobJanitor():
+    "Runs a thread deleting the oldest files of blob_folder beyond the limits of retention"
+
+    def __init__(self, rconn, redisserver, blob_folder, retention, previews=None):
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.blob_folder = blob_folder
+        self.retention = retention
+        # the PreviewMaker, whose previews of deleted files are deleted
+        self.previews = previews
+        # every file in the index scored below the cursor is protected, and skipped is the
+        # number of them, so a change shows older files have been added or removed
+        self._cursor = '-inf'
+        self._skipped = 0
+
+
+    def start(self):
+        "Starts the janitor thread, if there are limits to apply"
+        if not self.blob_folder:
+            return
+        if not (self.retention.max_bytes or self.retention.max_age or self.retention.max_count):
+            return
+        thread = threading.Thread(target=self._run, name="indiredis_janitor", daemon=True)
+        thread.start()
+
+
+    def _run(self):
+        while True:
+            sleep(INTERVAL)
+            try:
+                self.clean()
+            except Exception:
+                # redis unavailable, try again at the next interval
+                pass
+
+
+    def _protected(self, name):
+        "Returns True if the file name, without any sharded folders, matches a protected pattern"
+        filename = name.rsplit('/', 1)[-1]
+        return any(fnmatch.fnmatchcase(filename, pattern) for pattern in self.retention.protected)
+
+
+    def _below_cursor(self, key):
+        "Returns the number of files in the index scored below the cursor"
+        if self._cursor == '-inf':
+            return 0
+        return self.rconn.zcount(key, '-inf', '(' + repr(self._cursor))
+
+
+    def clean(self):
+        "Deletes up to BATCH of the oldest files beyond the limits, returns the number deleted"
+        usage = blob_usage(self.rconn, self.redisserver)
+        files = usage['files']
+        totalbytes = usage['bytes']
+        oldest = time() - self.retention.max_age if self.retention.max_age else None
+        key = self.redisserver.keyprefix + 'blobindex'
+        if self._below_cursor(key) != self._skipped:
+            # files older than the cursor have been added or removed, so start from the oldest
+            self._cursor = '-inf'
+        start = self._cursor
+        deleted = 0
+        # position from start of the oldest file not yet deleted, skipped files are passed,
+        # and while every file passed is protected, the cursor follows them
+        position = 0
+        head = True
+        try:
+            while deleted < BATCH:
+                entries = self.rconn.zrangebyscore(key, start, '+inf', start=position, num=BATCH, withscores=True)
+                if not entries:
+                    break
+                names = [name.decode('utf-8') if isinstance(name, bytes) else name for name, score in entries]
+                for name, (rxname, score) in zip(names, entries):
+                    if ((oldest is None or score >= oldest) and
+                        (not self.retention.max_count or files <= self.retention.max_count) and
+                        (not self.retention.max_bytes or totalbytes <= self.retention.max_bytes)):
+                        # this file, and all newer files, are within the limits
+                        return deleted
+                    if self._protected(name):
+                        position += 1
+                        if head:
+                            self._cursor = score
+                        continue
+                    try:
+                        (self.blob_folder / name).unlink()
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        # cannot be deleted, so left in place, and tried again at the next check
+                        position += 1
+                        head = False
+                        continue
+                    freed = remove_blob(self.rconn, self.redisserver, name)
+                    forget_blob(self.rconn, self.redisserver, name)
+                    if self.previews is not None:
+                        self.previews.remove(name.rsplit('/', 1)[-1])
+                    if "/" in name:
+                        # a sharded path, whose folders may now be empty
+                        prune_folders(self.blob_folder, name)
+                    files -= 1
+                    # a file hard linked to contents still held frees no space
+                    totalbytes -= freed
+                    deleted += 1
+                    if deleted >= BATCH:
+                        break
+            return deleted
+        finally:
+            self._skipped = self._below_cursor(key)
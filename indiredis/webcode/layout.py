@@ -0,0 +1,57 @@
+
+"""An optional sharded layout of the blob folder.
+
+indi-mr writes every BLOB to the top of the blob folder, which with many thousands of files
+slows every operation on the folder. With the sharded layout, each file received is moved
+into a sub folder YYYY/MM/DD/devicename, so no folder holds more than a day's files of one
+device.
+
+The blob index then holds paths relative to the blob folder, rather than file names, and
+the redis hash blobpath, prefixed by redisserver.keyprefix, maps each file name to its path.
+blobindex.migrate_blob_folder moves the files of an existing flat folder into the sharded layout.
+"""
+
+import os, re
+
+from datetime import datetime
+
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUTS = (FLAT, SHARDED)
+
+
+def shard_folder(devicename, timestamp):
+    "Returns the folder, relative to the blob folder, of a file of the device received at the unix timestamp"
+    # device names may hold spaces or other characters unsuitable for a folder name
+    device = re.sub(r'[^\w\-]', '_', devicename).lstrip('_') or "unknown"
+    return datetime.fromtimestamp(timestamp).strftime("%Y/%m/%d/") + device
+
+
+def shard_blob(blob_folder, filename, devicename, timestamp):
+    "Moves the file from the top of the blob folder to its shard folder, returns its relative path"
+    folder = shard_folder(devicename, timestamp)
+    (blob_folder / folder).mkdir(parents=True, exist_ok=True)
+    relpath = folder + "/" + filename
+    os.replace(blob_folder / filename, blob_folder / relpath)
+    return relpath
+
+
+def prune_folders(blob_folder, relpath):
+    "Removes the shard folders of relpath which have become empty"
+    parent = (blob_folder / relpath).parent
+    while parent != blob_folder:
+        try:
+            parent.rmdir()
+        except OSError:
+            # not empty
+            return
+        parent = parent.parent
+
+
+def blob_paths(rconn, redisserver, filenames):
+    "Returns a list of the paths, relative to the blob folder, of the given file names"
+    if not filenames:
+        return []
+    rxpaths = rconn.hmget(redisserver.keyprefix + 'blobpath', filenames)
+    return [relpath.decode('utf-8') if relpath else filename for filename, relpath in zip(filenames, rxpaths)]
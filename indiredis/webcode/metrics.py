@@ -0,0 +1,170 @@
+
+"""Metrics of the web service, served in the Prometheus text format.
+
+Requests and redis commands are added to a Metrics object by the RedisMeter of
+webcode.instrument, while the number of sessions, the blob folder usage and the depth of
+the waitress task queue are read when the metrics are requested. The MetricsServer WSGI
+application is served at url + "metrics", which if a password is set requires a login,
+unless make_wsgi_app is given public_metrics, for example scraped by Prometheus with::
+
+    scrape_configs:
+      - job_name: indiredis
+        static_configs:
+          - targets: ['localhost:8000']
+
+Metrics, all prefixed indiredis_, are
+
+request_seconds          - histogram of request durations, labelled by skipole page ident
+redis_commands_total     - counter of redis commands sent, labelled by command
+redis_round_trip_seconds - histogram of the time from sending commands to the last reply
+sessions                 - number of logged in sessions, the cookies held in redis
+blob_files, blob_bytes   - number and total size of files in the blob folder
+waitress_queue_depth     - requests waiting for a waitress thread
+waitress_active_threads  - waitress threads serving requests
+"""
+
+import threading
+
+from collections import Counter
+
+from .blobindex import blob_usage
+
+
+# upper bounds in seconds of the request duration histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# upper bounds in seconds of the redis round trip histogram buckets
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+
+class _Histogram():
+    "Counts observations in cumulative buckets, as a Prometheus histogram"
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        "Returns the sample lines of the histogram, labels being a string such as 'ident=\"5\"'"
+        separator = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        braces = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{braces} {self.sum}')
+        lines.append(f'{name}_count{braces} {self.count}')
+        return lines
+
+
+def _escape(value):
+    "Escapes a label value"
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics():
+    "Holds the request and redis metrics, added to by threads serving requests"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # dictionary of page ident:_Histogram
+        self._requests = {}
+        self._commands = Counter()
+        self._redis = _Histogram(REDIS_BUCKETS)
+        # the waitress server, if set by _Dispatcher.set_server
+        self.server = None
+
+    def request(self, ident, seconds):
+        "Adds a request to the given page ident, taking seconds"
+        ident = 'none' if ident is None else str(ident)
+        with self._lock:
+            histogram = self._requests.get(ident)
+            if histogram is None:
+                histogram = self._requests[ident] = _Histogram(REQUEST_BUCKETS)
+            histogram.observe(seconds)
+
+    def commands(self, names):
+        "Adds the given redis command names"
+        with self._lock:
+            self._commands.update(names)
+
+    def round_trip(self, seconds):
+        "Adds a redis round trip taking seconds"
+        with self._lock:
+            self._redis.observe(seconds)
+
+    def lines(self):
+        "Returns the lines of the request and redis metrics"
+        lines = ["# HELP indiredis_request_seconds Duration of requests, by skipole page ident",
+                 "# TYPE indiredis_request_seconds histogram"]
+        with self._lock:
+            for ident in sorted(self._requests):
+                lines.extend(self._requests[ident].lines("indiredis_request_seconds", f'ident="{_escape(ident)}"'))
+            lines.extend(["# HELP indiredis_redis_commands_total Redis commands sent, by command",
+                          "# TYPE indiredis_redis_commands_total counter"])
+            for name in sorted(self._commands):
+                lines.append(f'indiredis_redis_commands_total{{command="{_escape(name)}"}} {self._commands[name]}')
+            lines.extend(["# HELP indiredis_redis_round_trip_seconds Time from sending redis commands to the last reply",
+                          "# TYPE indiredis_redis_round_trip_seconds histogram"])
+            lines.extend(self._redis.lines("indiredis_redis_round_trip_seconds"))
+        return lines
+
+
+def _gauge(name, text, value):
+    "Returns the lines of a gauge"
+    return [f"# HELP {name} {text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+
+class MetricsServer():
+    "WSGI application serving the metrics, and the gauges read from proj_data, as Prometheus text"
+
+    def __init__(self, metrics, proj_data):
+        self.metrics = metrics
+        self.proj_data = proj_data
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain'), ('Allow', 'GET, HEAD')])
+            return [b"Method not allowed"]
+        try:
+            lines = self.metrics.lines() + self._gauges()
+        except Exception:
+            # redis is unavailable
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b"Metrics unavailable"]
+        data = ("\n".join(lines) + "\n").encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                  ('Content-Length', str(len(data))),
+                                  ('Cache-Control', 'no-store')])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [data]
+
+    def _gauges(self):
+        "Returns the lines of the gauges, read as the metrics are requested"
+        rconn = self.proj_data["rconn"]
+        lines = _gauge("indiredis_sessions", "Logged in sessions", rconn.zcard(self.proj_data["rediskey"]))
+        if self.proj_data["blob_folder"]:
+            usage = blob_usage(rconn, self.proj_data["redisserver"])
+            lines.extend(_gauge("indiredis_blob_files", "Files in the blob folder", usage['files']))
+            lines.extend(_gauge("indiredis_blob_bytes", "Total size of the files in the blob folder", usage['bytes']))
+        server = self.metrics.server
+        dispatcher = getattr(server, 'task_dispatcher', None)
+        if dispatcher is not None:
+            lines.extend(_gauge("indiredis_waitress_queue_depth", "Requests waiting for a waitress thread",
+                                len(dispatcher.queue)))
+            lines.extend(_gauge("indiredis_waitress_active_threads", "Waitress threads serving requests",
+                                dispatcher.active_count))
+        return lines
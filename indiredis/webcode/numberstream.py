@@ -0,0 +1,164 @@
+
+"""An optional WebSocket server streaming NumberVector values as they change.
+
+This requires the websockets package:
+
+python3 -m pip install websockets
+
+A client connects to ws://host:port/devicename/group, or ws://host:port/devicename for
+every group, with device and group names url quoted. It first receives all the number
+vectors of the device and group, then each number vector as it changes, as a JSON list of
+objects with keys 'device', 'property', 'state', 'timestamp' and 'elements', the latter
+being an object of element name:formatted number, as formatted by tools.format_number.
+
+If a client reads slowly, changes to the same property are merged, so only the latest
+values are sent.
+
+As browsers send the login cookie with a WebSocket connection made by any site, a connection
+whose Origin header names a host other than that of its Host header, or the host the server
+listens on, is refused.
+"""
+
+import asyncio, json, threading
+
+from urllib.parse import unquote, urlsplit
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+# changes for which the values of the number vector are sent
+_NUMBERTAGS = ('setNumberVector', 'defNumberVector')
+# changes for which every number vector of the device is sent
+_ALLTAGS = ('delProperty', 'load', 'reload')
+
+
+class NumberStreamServer():
+    """Runs a WebSocket server in its own thread, with an asyncio loop. The function
+       logged_in is called with the Cookie header of each connection, and should
+       return True if the connection is allowed"""
+
+    def __init__(self, propertycache, logged_in, host, port):
+        if websockets is None:
+            raise ImportError("The websockets package is required for the number stream: python3 -m pip install websockets")
+        self.propertycache = propertycache
+        self.logged_in = logged_in
+        self.host = host
+        self.port = port
+        self.loop = None
+        # set of _Client objects currently connected
+        self._clients = set()
+
+
+    def start(self):
+        "Starts the server thread"
+        thread = threading.Thread(target=asyncio.run, args=(self._serve(),), name="indiredis_numberstream", daemon=True)
+        thread.start()
+
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.propertycache.add_listener(self._listener)
+        async with websockets.serve(self._handler, self.host, self.port):
+            await asyncio.Future()
+
+
+    def _listener(self, event):
+        "Called in the cache subscriber thread, passes the change to the asyncio loop"
+        self.loop.call_soon_threadsafe(self._dispatch, event)
+
+
+    def _dispatch(self, event):
+        "Marks the changed property as pending for each client of the device"
+        sequence, tag, devicename, propertyname = event
+        if tag in _NUMBERTAGS:
+            for client in self._clients:
+                if client.devicename == devicename:
+                    client.add(propertyname)
+        elif tag in _ALLTAGS:
+            for client in self._clients:
+                if (devicename is None) or (client.devicename == devicename):
+                    client.add(None)
+
+
+    async def _handler(self, websocket, path=None):
+        "Serves a connection"
+        # the websockets package has changed how the request is provided
+        request = getattr(websocket, "request", None)
+        if request is None:
+            path = websocket.path
+            headers = websocket.request_headers
+        else:
+            path = request.path
+            headers = request.headers
+        if not self._same_origin(headers):
+            await websocket.close(code=1008, reason="Origin not allowed")
+            return
+        # the login check may read redis, so is not run on the asyncio loop
+        if not await self.loop.run_in_executor(None, self.logged_in, headers.get('Cookie', '')):
+            await websocket.close(code=1008, reason="Not logged in")
+            return
+        parts = [unquote(part) for part in path.split('?')[0].strip('/').split('/')]
+        if (not parts[0]) or (len(parts) > 2):
+            await websocket.close(code=1008, reason="Path should be /devicename/group")
+            return
+        devicename = parts[0]
+        group = parts[1] if len(parts) == 2 else None
+        client = _Client(devicename)
+        self._clients.add(client)
+        try:
+            await websocket.send(json.dumps(self.propertycache.read_numbervectors(devicename, group)))
+            while True:
+                pending = await client.wait()
+                if None in pending:
+                    numbervectors = self.propertycache.read_numbervectors(devicename, group)
+                else:
+                    numbervectors = []
+                    for propertyname in sorted(pending):
+                        numbervectors.extend(self.propertycache.read_numbervectors(devicename, group, propertyname))
+                if numbervectors:
+                    await websocket.send(json.dumps(numbervectors))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._clients.discard(client)
+
+
+    def _same_origin(self, headers):
+        """Returns True if the connection has no Origin header, as sent by browsers, or
+           if the Origin host is that of the Host header, or the host listened on"""
+        origin = headers.get('Origin')
+        if not origin:
+            return True
+        originhost = urlsplit(origin).hostname
+        if not originhost:
+            return False
+        allowed = {self.host.lower()}
+        hostheader = headers.get('Host')
+        if hostheader:
+            allowed.add((urlsplit("//" + hostheader).hostname or '').lower())
+        return originhost.lower() in allowed
+
+
+class _Client():
+    "Records the properties changed since values were last sent to a connection"
+
+    def __init__(self, devicename):
+        self.devicename = devicename
+        self.pending = set()
+        self.event = asyncio.Event()
+
+    def add(self, propertyname):
+        "Adds a changed property, None indicating all properties"
+        self.pending.add(propertyname)
+        self.event.set()
+
+    async def wait(self):
+        "Waits for changes, and returns the set of changed properties"
+        await self.event.wait()
+        self.event.clear()
+        pending = self.pending
+        self.pending = set()
+        return pending
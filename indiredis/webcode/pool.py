@@ -0,0 +1,94 @@
+
+"""Opens redis connections from a pool sized for the web server.
+
+With a threaded web server, each thread making a redis call takes a connection from the
+pool, and returns it when the call completes, so a slow call such as publishing a large
+BLOB does not hold up other requests. A BlockingConnectionPool is used, so if every
+connection is in use a thread waits for one to be returned, rather than opening an
+unlimited number of connections.
+
+Connections are also used by background threads, the property cache holds one
+permanently for its pub/sub subscription and uses another to read each change, and the
+BLOB indexer, janitor, deduplicator and preview maker, the threads publishing compressed
+uploads, and the number stream server, each use one. background_connections returns the
+number of these, which should be added to the number of web server threads.
+"""
+
+from collections import namedtuple
+
+import redis
+
+
+RedisPool = namedtuple('RedisPool', ['max_connections', 'unix_socket_path', 'socket_timeout', 'timeout'])
+
+
+def redis_pool(max_connections=10, unix_socket_path='', socket_timeout=5, timeout=20):
+    """Creates a named tuple describing a pool of redis connections.
+
+    :param max_connections: Maximum number of connections, which should exceed the number of web server threads
+    :type max_connections: Integer
+    :param unix_socket_path: If given, connects to redis by this unix socket rather than host and port
+    :type unix_socket_path: String
+    :param socket_timeout: Seconds to wait for a redis reply
+    :type socket_timeout: Float
+    :param timeout: Seconds a thread waits for a connection when all are in use
+    :type timeout: Float
+    :return: A named tuple with above parameters as named elements
+    :rtype: collections.namedtuple
+    """
+    return RedisPool(max_connections, unix_socket_path, socket_timeout, timeout)
+
+
+def background_connections(blob_folder='', compress_workers=1, blob_retention=None, blob_dedup=False, websocket_port=0):
+    """Returns the number of pool connections which may be used at once by background threads
+       rather than web server threads, given the arguments of make_wsgi_app"""
+    # the property cache subscription, and its reads of each change
+    count = 2
+    # compressed uploads are published by a thread as each worker process completes
+    count += compress_workers
+    if blob_folder:
+        # the BLOB indexer, the rescan of the folder on start, and the preview maker
+        count += 3
+        if (blob_retention is not None) and (blob_retention.max_bytes or blob_retention.max_age or blob_retention.max_count):
+            # the janitor
+            count += 1
+        if blob_dedup:
+            count += 1
+    if websocket_port:
+        # login checks of the number stream
+        count += 1
+    return count
+
+
+def open_redis_pool(redisserver, pool):
+    "Returns a redis connection using a BlockingConnectionPool as described by pool"
+    kwargs = {'db':redisserver.db,
+              'password':redisserver.password,
+              'socket_timeout':pool.socket_timeout,
+              'max_connections':pool.max_connections,
+              'timeout':pool.timeout}
+    if pool.unix_socket_path:
+        connection_pool = redis.BlockingConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                                       path=pool.unix_socket_path, **kwargs)
+    else:
+        connection_pool = redis.BlockingConnectionPool(host=redisserver.host, port=redisserver.port, **kwargs)
+    return redis.Redis(connection_pool=connection_pool)
+
+
+def pool_stats(rconn):
+    """Returns a dictionary of usage of the connection pool of rconn, with keys
+       'max_connections', 'created', 'in_use' and 'available'"""
+    connection_pool = rconn.connection_pool
+    created = len(getattr(connection_pool, '_connections', []))
+    queue = getattr(connection_pool, 'pool', None)
+    if queue is None:
+        # a standard ConnectionPool, which does not block
+        available = len(getattr(connection_pool, '_available_connections', []))
+    else:
+        # the queue of a BlockingConnectionPool holds None for connections not yet created
+        with queue.mutex:
+            available = sum(1 for connection in queue.queue if connection is not None)
+    return {'max_connections':connection_pool.max_connections,
+            'created':created,
+            'in_use':created - available,
+            'available':available}
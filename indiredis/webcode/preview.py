@@ -0,0 +1,264 @@
+
+"""Makes small PNG previews of FITS images received as BLOBs.
+
+Each FITS file received is read, reduced by averaging blocks of pixels to at most PREVIEWSIZE
+pixels across, stretched between percentiles of its pixel values, and written as a greyscale
+PNG to the folder .previews in the blob folder. This is done in a thread, and only the most
+recently used MAXPREVIEWS previews are kept.
+
+The property page shows the preview, linked to the full file, so a frame can be judged
+without downloading it. This requires the numpy package, without it no previews are made.
+"""
+
+import gzip, os, queue, struct, threading, zlib
+
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .blobserve import BlobServer
+from .versions import bump_versions, group_field
+from .layout import blob_paths
+
+
+# maximum width or height of a preview in pixels
+PREVIEWSIZE = 256
+
+# number of previews kept, the least recently used are deleted
+MAXPREVIEWS = 200
+
+# number of received files which may wait for a preview, further files are not previewed
+QUEUESIZE = 4
+
+# percentiles of the pixel values shown as black and white
+STRETCH = (0.5, 99.5)
+
+# file name endings of the images previewed
+_FITS = ('.fits', '.fit', '.fts', '.fits.gz', '.fit.gz', '.fts.gz')
+
+# numpy data types of the FITS BITPIX values, FITS data is big endian
+_BITPIX = {8:'>u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+# size of a FITS header block, which holds 36 cards of 80 characters
+_FITSBLOCK = 2880
+
+
+def _read_fits(path):
+    "Returns the primary image of the FITS file as a two dimensional numpy float array"
+    opener = gzip.open if path.name.lower().endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        header = {}
+        end = False
+        while not end:
+            block = f.read(_FITSBLOCK)
+            if len(block) < _FITSBLOCK:
+                raise ValueError("Incomplete FITS header")
+            for position in range(0, _FITSBLOCK, 80):
+                card = block[position:position+80].decode('ascii', 'replace')
+                keyword = card[:8].strip()
+                if keyword == 'END':
+                    end = True
+                    break
+                if card[8:10] == '= ':
+                    header[keyword] = card[10:].split('/', 1)[0].strip()
+        bitpix = int(header['BITPIX'])
+        if int(header.get('NAXIS', 0)) < 2:
+            raise ValueError("FITS file has no image")
+        width = int(header['NAXIS1'])
+        height = int(header['NAXIS2'])
+        dtype = numpy.dtype(_BITPIX[bitpix])
+        # only the first plane of a colour or cube image is read
+        count = width * height
+        data = f.read(count * dtype.itemsize)
+    image = numpy.frombuffer(data, dtype=dtype, count=count).reshape(height, width).astype(numpy.float32)
+    # scale to physical values, so unsigned 16 bit data, stored with BZERO 32768, is ordered correctly
+    image = image * float(header.get('BSCALE', 1)) + float(header.get('BZERO', 0))
+    # FITS images are stored from the bottom row up
+    return image[::-1]
+
+
+def _downscale(image, size=PREVIEWSIZE):
+    "Returns the image reduced, by averaging square blocks of pixels, to at most size pixels across"
+    height, width = image.shape
+    factor = -(-max(height, width) // size)
+    if factor <= 1:
+        return image
+    height = height // factor * factor
+    width = width // factor * factor
+    if not (height and width):
+        raise ValueError("Image too narrow to preview")
+    return image[:height, :width].reshape(height//factor, factor, width//factor, factor).mean(axis=(1, 3))
+
+
+def _stretch(image):
+    "Returns the image as unsigned bytes, stretched between the STRETCH percentiles"
+    finite = image[numpy.isfinite(image)]
+    if not finite.size:
+        return numpy.zeros(image.shape, dtype=numpy.uint8)
+    low, high = numpy.percentile(finite, STRETCH)
+    if high <= low:
+        high = low + 1
+    scaled = numpy.clip((image - low) / (high - low), 0, 1)
+    # a square root stretch shows faint detail of astronomical images
+    scaled = numpy.sqrt(scaled)
+    return numpy.nan_to_num(scaled * 255).astype(numpy.uint8)
+
+
+def _chunk(kind, data):
+    "Returns a PNG chunk"
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def _png(image):
+    "Returns the bytes of a greyscale PNG of the two dimensional uint8 image"
+    height, width = image.shape
+    # each row starts with a filter type byte, zero for no filter
+    rows = numpy.zeros((height, width+1), dtype=numpy.uint8)
+    rows[:, 1:] = image
+    return (b'\x89PNG\r\n\x1a\n' +
+            _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            _chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) +
+            _chunk(b'IEND', b''))
+
+
+def make_preview(path):
+    "Returns the PNG preview bytes of the FITS file at path, a pathlib.Path"
+    return _png(_stretch(_downscale(_read_fits(path))))
+
+
+class PreviewMaker():
+    """A listener of the property cache, which makes previews of FITS files received in
+       setBLOBVectors, and keeps the most recently used maxpreviews in the preview folder"""
+
+    def __init__(self, propertycache, rconn, redisserver, blob_folder, maxpreviews=MAXPREVIEWS):
+        self.propertycache = propertycache
+        self.rconn = rconn
+        self.redisserver = redisserver
+        self.preview_folder = blob_folder / ".previews" if blob_folder else None
+        self.maxpreviews = maxpreviews
+        self._queue = queue.Queue(QUEUESIZE)
+        self._lock = threading.Lock()
+        # preview file names, least recently used first
+        self._previews = OrderedDict()
+
+
+    def start(self):
+        "Adds this listener to the property cache, and starts the thread making previews"
+        if (numpy is None) or (self.preview_folder is None):
+            return
+        self.preview_folder.mkdir(parents=True, exist_ok=True)
+        existing = [path for path in self.preview_folder.iterdir() if path.suffix == '.png']
+        existing.sort(key=lambda path: path.stat().st_mtime)
+        with self._lock:
+            for path in existing:
+                self._previews[path.name] = None
+        self._evict()
+        self.propertycache.add_listener(self)
+        thread = threading.Thread(target=self._run, name="indiredis_preview", daemon=True)
+        thread.start()
+
+
+    def __call__(self, event):
+        sequence, tag, devicename, propertyname = event
+        if tag != 'setBLOBVector':
+            return
+        for eld in self.propertycache.read_elements(devicename, propertyname):
+            filepath = eld.get('filepath')
+            if filepath and filepath.lower().endswith(_FITS):
+                try:
+                    self._queue.put_nowait((devicename, propertyname, filepath))
+                except queue.Full:
+                    # previews are behind, this file is not previewed
+                    pass
+
+
+    def _run(self):
+        "Makes previews of the files in the queue"
+        while True:
+            devicename, propertyname, filepath = self._queue.get()
+            try:
+                self._make(filepath)
+            except Exception:
+                # a file which cannot be read has no preview
+                continue
+            # the property page shows the preview with its next json update
+            ad = self.propertycache.read_attributes(devicename, propertyname)
+            if ad.get('group'):
+                bump_versions(self.rconn, self.redisserver, [group_field(devicename, ad['group'])])
+
+
+    def _make(self, filepath):
+        "Writes the preview of the file"
+        filename = os.path.basename(filepath)
+        path = self.preview_folder.parent / filename
+        if not path.is_file():
+            # moved to its shard folder
+            path = self.preview_folder.parent / blob_paths(self.rconn, self.redisserver, [filename])[0]
+        data = make_preview(path)
+        name = filename + ".png"
+        temppath = self.preview_folder / ("." + name)
+        temppath.write_bytes(data)
+        os.replace(temppath, self.preview_folder / name)
+        with self._lock:
+            self._previews[name] = None
+            self._previews.move_to_end(name)
+        self._evict()
+
+
+    def _evict(self):
+        "Deletes the least recently used previews, beyond maxpreviews"
+        with self._lock:
+            removed = []
+            while len(self._previews) > self.maxpreviews:
+                name, value = self._previews.popitem(last=False)
+                removed.append(name)
+        for name in removed:
+            try:
+                (self.preview_folder / name).unlink()
+            except OSError:
+                pass
+
+
+    def preview_name(self, filename):
+        "Returns the name of the preview of the blob file, or None if there is none"
+        name = filename + ".png"
+        with self._lock:
+            if name in self._previews:
+                return name
+
+
+    def remove(self, filename):
+        "Deletes the preview of the blob file, if it has one, as the file has been deleted"
+        if self.preview_folder is None:
+            return
+        name = filename + ".png"
+        with self._lock:
+            self._previews.pop(name, None)
+        try:
+            (self.preview_folder / name).unlink()
+        except OSError:
+            pass
+
+
+    def used(self, name):
+        "Records the preview as recently used"
+        with self._lock:
+            if name in self._previews:
+                self._previews.move_to_end(name)
+
+
+class PreviewServer(BlobServer):
+    "WSGI application serving previews from the preview folder, recording their use"
+
+    def __init__(self, previewmaker):
+        BlobServer.__init__(self, previewmaker.preview_folder)
+        self.previewmaker = previewmaker
+
+    def _path(self, filename):
+        path = BlobServer._path(self, filename)
+        if path is not None:
+            self.previewmaker.used(filename)
+        return path
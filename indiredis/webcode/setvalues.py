@@ -3,12 +3,16 @@ from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from pathlib import Path
 
-import gzip
+from io import BytesIO
+
+from uuid import uuid4
 
 from skipole import FailPage
 
 from indi_mr import tools
 
+from .blobupload import publish_blob
+
 ## hiddenfields are
 #
 # propertyname
@@ -28,6 +32,18 @@ def _fromsafekey(safekey):
     return urlsafe_b64decode(b64binarydata).decode('utf-8') # b64 decode, and convert to string
 
 
+def client_key(skicall, create=False):
+    """Returns a key identifying the browser, being its login cookie if a password is set,
+       otherwise a random key carried in ident_data, created if create is True, or None"""
+    if skicall.proj_data["hashedpassword"]:
+        cookie = skicall.received_cookies.get(skicall.proj_ident)
+        if cookie:
+            return cookie
+    if create and ("client" not in skicall.call_data):
+        skicall.call_data["client"] = uuid4().hex
+    return skicall.call_data.get("client")
+
+
 def set_state(skicall, index, state):
     """Set the state, which is either a string or a dictionary, if it is a dictionary
        the actual state should be set under key 'state'
@@ -513,12 +529,28 @@ def set_blob(skicall):
     fext = ''
     for f in fextension:
         fext += f
-    if skicall.call_data['zipbox', "checkbox"] == "zipfile":
-        # zip the file and add .gz extension
-        rxfile = gzip.compress(rxfile)
-        fext = fext + ".gz"
-    data_sent = tools.newblobvector(rconn, redisserver, propertyname, devicename, [{'name':elementname, 'size':lenrxfile, 'format':fext, 'value':rxfile}])
-    if not data_sent:
+    # zip the file if requested, in which case .gz is added to the extension
+    zipfile = skicall.call_data['zipbox', "checkbox"] == "zipfile"
+    if zipfile:
+        # compression is done in another process, which publishes the file when complete
+        if not rconn.exists(redisserver.keyprefix + 'attributes:' + propertyname + ':' + devicename):
+            raise FailPage("Error sending data")
+        client = client_key(skicall, create=True)
+        if not skicall.proj_data["compression"].submit(client, devicename, propertyname, elementname, rxfile, fext):
+            raise FailPage("Too many files are awaiting compression, please try again later")
+        set_state(skicall, sectionindex, "Busy")
+        skicall.call_data["status"] = f"""The file has been queued for compression:
+    Device name   : {devicename}
+    Property name : {propertyname}
+    Element name  : {elementname}
+    Size          : {lenrxfile}
+    Format        : {fext}.gz
+It will be sent when compressed, and its status shown on the next page update."""
+        return
+    # skipole has received the file into memory, publish_blob encodes it in blocks
+    # into a temporary file, rather than making further copies in memory
+    data_sent = publish_blob(rconn, redisserver, devicename, propertyname, elementname, BytesIO(rxfile), fext)
+    if data_sent is None:
         raise FailPage("Error sending data")
     set_state(skicall, sectionindex, "Busy")
     skicall.call_data["status"] = f"""The file has been submitted:
@@ -0,0 +1,285 @@
+
+"""Reads the property tree of a device from redis in a single round trip.
+
+The redis key layout is that created by indi-mr, with keys prefixed by redisserver.keyprefix
+
+devices                                            - set of device names
+properties:devicename                              - set of property names
+attributes:propertyname:devicename                 - hash of property attributes
+elements:propertyname:devicename                   - set of element names
+elementattributes:elementname:propertyname:devicename  - hash of element attributes
+messages                                           - list of system messages, latest first
+devicemessages:devicename                          - list of device messages, latest first
+
+Rather than calling the indi_mr.tools functions once per property and element, a lua
+script is run on the redis server which gathers all of these into one reply.
+
+read_group reads only the properties of one group, listed by the index of webcode.groupindex.
+"""
+
+
+from indi_mr import tools
+
+from .groupindex import order_groups
+
+
+# ARGV[1] is the key prefix, ARGV[2] the device name, ARGV[3] the group, if ARGV[3] is an
+# empty string element attributes are returned for every property, otherwise only for those
+# properties with the given group
+_DEVICE_SCRIPT = """
+local prefix = ARGV[1]
+local device = ARGV[2]
+local group = ARGV[3]
+local devices = redis.call('SMEMBERS', prefix .. 'devices')
+local properties = redis.call('SMEMBERS', prefix .. 'properties:' .. device)
+local message = redis.call('LINDEX', prefix .. 'messages', 0)
+local devicemessage = redis.call('LINDEX', prefix .. 'devicemessages:' .. device, 0)
+local attributes = {}
+local elements = {}
+for i, name in ipairs(properties) do
+    local attkey = prefix .. 'attributes:' .. name .. ':' .. device
+    attributes[i] = redis.call('HGETALL', attkey)
+    local eldicts = {}
+    if group == '' or redis.call('HGET', attkey, 'group') == group then
+        local names = redis.call('SMEMBERS', prefix .. 'elements:' .. name .. ':' .. device)
+        for j, elname in ipairs(names) do
+            eldicts[j] = redis.call('HGETALL', prefix .. 'elementattributes:' .. elname .. ':' .. name .. ':' .. device)
+        end
+    end
+    elements[i] = eldicts
+end
+return {devices, properties, message, devicemessage, attributes, elements}
+"""
+
+
+# ARGV[1] is the key prefix, ARGV[2] the device name, ARGV[3] the group, or if ARGV[4] is '1'
+# the first group of the device. The first item returned is 0 if the group index does not
+# hold every property of the device, in which case the group is not read
+_GROUP_SCRIPT = """
+local prefix = ARGV[1]
+local device = ARGV[2]
+local group = ARGV[3]
+local devices = redis.call('SMEMBERS', prefix .. 'devices')
+local message = redis.call('LINDEX', prefix .. 'messages', 0)
+local devicemessage = redis.call('LINDEX', prefix .. 'devicemessages:' .. device, 0)
+if redis.call('HLEN', prefix .. 'groupindex:' .. device) ~= redis.call('SCARD', prefix .. 'properties:' .. device) then
+    return {0, devices, message, devicemessage}
+end
+local groups = redis.call('ZRANGE', prefix .. 'groups:' .. device, 0, -1)
+if ARGV[4] == '1' then
+    group = groups[1] or ''
+end
+local members = redis.call('ZRANGE', prefix .. 'groupproperties:' .. group .. ':' .. device, 0, -1)
+local properties = {}
+local attributes = {}
+local elements = {}
+for i, member in ipairs(members) do
+    local name = string.sub(member, string.find(member, '\\0', 1, true) + 1)
+    properties[i] = name
+    attributes[i] = redis.call('HGETALL', prefix .. 'attributes:' .. name .. ':' .. device)
+    local eldicts = {}
+    local names = redis.call('SMEMBERS', prefix .. 'elements:' .. name .. ':' .. device)
+    for j, elname in ipairs(names) do
+        eldicts[j] = redis.call('HGETALL', prefix .. 'elementattributes:' .. elname .. ':' .. name .. ':' .. device)
+    end
+    elements[i] = eldicts
+end
+return {1, devices, message, devicemessage, groups, group, properties, attributes, elements}
+"""
+
+
+# ARGV[1] is the key prefix, ARGV[2] the device name, ARGV[3] the property name
+_PROPERTY_SCRIPT = """
+local prefix = ARGV[1]
+local device = ARGV[2]
+local name = ARGV[3]
+local isdevice = redis.call('SISMEMBER', prefix .. 'devices', device)
+local message = redis.call('LINDEX', prefix .. 'messages', 0)
+local devicemessage = redis.call('LINDEX', prefix .. 'devicemessages:' .. device, 0)
+local attributes = redis.call('HGETALL', prefix .. 'attributes:' .. name .. ':' .. device)
+local eldicts = {}
+local names = redis.call('SMEMBERS', prefix .. 'elements:' .. name .. ':' .. device)
+for j, elname in ipairs(names) do
+    eldicts[j] = redis.call('HGETALL', prefix .. 'elementattributes:' .. elname .. ':' .. name .. ':' .. device)
+end
+return {isdevice, message, devicemessage, attributes, eldicts}
+"""
+
+
+# ARGV[1] is the key prefix
+_DEVICELIST_SCRIPT = """
+local prefix = ARGV[1]
+local devices = redis.call('SMEMBERS', prefix .. 'devices')
+local message = redis.call('LINDEX', prefix .. 'messages', 0)
+local devicemessages = {}
+for i, device in ipairs(devices) do
+    devicemessages[i] = redis.call('LINDEX', prefix .. 'devicemessages:' .. device, 0)
+end
+return {devices, message, devicemessages}
+"""
+
+
+def _decode(value):
+    "Returns a string from the bytes returned by redis, None is returned as an empty string"
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+def _flat_to_dict(flatlist):
+    "Converts the flat [key, value, key, value ...] list returned by HGETALL to a dictionary"
+    return {_decode(flatlist[i]):_decode(flatlist[i+1]) for i in range(0, len(flatlist), 2)}
+
+
+def _element_dict(el_dict, vector):
+    """Given a dictionary of element attributes, adds the numeric values which tools.elements_dict
+       provides for number vectors, and returns the dictionary"""
+    if vector != "NumberVector":
+        return el_dict
+    el_dict['float_number'] = tools.number_to_float(el_dict['value'])
+    el_dict['float_min'] = tools.number_to_float(el_dict['min'])
+    el_dict['float_max'] = tools.number_to_float(el_dict['max'])
+    el_dict['float_step'] = tools.number_to_float(el_dict['step'])
+    el_dict['formatted_number'] = tools.format_number(el_dict['float_number'], el_dict['format'])
+    return el_dict
+
+
+def _element_list(rxels, vector):
+    "Returns a list of element dictionaries sorted by label, as tools.property_elements"
+    element_list = [_element_dict(_flat_to_dict(el), vector) for el in rxels if el]
+    element_list.sort(key=lambda eld : eld.get('label', ''))
+    return element_list
+
+
+def read_device(rconn, redisserver, devicename, group=None):
+    """Reads redis with one round trip and returns a dictionary with keys
+
+       'devices'       - sorted list of all device names
+       'message'       - the last system message, or empty string
+       'devicemessage' - the last message of this device, or empty string
+       'attributes'    - dictionary of propertyname:attribute dictionary
+       'elements'      - dictionary of propertyname:list of element dictionaries sorted by label
+
+       If group is given, 'elements' only contains the properties of that group, otherwise
+       it contains all the properties of the device. If the device is unknown, 'attributes'
+       and 'elements' will be empty"""
+    script = rconn.register_script(_DEVICE_SCRIPT)
+    reply = script(args=[redisserver.keyprefix, devicename, group or ''])
+    rxdevices, rxproperties, rxmessage, rxdevicemessage, rxattributes, rxelements = reply
+    devices = sorted(_decode(d) for d in rxdevices)
+    attributes = {}
+    elements = {}
+    for rxname, rxatt, rxels in zip(rxproperties, rxattributes, rxelements):
+        if not rxatt:
+            # property deleted while being read
+            continue
+        propertyname = _decode(rxname)
+        att_dict = _flat_to_dict(rxatt)
+        attributes[propertyname] = att_dict
+        if group and (att_dict.get('group') != group):
+            continue
+        elements[propertyname] = _element_list(rxels, att_dict.get('vector'))
+    return {'devices':devices,
+            'message':_decode(rxmessage),
+            'devicemessage':_decode(rxdevicemessage),
+            'attributes':attributes,
+            'elements':elements}
+
+
+def group_snapshot(snapshot, group=None):
+    """Given the dictionary returned by read_device, returns the dictionary returned by
+       read_group, of the given group, or of the first group of the device if group is None"""
+    order = order_groups(snapshot['attributes'])
+    groups = sorted(order)
+    if group is None:
+        group = groups[0] if groups else ''
+    properties = order.get(group, [])
+    return {'devices':snapshot['devices'],
+            'message':snapshot['message'],
+            'devicemessage':snapshot['devicemessage'],
+            'groups':groups,
+            'group':group,
+            'properties':properties,
+            'attributes':{name:snapshot['attributes'][name] for name in properties},
+            'elements':{name:snapshot['elements'].get(name, []) for name in properties}}
+
+
+def read_group(rconn, redisserver, devicename, group=None):
+    """Reads redis with one round trip, using the group index, and returns a dictionary with keys
+
+       'devices'       - sorted list of all device names
+       'message'       - the last system message, or empty string
+       'devicemessage' - the last message of this device, or empty string
+       'groups'        - sorted list of the groups of the device
+       'group'         - the group read, being the first group of the device if group is None
+       'properties'    - list of the property names of the group, sorted by label
+       'attributes'    - dictionary of propertyname:attribute dictionary of the group
+       'elements'      - dictionary of propertyname:list of element dictionaries sorted by label
+
+       If the index does not hold every property of the device, the whole device is read instead"""
+    script = rconn.register_script(_GROUP_SCRIPT)
+    reply = script(args=[redisserver.keyprefix, devicename, group or '', '' if group else '1'])
+    if not reply[0]:
+        return group_snapshot(read_device(rconn, redisserver, devicename, group), group)
+    indexed, rxdevices, rxmessage, rxdevicemessage, rxgroups, rxgroup, rxproperties, rxattributes, rxelements = reply
+    properties = []
+    attributes = {}
+    elements = {}
+    for rxname, rxatt, rxels in zip(rxproperties, rxattributes, rxelements):
+        if not rxatt:
+            # property deleted while being read
+            continue
+        propertyname = _decode(rxname)
+        att_dict = _flat_to_dict(rxatt)
+        properties.append(propertyname)
+        attributes[propertyname] = att_dict
+        elements[propertyname] = _element_list(rxels, att_dict.get('vector'))
+    return {'devices':sorted(_decode(d) for d in rxdevices),
+            'message':_decode(rxmessage),
+            'devicemessage':_decode(rxdevicemessage),
+            'groups':[_decode(g) for g in rxgroups],
+            'group':_decode(rxgroup),
+            'properties':properties,
+            'attributes':attributes,
+            'elements':elements}
+
+
+def read_property(rconn, redisserver, devicename, propertyname):
+    """Reads redis with one round trip and returns a dictionary with keys
+
+       'isdevice'      - True if the device is in the set of devices
+       'message'       - the last system message, or empty string
+       'devicemessage' - the last message of this device, or empty string
+       'attributes'    - the attribute dictionary of the property, empty if the property does not exist
+       'elements'      - list of element dictionaries sorted by label
+
+       If propertyname is an empty string, only the device and messages are of interest"""
+    script = rconn.register_script(_PROPERTY_SCRIPT)
+    reply = script(args=[redisserver.keyprefix, devicename, propertyname])
+    rxisdevice, rxmessage, rxdevicemessage, rxattributes, rxelements = reply
+    att_dict = _flat_to_dict(rxattributes)
+    if att_dict:
+        element_list = _element_list(rxelements, att_dict.get('vector'))
+    else:
+        element_list = []
+    return {'isdevice':bool(rxisdevice),
+            'message':_decode(rxmessage),
+            'devicemessage':_decode(rxdevicemessage),
+            'attributes':att_dict,
+            'elements':element_list}
+
+
+def read_devicelist(rconn, redisserver):
+    """Reads redis with one round trip and returns a dictionary with keys
+
+       'devices'        - sorted list of all device names
+       'message'        - the last system message, or empty string
+       'devicemessages' - dictionary of devicename:last message of the device, or empty string"""
+    script = rconn.register_script(_DEVICELIST_SCRIPT)
+    rxdevices, rxmessage, rxdevicemessages = script(args=[redisserver.keyprefix])
+    devicemessages = {_decode(d):_decode(m) for d,m in zip(rxdevices, rxdevicemessages)}
+    return {'devices':sorted(devicemessages),
+            'message':_decode(rxmessage),
+            'devicemessages':devicemessages}
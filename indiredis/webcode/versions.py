@@ -0,0 +1,79 @@
+
+"""Version counters recording changes to the data shown on the web pages.
+
+The counters are fields of the redis hash keyprefix + 'webversions', and are incremented
+by the DeviceCache subscriber thread as it applies each change, so a page poll can test
+whether anything it shows has changed with a single HMGET, rather than reading and
+comparing all the data. The fields are
+
+load                        - incremented each time the cache is loaded from redis
+messages                    - the last system message
+devices                     - the set of devices
+devicemessages              - the last message of any device
+devicemessage:device        - the last message of the device
+structure:device            - the set of properties of the device, and their groups
+group:device:group          - values of the properties in the group, which can be updated by json
+groupstructure:device:group - changes in the group which need a html refresh of the page
+
+As the counters only ever increase, the sum of a number of them changes whenever any of
+them changes, and so a page records just two sums in its ident_data.
+"""
+
+
+def _key(redisserver):
+    "Returns the key of the hash of version counters"
+    return redisserver.keyprefix + 'webversions'
+
+
+def devicemessage_field(devicename):
+    "Returns the field counting changes to the last message of the device"
+    return "devicemessage:" + devicename
+
+
+def structure_field(devicename):
+    "Returns the field counting changes to the properties and groups of the device"
+    return "structure:" + devicename
+
+
+def group_field(devicename, group):
+    "Returns the field counting changes to values in the group which can be updated by json"
+    return "group:" + devicename + ":" + group
+
+
+def groupstructure_field(devicename, group):
+    "Returns the field counting changes in the group which need a html refresh"
+    return "groupstructure:" + devicename + ":" + group
+
+
+def bump_versions(rconn, redisserver, fields):
+    "Increments the given version counters"
+    if not fields:
+        return
+    key = _key(redisserver)
+    pipe = rconn.pipeline()
+    for field in fields:
+        pipe.hincrby(key, field, 1)
+    pipe.execute()
+
+
+def read_versions(rconn, redisserver, fields):
+    "Returns the sum of the given version counters, read with one redis call"
+    values = rconn.hmget(_key(redisserver), fields)
+    return sum(int(value) for value in values if value is not None)
+
+
+def devicelist_version(rconn, redisserver):
+    "Returns the version of the devices page"
+    return read_versions(rconn, redisserver, ['load', 'messages', 'devices', 'devicemessages'])
+
+
+def property_versions(rconn, redisserver, devicename, group):
+    """Returns a tuple (version1, version2) for the properties page showing the given group,
+       version1 changes if anything on the page has changed, version2 only if a html refresh is needed"""
+    htmlfields = ['load', 'devices', structure_field(devicename), groupstructure_field(devicename, group)]
+    jsonfields = ['messages', devicemessage_field(devicename), group_field(devicename, group)]
+    values = rconn.hmget(_key(redisserver), htmlfields + jsonfields)
+    values = [int(value) if value is not None else 0 for value in values]
+    version2 = sum(values[:len(htmlfields)])
+    version1 = version2 + sum(values[len(htmlfields):])
+    return version1, version2